@@ -1,16 +1,33 @@
-from flask import Flask, request, jsonify
-from anthropic import Anthropic
+from flask import Flask, g, request, jsonify
+from anthropic import Anthropic, APIConnectionError, APIStatusError
+import base64
+import contextvars
+import hashlib
 import httpx
+import ipaddress
 import json
 import os
-from datetime import date, timedelta
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import wraps
 
 app = Flask(__name__)
 
-# Custom HTTP client for Anthropic
+# Custom HTTP client for Anthropic - shared by every worker thread
 custom_http_client = httpx.Client(
     timeout=60.0,
-    follow_redirects=True
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
 )
 
 client = Anthropic(
@@ -21,10 +38,173 @@ client = Anthropic(
 # Airtable config
 AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY')
 AIRTABLE_BASE_ID = 'app8CI7NAZqhQ4G1Y'
+AIRTABLE_API_URL = os.environ.get('AIRTABLE_API_URL', 'https://api.airtable.com/v0')
 AIRTABLE_CLIENTS_TABLE = 'Clients'
 AIRTABLE_JOBS_TABLE = 'Projects'
 AIRTABLE_UPDATES_TABLE = 'Updates'
 
+# Settle mechanical /traffic routes locally before calling Claude
+TRAFFIC_FAST_PATH = os.environ.get('TRAFFIC_FAST_PATH', 'true').lower() != 'false'
+
+# Stream /traffic completions so the project lookup starts as soon as jobNumber arrives
+TRAFFIC_STREAMING = os.environ.get('TRAFFIC_STREAMING', 'true').lower() != 'false'
+
+# Trim quoted history, signatures and disclaimers before Claude sees an email,
+# then cap what's left at a per-endpoint budget (estimated tokens)
+INPUT_TRIMMING = os.environ.get('INPUT_TRIMMING', 'true').lower() != 'false'
+INPUT_TOKEN_BUDGETS = {
+    'traffic': int(os.environ.get('TRAFFIC_INPUT_BUDGET', 2000)),
+    'triage': int(os.environ.get('TRIAGE_INPUT_BUDGET', 6000)),
+    'update': int(os.environ.get('UPDATE_INPUT_BUDGET', 3000)),
+    'feedback': int(os.environ.get('FEEDBACK_INPUT_BUDGET', 3000))
+}
+
+# Model policy - models to try per endpoint, cheapest first. Each tier's output
+# is checked and escalated to the next model if it fails schema validation or
+# reports low confidence. The last model is the authoritative one.
+SONNET_MODEL = 'claude-sonnet-4-20250514'
+HAIKU_MODEL = 'claude-3-5-haiku-20241022'
+
+
+def model_policy(env_var, default):
+    return [m.strip() for m in os.environ.get(env_var, ','.join(default)).split(',') if m.strip()]
+
+
+MODEL_POLICY = {
+    'traffic': model_policy('TRAFFIC_MODELS', [HAIKU_MODEL, SONNET_MODEL]),
+    'triage': model_policy('TRIAGE_MODELS', [SONNET_MODEL]),
+    'update': model_policy('UPDATE_MODELS', [SONNET_MODEL]),
+    'feedback': model_policy('FEEDBACK_MODELS', [SONNET_MODEL])
+}
+
+# Response cache - Claude's answer for an email is reused for near-identical
+# ones (estimated Jaccard similarity of word 3-shingles at or above
+# RESPONSE_CACHE_SIMILARITY). TTLs are per endpoint; 0 turns an endpoint's
+# cache off.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 2000))
+RESPONSE_CACHE_TTLS = {
+    'traffic': float(os.environ.get('TRAFFIC_CACHE_TTL', 900)),
+    'triage': float(os.environ.get('TRIAGE_CACHE_TTL', 600))
+}
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('RESPONSE_CACHE_SIMILARITY', 0.85))
+RESPONSE_CACHE_MIN_TOKENS = 20
+
+# Project cache config - how long a looked-up project stays fresh
+PROJECT_CACHE_TTL = float(os.environ.get('PROJECT_CACHE_TTL', 300))
+PROJECT_CACHE_SIZE = int(os.environ.get('PROJECT_CACHE_SIZE', 512))
+
+# Client directory - seconds between background reloads of the Clients table
+CLIENT_DIRECTORY_REFRESH = float(os.environ.get('CLIENT_DIRECTORY_REFRESH', 600))
+
+# Local state (job number blocks etc.) lives in one SQLite file
+DOT_DATA_DIR = os.environ.get('DOT_DATA_DIR', 'data')
+DOT_DB_PATH = os.path.join(DOT_DATA_DIR, 'dot.db')
+# Rate limiter state gets its own file - every Airtable and Anthropic call
+# takes a slot with a short write transaction, and in dot.db those would
+# queue on the one SQLite write lock behind journal, job queue and
+# idempotency writes (and they behind it)
+RATE_LIMIT_DB_PATH = os.path.join(DOT_DATA_DIR, 'rate_limits.db')
+
+# Job numbers reserved from Airtable per round trip. 1 = no pre-reservation,
+# higher values skip the Airtable read-modify-write on most triages but leave
+# gaps if the local database is lost with part of a block unused.
+JOB_NUMBER_BLOCK_SIZE = max(1, int(os.environ.get('JOB_NUMBER_BLOCK_SIZE', 1)))
+
+# Airtable accepts at most 10 records per create/update request
+AIRTABLE_BATCH_SIZE = 10
+
+# Write-behind - Airtable writes are journalled in SQLite and the response
+# returns once they're queued. The flusher retries failures with backoff.
+AIRTABLE_WRITE_BEHIND = os.environ.get('AIRTABLE_WRITE_BEHIND', 'true').lower() != 'false'
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get('JOURNAL_MAX_ATTEMPTS', 10))
+JOURNAL_POLL_INTERVAL = 0.5
+JOURNAL_CLAIM_TIMEOUT = 60.0
+# Claims are renewed this often while their send is in progress, however
+# long the rate limiter or circuit breaker holds it up
+JOURNAL_CLAIM_RENEW_FRACTION = 0.25
+JOURNAL_RETENTION = 86400.0
+
+# Upstream rate limits (requests/second, shared by all workers; 0 = off) and
+# how long a call may queue for a slot before giving up. Airtable allows 5
+# requests a second per base.
+AIRTABLE_RATE_LIMIT = float(os.environ.get('AIRTABLE_RATE_LIMIT', 5))
+AIRTABLE_RATE_BURST = int(os.environ.get('AIRTABLE_RATE_BURST', 5))
+ANTHROPIC_RATE_LIMIT = float(os.environ.get('ANTHROPIC_RATE_LIMIT', 0))
+ANTHROPIC_RATE_BURST = int(os.environ.get('ANTHROPIC_RATE_BURST', 10))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 15))
+
+# Circuit breakers - consecutive upstream failures before failing fast, and
+# seconds before a trial call is let through again
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+# Batch endpoints - emails per request and concurrent Claude calls per batch
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 200))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 5))
+
+# Idempotency - how long completed responses are replayed, how many are kept,
+# and how long a duplicate waits on the original before giving up
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 3600))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 5000))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 120))
+
+# Async jobs - /triage, /update and the batch endpoints queue the work and
+# return a job id when the caller asks (Prefer: respond-async, ?async=1 or a
+# callbackUrl). Jobs are run by worker.py processes and/or JOB_QUEUE_WORKERS
+# threads in each web worker. A job that hits a 503 is retried, up to
+# JOB_MAX_ATTEMPTS runs; callbacks get JOB_CALLBACK_ATTEMPTS tries.
+# Callbacks are only sent to JOB_CALLBACK_HOSTS (and their subdomains) - none
+# when it's unset - and never to private or loopback addresses.
+JOB_QUEUE_WORKERS = int(os.environ.get('JOB_QUEUE_WORKERS', 0))
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', 5))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_CALLBACK_ATTEMPTS = int(os.environ.get('JOB_CALLBACK_ATTEMPTS', 5))
+JOB_CALLBACK_HOSTS = [host.strip().lower() for host in os.environ.get('JOB_CALLBACK_HOSTS', '').split(',') if host.strip()]
+JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 7 * 86400))
+JOB_POLL_INTERVAL = 0.5
+JOB_HEARTBEAT_INTERVAL = 10.0
+
+# WIP snapshot - how often /wip checks Airtable for changed records, and how
+# often it does a full re-fetch to pick up deletions
+WIP_REFRESH_INTERVAL = float(os.environ.get('WIP_REFRESH_INTERVAL', 30))
+WIP_FULL_SYNC_INTERVAL = float(os.environ.get('WIP_FULL_SYNC_INTERVAL', 3600))
+
+# Feedback attachments - how many per request, how big each may be, and how
+# much of them Claude sees (estimated tokens, shared across attachments).
+# Extraction stops after FEEDBACK_EXTRACT_MAX_CHARS of document text or
+# FEEDBACK_MAX_PDF_PAGES pages; results are cached by content hash.
+FEEDBACK_MAX_ATTACHMENTS = int(os.environ.get('FEEDBACK_MAX_ATTACHMENTS', 10))
+FEEDBACK_MAX_ATTACHMENT_BYTES = int(os.environ.get('FEEDBACK_MAX_ATTACHMENT_BYTES', 25 * 1024 * 1024))
+FEEDBACK_ATTACHMENT_BUDGET = int(os.environ.get('FEEDBACK_ATTACHMENT_BUDGET', 20000))
+FEEDBACK_EXTRACT_MAX_CHARS = int(os.environ.get('FEEDBACK_EXTRACT_MAX_CHARS', 200000))
+FEEDBACK_MAX_PDF_PAGES = int(os.environ.get('FEEDBACK_MAX_PDF_PAGES', 300))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.environ.get('EXTRACTION_CACHE_MAX_ENTRIES', 500))
+
+# Largest request body accepted - Flask answers 413 above it. Sized for
+# /feedback with base64 attachments (a third bigger than the files).
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_REQUEST_BYTES', 80 * 1024 * 1024))
+
+# Record inbound payloads (redacted) with the Claude and Airtable responses they
+# caused, one JSON line per request, for replay.py. Off unless RECORDING_PATH is set.
+RECORDING_PATH = os.environ.get('RECORDING_PATH')
+RECORDING_SALT = os.environ.get('RECORDING_SALT', '')
+RECORDED_ENDPOINTS = ['/traffic', '/triage', '/update', '/triage/batch', '/update/batch']
+
+# HTTP/2 needs the optional h2 package - fall back to HTTP/1.1 keep-alive without it
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# PDF attachments need the optional pypdf package - without it /feedback
+# notes that a PDF couldn't be read and works from the email and other files
+try:
+    import pypdf
+    PDF_AVAILABLE = True
+except ImportError:
+    PDF_AVAILABLE = False
+
 # Load prompts from files
 with open('dot_traffic_prompt.txt', 'r') as f:
     TRAFFIC_PROMPT = f.read()
@@ -35,17 +215,36 @@ with open('dot_triage_prompt.txt', 'r') as f:
 with open('dot_update_prompt.txt', 'r') as f:
     UPDATE_PROMPT = f.read()
 
+with open('dot_feedback_prompt.txt', 'r') as f:
+    FEEDBACK_PROMPT = f.read()
+
+
+json_decoder = json.JSONDecoder()
+
+
+def extract_json(text):
+    """The outermost JSON object in Claude's reply, wherever it sits.
+
+    Code fences, a preamble and trailing prose are skipped: the object is
+    decoded from the first '{' in one pass, and only if that fails (a stray
+    brace in the preamble) does the scan move on past the failure point.
+    Raises json.JSONDecodeError when there's no object at all."""
+    start = text.find('{')
+    while start != -1:
+        try:
+            return json_decoder.raw_decode(text, start)[0]
+        except json.JSONDecodeError as e:
+            start = text.find('{', max(start + 1, e.pos))
+    raise json.JSONDecodeError('No JSON object in reply', text, 0)
+
 
-def strip_markdown_json(content):
-    """Strip markdown code blocks from Claude's JSON response"""
-    content = content.strip()
-    if content.startswith('```'):
-        # Remove first line (```json or ```)
-        content = content.split('\n', 1)[1] if '\n' in content else content[3:]
-    if content.endswith('```'):
-        # Remove trailing ```
-        content = content.rsplit('```', 1)[0]
-    return content.strip()
+def normalise_job_number(job_number):
+    """Canonical job number form, e.g. 'one_125' -> 'ONE 125'."""
+    job_number = (job_number or '').strip().upper()
+    match = re.fullmatch(r'([A-Z]{3})[\s_]*(\d{3})', job_number)
+    if match:
+        return f"{match.group(1)} {match.group(2)}"
+    return job_number
 
 
 def get_next_working_day(start_date, days=5):
@@ -60,341 +259,3357 @@ def get_next_working_day(start_date, days=5):
 
 
 # ===================
-# AIRTABLE HELPERS
+# METRICS
 # ===================
+# Span timings, token usage and error counters, exported in Prometheus text
+# format on /metrics. Each gunicorn worker keeps its own registry, so a scrape
+# sees the worker that answered it.
 
-def get_job_info_from_airtable(client_code):
-    """Look up client in Airtable, increment job number, return job number, team ID, SharePoint URL, and client record ID
-    Used by TRIAGE for new jobs"""
-    if not AIRTABLE_API_KEY:
-        print("No Airtable API key configured")
-        return f"{client_code} TBC", None, None, None
-    
-    try:
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Search for the client code
-        search_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_CLIENTS_TABLE}"
-        params = {'filterByFormula': f"{{Client code}}='{client_code}'"}
-        
-        response = httpx.get(search_url, headers=headers, params=params, timeout=10.0)
-        response.raise_for_status()
-        
-        records = response.json().get('records', [])
-        
-        if not records:
-            print(f"Client code '{client_code}' not found in Airtable")
-            return f"{client_code} TBC", None, None, None
-        
-        record = records[0]
-        record_id = record['id']
-        fields = record['fields']
-        
-        current_number = fields.get('Next #', 1)
-        team_id = fields.get('Teams ID', None)
-        sharepoint_url = fields.get('Sharepoint ID', None)
-        next_number = current_number + 1
-        
-        # Format job number (e.g., "TOW 023")
-        job_number = f"{client_code} {str(current_number).zfill(3)}"
-        
-        # Update Airtable with incremented number
-        update_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_CLIENTS_TABLE}/{record_id}"
-        update_data = {'fields': {'Next #': next_number}}
-        
-        httpx.patch(update_url, headers=headers, json=update_data, timeout=10.0)
-        
-        return job_number, team_id, sharepoint_url, record_id
-        
-    except Exception as e:
-        print(f"Error getting job info from Airtable: {e}")
-        return f"{client_code} TBC", None, None, None
+# Histogram buckets in seconds - Airtable calls sit at the low end, Claude at the top
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
 
 
-def get_project_from_airtable(job_number):
-    """Look up existing project by job number. Returns project details or None.
-    Used by TRAFFIC to validate job numbers and enrich routing data."""
-    if not AIRTABLE_API_KEY:
-        print("No Airtable API key configured")
-        return None
-    
-    try:
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Search for the job number
-        search_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_JOBS_TABLE}"
-        params = {'filterByFormula': f"{{Job Number}}='{job_number}'"}
-        
-        response = httpx.get(search_url, headers=headers, params=params, timeout=10.0)
-        response.raise_for_status()
-        
-        records = response.json().get('records', [])
-        
-        if not records:
-            print(f"Job '{job_number}' not found in Airtable")
-            return None
-        
-        record = records[0]
-        fields = record['fields']
-        
-        # Get client name from linked record if available
-        client_name = fields.get('Client', '')
-        if isinstance(client_name, list):
-            client_name = client_name[0] if client_name else ''
-        
-        return {
-            'recordId': record['id'],
-            'jobNumber': fields.get('Job Number', job_number),
-            'jobName': fields.get('Project Name', ''),
-            'clientName': client_name,
-            'stage': fields.get('Stage', ''),
-            'status': fields.get('Status', ''),
-            'round': fields.get('Round', 0),
-            'withClient': fields.get('With Client?', False),
-            'teamsChannelId': fields.get('Teams Channel ID', None)
-        }
-        
-    except Exception as e:
-        print(f"Error looking up project in Airtable: {e}")
-        return None
+class Metrics:
+    """Thread-safe counters and histograms keyed by metric name and labels."""
 
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.descriptions = {}
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self._lock = threading.Lock()
 
-def create_update_in_airtable(project_record_id, update_text, update_due=None):
-    """Create a new update record in the Updates table."""
-    if not AIRTABLE_API_KEY:
-        print("No Airtable API key configured")
-        return False
-    
-    try:
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Default to 5 working days if no due date provided
-        if not update_due:
-            update_due = get_next_working_day(date.today(), 5).isoformat()
-        
-        # Build the update record
-        update_data = {
-            'fields': {
-                'Project Link': [project_record_id],
-                'Update': update_text,
-                'Updated on': date.today().isoformat(),
-                'Update due': update_due
-            }
-        }
-        
-        # Create the record
-        create_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_UPDATES_TABLE}"
-        response = httpx.post(create_url, headers=headers, json=update_data, timeout=10.0)
-        response.raise_for_status()
-        
-        print(f"Created update for project {project_record_id}: {update_text}")
-        return True
-        
-    except Exception as e:
-        print(f"Error creating update in Airtable: {e}")
-        return False
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
 
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += amount
 
-def update_project_fields_in_airtable(job_number, updates):
-    """Update specific fields on the Project record (Stage, Status, Live Date, With Client).
-    NOT used for Update field - that comes from Updates table lookup."""
-    if not AIRTABLE_API_KEY:
-        print("No Airtable API key configured")
-        return False
-    
-    try:
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # First find the record
-        search_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_JOBS_TABLE}"
-        params = {'filterByFormula': f"{{Job Number}}='{job_number}'"}
-        
-        response = httpx.get(search_url, headers=headers, params=params, timeout=10.0)
-        response.raise_for_status()
-        
-        records = response.json().get('records', [])
-        
-        if not records:
-            print(f"Job '{job_number}' not found for update")
-            return False
-        
-        record_id = records[0]['id']
-        
-        # Build update payload - only include non-null values
-        # Note: We DON'T update 'Update' field here - it's a lookup from Updates table
-        update_fields = {}
-        
-        field_mapping = {
-            'Stage': 'Stage',
-            'Status': 'Status',
-            'Live Date': 'Live Date',
-            'With Client?': 'With Client?'
-        }
-        
-        for key, airtable_field in field_mapping.items():
-            if key in updates and updates[key] is not None:
-                update_fields[airtable_field] = updates[key]
-        
-        if not update_fields:
-            print("No project fields to update")
-            return True
-        
-        # Update the record
-        update_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_JOBS_TABLE}/{record_id}"
-        update_data = {'fields': update_fields}
-        
-        response = httpx.patch(update_url, headers=headers, json=update_data, timeout=10.0)
-        response.raise_for_status()
-        
-        print(f"Updated project {job_number}: {update_fields}")
-        return True
-        
-    except Exception as e:
-        print(f"Error updating project in Airtable: {e}")
-        return False
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for n, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][n] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
 
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
 
-def create_job_in_airtable(job_number, job_name, client_code, description, project_owner, client_record_id):
-    """Create a new job record in the Jobs table.
-    Used by TRIAGE for new jobs."""
-    if not AIRTABLE_API_KEY:
-        print("No Airtable API key configured")
-        return None
-    
+    def render(self, extra=()):
+        """Prometheus text exposition. extra are (name, labels, value) samples
+        read from elsewhere (e.g. cache stats) at scrape time."""
+        with self._lock:
+            counters = list(self.counters.items())
+            histograms = [(key, dict(h, buckets=list(h['buckets']))) for key, h in self.histograms.items()]
+        counters += [((name, tuple(sorted(labels.items()))), value) for name, labels, value in extra]
+
+        samples = defaultdict(list)
+        for (name, labels), value in counters:
+            samples[name].append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), histogram in histograms:
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                samples[name].append(f"{name}_bucket{self._labels(labels + (('le', f'{bound:g}'),))} {count}")
+            samples[name].append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            samples[name].append(f"{name}_sum{self._labels(labels)} {histogram['sum']:.6f}")
+            samples[name].append(f"{name}_count{self._labels(labels)} {histogram['count']}")
+
+        lines = []
+        for name in sorted(samples):
+            kind, text = self.descriptions.get(name, ('untyped', name))
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + samples[name]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+metrics.describe('dot_request_seconds', 'histogram', 'Request latency by endpoint and status')
+metrics.describe('dot_span_seconds', 'histogram', 'Time spent in Claude calls, Airtable helpers, parsing and validation')
+metrics.describe('dot_airtable_request_seconds', 'histogram', 'Airtable HTTP request latency, retries included')
+metrics.describe('dot_airtable_retries_total', 'counter', 'Airtable requests retried, by reason')
+metrics.describe('dot_claude_tokens_total', 'counter', 'Claude tokens by endpoint and kind (cache reads/writes included)')
+metrics.describe('dot_errors_total', 'counter', 'Errors by where they were caught and exception type')
+metrics.describe('dot_project_cache_lookups_total', 'counter', 'Project cache lookups by result')
+metrics.describe('dot_extraction_cache_lookups_total', 'counter', 'Feedback attachment extraction cache lookups by result')
+metrics.describe('dot_output_repairs_total', 'counter', 'Claude replies sent back for one repair turn, by result')
+metrics.describe('dot_response_cache_lookups_total', 'counter', 'Response cache lookups by endpoint and result (hit, near, miss)')
+metrics.describe('dot_response_cache_saved_seconds_total', 'counter', 'Claude time saved by reusing cached responses')
+metrics.describe('dot_idempotent_replays_total', 'counter', 'Retried deliveries answered from the idempotency store')
+metrics.describe('dot_write_journal_entries', 'gauge', 'Airtable writes in the journal by state')
+metrics.describe('dot_write_journal_oldest_pending_seconds', 'gauge', 'Age of the oldest unsent Airtable write')
+metrics.describe('dot_write_journal_flushed_total', 'counter', 'Journalled Airtable writes sent by this worker')
+metrics.describe('dot_write_journal_retries_total', 'counter', 'Journalled Airtable writes that failed and were requeued')
+metrics.describe('dot_jobs', 'gauge', 'Async jobs in the queue by state (all processes)')
+metrics.describe('dot_job_oldest_queued_seconds', 'gauge', 'Age of the oldest job waiting for a worker')
+metrics.describe('dot_job_callbacks', 'gauge', 'Job result callbacks by state')
+metrics.describe('dot_job_worker_threads', 'gauge', 'Job worker threads heartbeating across all processes')
+metrics.describe('dot_circuit_state', 'gauge', 'Upstream circuit breaker state (0 closed, 1 half-open, 2 open)')
+metrics.describe('dot_circuit_opens_total', 'counter', 'Times the upstream circuit breaker opened')
+metrics.describe('dot_circuit_rejected_total', 'counter', 'Calls failed fast while the circuit was open')
+metrics.describe('dot_rate_limit_wait_seconds', 'histogram', 'Time calls queued for an upstream rate limit slot')
+
+# Spans recorded during the current request, when it asked for a breakdown
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+@contextmanager
+def span(name, **labels):
+    """Time a block into dot_span_seconds and the request's breakdown, if any."""
+    started = time.perf_counter()
     try:
-        headers = {
-            'Authorization': f'Bearer {AIRTABLE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Build the job record
-        job_data = {
-            'fields': {
-                'Job Number': job_number,
-                'Project Name': job_name,
-                'Description': description,
-                'Status': 'In Progress',
-                'Stage': 'Triage',
-                'Project Owner': project_owner,
-                'Start Date': date.today().isoformat()
-            }
-        }
-        
-        # Add client link if we have the record ID
-        if client_record_id:
-            job_data['fields']['Client Link'] = [client_record_id]
-        
-        # Create the record
-        create_url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_JOBS_TABLE}"
-        response = httpx.post(create_url, headers=headers, json=create_data, timeout=10.0)
-        response.raise_for_status()
-        
-        new_record = response.json()
-        print(f"Created job record: {new_record.get('id')}")
-        return new_record.get('id')
-        
-    except Exception as e:
-        print(f"Error creating job in Airtable: {e}")
-        return None
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('dot_span_seconds', elapsed, span=name, **labels)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.append({'span': name, **labels, 'ms': round(elapsed * 1000, 1)})
+
+
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_request_context(fn):
+    """Wrap fn so pool threads see the submitting request's trace and recording."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def record_error(where, e):
+    metrics.inc('dot_errors_total', where=where, type=type(e).__name__)
 
 
 # ===================
-# TRAFFIC ENDPOINT
+# UPSTREAM GUARDS
 # ===================
-@app.route('/traffic', methods=['POST'])
-def traffic():
-    """Route incoming emails to the correct handler.
-    
-    Accepts additional fields and validates job numbers against Airtable.
-    """
-    try:
-        data = request.get_json()
-        
-        # Required field
-        email_content = data.get('emailContent', '')
-        if not email_content:
-            return jsonify({'error': 'No email content provided'}), 400
-        
-        # Original fields
-        subject_line = data.get('subjectLine', '')
-        
-        # Additional fields for smarter routing
-        sender_email = data.get('senderEmail', '')
-        sender_name = data.get('senderName', '')
-        all_recipients = data.get('allRecipients', [])
-        has_attachments = data.get('hasAttachments', False)
-        attachment_names = data.get('attachmentNames', [])
-        
-        # Build content for Claude
-        full_content = f"""Subject: {subject_line}
+# A shared rate limiter queues calls to stay under an upstream's limit
+# instead of tripping it, and a circuit breaker per upstream fails fast
+# while it is down rather than tying up a thread per request on timeouts.
 
-From: {sender_name} <{sender_email}>
-Recipients: {', '.join(all_recipients) if isinstance(all_recipients, list) else all_recipients}
-Has Attachments: {has_attachments}
-Attachment Names: {', '.join(attachment_names) if isinstance(attachment_names, list) else attachment_names}
+class UpstreamUnavailable(Exception):
+    """Airtable or Anthropic can't be reached right now - distinct from a
+    successful answer like 'job not found'."""
 
-Email Body:
-{email_content}"""
-        
-        # Call Claude to determine routing
-        response = client.messages.create(
-            model='claude-sonnet-4-20250514',
-            max_tokens=1000,
-            temperature=0.1,
-            system=TRAFFIC_PROMPT,
-            messages=[
-                {'role': 'user', 'content': f'Email to route:\n\n{full_content}'}
-            ]
-        )
-        
-        # Parse Claude's JSON response
-        content = response.content[0].text
-        content = strip_markdown_json(content)
-        routing = json.loads(content)
-        
-        # If job number found, validate against Airtable and enrich
-        if routing.get('jobNumber'):
-            project = get_project_from_airtable(routing['jobNumber'])
-            
-            if project:
-                # Enrich routing with project data
-                routing['jobName'] = project['jobName']
-                routing['clientName'] = project['clientName']
-                routing['currentRound'] = project['round']
-                routing['currentStage'] = project['stage']
-                routing['withClient'] = project['withClient']
-                routing['teamsChannelId'] = project['teamsChannelId']
-                routing['projectRecordId'] = project['recordId']
-            else:
-                # Job number not found - reroute to clarify
-                routing['route'] = 'clarify'
-                routing['reason'] = f"Job {routing['jobNumber']} not found in system"
-                routing['clarifyEmail'] = f"""<p>Hi {routing.get('senderName', 'there')},</p>
-<p>I couldn't find job {routing['jobNumber']} in our system.</p>
-<p>Could you double-check the job number? Or if this is a new job, just reply "Triage" and I'll set it up.</p>
-<p>Thanks,<br>Dot</p>"""
+    def __init__(self, upstream, reason, retry_after=None):
+        super().__init__(f"{upstream} unavailable: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token bucket shared by every worker process, kept in SQLite
+    (RATE_LIMIT_DB_PATH).
+
+    Uses the GCRA form of a token bucket: one stored timestamp per limiter
+    (the theoretical arrival time) reserves each caller a slot, and callers
+    sleep until it comes round. Bursts of up to `burst` go straight through."""
+
+    def __init__(self, name, rate, burst, max_wait):
+        self.name = name
+        self.interval = 1.0 / rate if rate else 0.0
+        self.burst = burst
+        self.max_wait = max_wait
+        self.waits = 0
+        self._ready = False
+
+    def acquire(self):
+        """Block until a slot is free. Raises UpstreamUnavailable rather than
+        queue for longer than max_wait."""
+        if not self.interval:
+            return
+        conn = open_db(RATE_LIMIT_DB_PATH)
+        try:
+            if not self._ready:
+                conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, tat REAL NOT NULL)")
+                self._ready = True
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT tat FROM rate_limits WHERE name = ?", (self.name,)).fetchone()
+                tat = max(row['tat'] if row else now, now)
+                wait = max(0.0, tat - (self.burst - 1) * self.interval - now)
+                if wait > self.max_wait:
+                    conn.execute('ROLLBACK')
+                    raise UpstreamUnavailable(self.name, 'rate limit queue is full', retry_after=wait)
+                conn.execute("INSERT OR REPLACE INTO rate_limits (name, tat) VALUES (?, ?)",
+                             (self.name, tat + self.interval))
+                conn.execute('COMMIT')
+            except UpstreamUnavailable:
+                raise
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        if wait > 0:
+            self.waits += 1
+            metrics.observe('dot_rate_limit_wait_seconds', wait, upstream=self.name)
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive upstream failures and fails fast
+    until `reset_timeout` has passed. Then one trial call is let through
+    (half-open): success closes the breaker, failure re-opens it."""
+
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _before(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            retry_after = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == 'open' and retry_after <= 0:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return
+            self.rejected += 1
+        raise UpstreamUnavailable(self.name, 'circuit open', retry_after=max(retry_after, 1.0))
+
+    def _record(self, failed):
+        with self._lock:
+            self._trial = False
+            if not failed:
+                self.state = 'closed'
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    print(f"Circuit for {self.name} opened after {self.failures} failures")
+                    self.opens += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self, is_failure):
+        """Run a call through the breaker. is_failure(exc) decides whether an
+        exception means the upstream is unhealthy (vs e.g. a 404)."""
+        self._before()
+        try:
+            yield
+        except UpstreamUnavailable:
+            # Our own rate limiter (or a nested breaker) gave up before the
+            # upstream answered - that says nothing about its health either way
+            with self._lock:
+                self._trial = False
+            raise
+        except Exception as e:
+            self._record(is_failure(e))
+            raise
+        self._record(False)
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'consecutiveFailures': self.failures,
+                    'opens': self.opens, 'rejected': self.rejected}
+
+
+def airtable_failure(e):
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+def anthropic_failure(e):
+    if isinstance(e, APIStatusError):
+        return e.status_code >= 500
+    return isinstance(e, APIConnectionError)
+
+
+upstream_breakers = {
+    'airtable': CircuitBreaker('airtable', BREAKER_THRESHOLD, BREAKER_RESET_TIMEOUT),
+    'anthropic': CircuitBreaker('anthropic', BREAKER_THRESHOLD, BREAKER_RESET_TIMEOUT)
+}
+upstream_limiters = {
+    'airtable': RateLimiter('airtable', AIRTABLE_RATE_LIMIT, AIRTABLE_RATE_BURST, RATE_LIMIT_MAX_WAIT),
+    'anthropic': RateLimiter('anthropic', ANTHROPIC_RATE_LIMIT, ANTHROPIC_RATE_BURST, RATE_LIMIT_MAX_WAIT)
+}
+
+
+def upstream_stats():
+    return {name: {**breaker.stats(), 'rateLimitWaits': upstream_limiters[name].waits}
+            for name, breaker in upstream_breakers.items()}
+
+
+def upstream_unavailable(e):
+    """503 for a request that can't be served while an upstream is down.
+    Power Automate retries it after Retry-After."""
+    retry_after = int(e.retry_after or BREAKER_RESET_TIMEOUT) + 1
+    response = jsonify({
+        'error': 'upstream_unavailable',
+        'upstream': e.upstream,
+        'message': str(e),
+        'retryAfter': retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# ===================
+# RECORDING
+# ===================
+# Email addresses, phone numbers and the sender's name are pseudonymised with
+# a salted hash, so the same person maps to the same token across a recording
+# and the domains the fast path routes on survive. Other names in free text
+# (e.g. signatures) are not detected.
+
+class Redactor:
+    """Pseudonymises one request's payload and everything recorded with it."""
+
+    EMAIL_PATTERN = re.compile(r'([A-Za-z0-9._%+\-]+)@([A-Za-z0-9\-]+(?:\.[A-Za-z0-9\-]+)*\.[A-Za-z]{2,})')
+    PHONE_PATTERN = re.compile(r'(?<![\w+])(?:\+64|0)[ \-]?[2-9][\d \-]{6,12}\d(?!\w)')
+
+    def __init__(self, names=(), salt=''):
+        self.salt = salt
+        # Full names first, then each part on its own (signatures use first names)
+        self.names = []
+        for name in names:
+            if isinstance(name, str) and len(name.strip()) >= 3:
+                self.names.append(name.strip())
+                self.names += [part for part in name.split() if len(part) >= 3 and part[0].isupper()]
+
+    def pseudonym(self, value):
+        return 'anon-' + hashlib.sha256(f"{self.salt}{value.lower()}".encode('utf-8')).hexdigest()[:8]
+
+    def _email(self, match):
+        if match.group(1).startswith('anon-'):
+            return match.group(0)
+        return f"{self.pseudonym(match.group(0))}@{match.group(2)}"
+
+    def text(self, value):
+        for name in self.names:
+            value = re.sub(rf'\b{re.escape(name)}\b', self.pseudonym(name), value)
+        value = self.EMAIL_PATTERN.sub(self._email, value)
+        return self.PHONE_PATTERN.sub('[phone]', value)
+
+    def __call__(self, value):
+        if isinstance(value, str):
+            return self.text(value)
+        if isinstance(value, list):
+            return [self(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self(item) for key, item in value.items()}
+        return value
+
+
+# Upstream exchanges made while handling the current request, when recording
+current_recording = contextvars.ContextVar('current_recording', default=None)
+recording_lock = threading.Lock()
+
+
+def prompt_key(messages):
+    """Stable key for a Claude prompt - replay.py matches requests on it."""
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def record_exchange(kind, request_info, response_body, started):
+    exchanges = current_recording.get()
+    if exchanges is not None:
+        # Copied now - callers may reuse the dicts (e.g. paging params)
+        exchanges.append({'kind': kind, 'request': json.loads(json.dumps(request_info)), 'response': response_body,
+                          'ms': round((time.perf_counter() - started) * 1000, 1)})
+
+
+def record_claude_call(endpoint, params, response, started):
+    """record_usage plus, when recording, the reply keyed by its prompt."""
+    usage = record_usage(endpoint, response)
+    if current_recording.get() is not None:
+        record_exchange('claude', {'endpoint': endpoint, 'model': params['model'], 'messages': params['messages']},
+                        {'text': response.content[0].text, 'usage': usage}, started)
+
+
+def write_recording(payload, exchanges, status, body, elapsed):
+    """Append one redacted request to RECORDING_PATH. Prompts are stored as
+    the key of their redacted form, which is what replay will send."""
+    redact = Redactor([payload.get('senderName')] if isinstance(payload, dict) else [], RECORDING_SALT)
+    for exchange in exchanges:
+        if exchange['kind'] == 'claude':
+            messages = exchange['request'].pop('messages')
+            exchange['request']['promptKey'] = prompt_key(redact(messages))
+    line = json.dumps({
+        't': time.time(),
+        'endpoint': request.url_rule.rule,
+        'method': request.method,
+        'idempotencyKey': request.headers.get('Idempotency-Key'),
+        'payload': redact(payload),
+        'status': status,
+        'response': redact(body),
+        'ms': round(elapsed * 1000, 1),
+        'exchanges': redact(exchanges)
+    })
+    with recording_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(RECORDING_PATH)), exist_ok=True)
+        with open(RECORDING_PATH, 'a') as f:
+            f.write(line + '\n')
+
+
+# ===================
+# CLAUDE HELPERS
+# ===================
+
+# Anthropic only caches a prompt prefix of at least this many tokens - below
+# it cache_control is silently ignored and the prompt is billed in full. By
+# estimate_tokens the prompts are traffic ~1.4k, triage ~900, update ~2.8k and
+# feedback ~1.6k, so triage is never cached and traffic only caches on the
+# Sonnet fallback (Haiku, which answers first, needs 2048). Read counts for
+# those calls can't be checked here; watch cache_read_input_tokens in the
+# usage log before counting any savings.
+PROMPT_CACHE_MIN_TOKENS = {HAIKU_MODEL: 2048, SONNET_MODEL: 1024}
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) - good enough for budgeting."""
+    return (len(text) + 3) // 4
+
+
+def cacheable_system(prompt, endpoint):
+    """Wrap a static system prompt as a content block, marked for caching when
+    it is long enough for at least one of the endpoint's models to cache."""
+    block = {'type': 'text', 'text': prompt}
+    tokens = estimate_tokens(prompt)
+    models = MODEL_POLICY[endpoint]
+    if any(tokens >= PROMPT_CACHE_MIN_TOKENS.get(model, 1024) for model in models):
+        block['cache_control'] = {'type': 'ephemeral'}
+    else:
+        print(f"Prompt caching off for {endpoint}: ~{tokens} tokens is under the minimum for {', '.join(models)}")
+    return [block]
+
+
+# System blocks are built once - the prompts never change while running
+TRAFFIC_SYSTEM = cacheable_system(TRAFFIC_PROMPT, 'traffic')
+TRIAGE_SYSTEM = cacheable_system(TRIAGE_PROMPT, 'triage')
+UPDATE_SYSTEM = cacheable_system(UPDATE_PROMPT, 'update')
+FEEDBACK_SYSTEM = cacheable_system(FEEDBACK_PROMPT, 'feedback')
+
+USAGE_FIELDS = ['input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens']
+
+# Running token totals per endpoint, reported on /health
+claude_usage = {}
+claude_usage_lock = threading.Lock()
+
+
+def record_usage(endpoint, response):
+    """Log token usage (including prompt cache reads/writes) for one Claude call."""
+    usage = {field: getattr(response.usage, field, None) or 0 for field in USAGE_FIELDS}
+    print(f"Claude usage [{endpoint}]: input={usage['input_tokens']} output={usage['output_tokens']} "
+          f"cache_read={usage['cache_read_input_tokens']} cache_write={usage['cache_creation_input_tokens']}")
+    with claude_usage_lock:
+        totals = claude_usage.setdefault(endpoint, dict.fromkeys(['calls'] + USAGE_FIELDS, 0))
+        totals['calls'] += 1
+        for field in USAGE_FIELDS:
+            totals[field] += usage[field]
+    for field in USAGE_FIELDS:
+        metrics.inc('dot_claude_tokens_total', usage[field], endpoint=endpoint, kind=field.replace('_tokens', ''))
+    return usage
+
+
+class JSONFieldScanner:
+    """Pulls top-level scalar fields out of a JSON object while it streams in.
+
+    Feed it text chunks as they arrive; `fields` fills up as soon as each
+    top-level string/number/bool/null value is complete. Anything before the
+    first '{' (e.g. a ```json fence) and nested values are skipped."""
+
+    def __init__(self):
+        self.fields = {}
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.buffer = []
+        self.literal = []
+        self.key = None
+        self.expect = 'key'
+
+    def feed(self, text):
+        for ch in text:
+            if self.in_string:
+                self.buffer.append(ch)
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    self._end_string(''.join(self.buffer))
+                continue
+            if ch == '"':
+                self.in_string = True
+                self.buffer = [ch]
+            elif ch in '{[':
+                self.depth += 1
+            elif ch in '}]':
+                if self.depth == 1:
+                    self._end_literal()
+                self.depth -= 1
+            elif self.depth != 1:
+                continue
+            elif ch == ':':
+                self.expect = 'value'
+                self.literal = []
+            elif ch == ',':
+                self._end_literal()
+                self.expect = 'key'
+            elif self.expect == 'value' and not ch.isspace():
+                self.literal.append(ch)
+
+    def _end_string(self, raw):
+        if self.depth != 1:
+            return
+        value = json.loads(raw)
+        if self.expect == 'key':
+            self.key = value
+        elif self.key is not None:
+            self.fields[self.key] = value
+            self.key = None
+
+    def _end_literal(self):
+        if self.key is not None and self.literal:
+            try:
+                self.fields[self.key] = json.loads(''.join(self.literal))
+            except ValueError:
+                pass
+        self.key = None
+        self.literal = []
+
+
+# Calls, escalations and latency per endpoint and model tier, reported on /health
+model_stats = {}
+
+
+def record_model_call(endpoint, model, elapsed_ms, escalated):
+    with claude_usage_lock:
+        stats = model_stats.setdefault(endpoint, {}).setdefault(
+            model, {'calls': 0, 'escalations': 0, 'totalMs': 0.0, 'maxMs': 0.0})
+        stats['calls'] += 1
+        stats['escalations'] += int(escalated)
+        stats['totalMs'] += elapsed_ms
+        stats['maxMs'] = max(stats['maxMs'], elapsed_ms)
+
+
+def model_stats_report():
+    with claude_usage_lock:
+        return {
+            endpoint: {
+                model: {
+                    'calls': stats['calls'],
+                    'escalationRate': round(stats['escalations'] / stats['calls'], 3),
+                    'avgMs': round(stats['totalMs'] / stats['calls'], 1),
+                    'maxMs': round(stats['maxMs'], 1)
+                }
+                for model, stats in models.items()
+            }
+            for endpoint, models in model_stats.items()
+        }
+
+
+def run_model_policy(endpoint, call, check):
+    """Try each model in the endpoint's policy until one's output passes.
+
+    call(model) -> (content, extra) makes one Claude call; check(content)
+    returns a list of reasons to escalate (empty = accept). The last model's
+    output is always accepted. Returns (content, extra, model, escalations).
+    Each call goes through the Anthropic rate limiter and circuit breaker."""
+    models = MODEL_POLICY[endpoint]
+    escalations = []
+    for n, model in enumerate(models):
+        upstream_limiters['anthropic'].acquire()
+        started = time.perf_counter()
+        with span('claude', endpoint=endpoint, model=model), upstream_breakers['anthropic'].guard(anthropic_failure):
+            content, extra = call(model)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        reasons = check(content) if n < len(models) - 1 else []
+        record_model_call(endpoint, model, elapsed_ms, bool(reasons))
+        if not reasons:
+            return content, extra, model, escalations
+        print(f"Escalating {endpoint} from {model}: {', '.join(reasons)}")
+        escalations.append({'model': model, 'reasons': reasons, 'ms': round(elapsed_ms, 1)})
+
+
+def claude_usage_stats():
+    with claude_usage_lock:
+        return {endpoint: dict(totals) for endpoint, totals in claude_usage.items()}
+
+
+# ===================
+# STRUCTURED OUTPUT
+# ===================
+# Claude's JSON is checked against a schema per endpoint, compiled once at
+# import into plain checks. A reply that fails escalates to the next model
+# tier like any other bad answer; if the last tier's still fails, Claude gets
+# one repair turn quoting what was wrong before the request errors.
+
+TRAFFIC_ROUTES = ['wip', 'triage', 'clarify', 'work-to-client', 'update']
+REPAIR_MAX_ERRORS = 10
+REPAIR_PROMPT = """Your reply couldn't be used:
+{errors}
+
+Reply with the corrected JSON object only - the same fields, no other text."""
+
+
+class OptionalField:
+    """Schema marker for an object field that may be missing or null."""
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+def optional(spec):
+    return OptionalField(spec)
+
+
+# Error replies the triage and update prompts allow instead of an analysis
+ERROR_OUTPUT = {'error': str, 'message': optional(str)}
+
+# Only what the code reads is checked - extra fields pass through. A spec is
+# a type, a set of allowed strings, [spec] for an array, {field: spec} for an
+# object, or a tuple of alternatives.
+OUTPUT_SCHEMA_SPECS = {
+    'traffic': {
+        'route': set(TRAFFIC_ROUTES),
+        'jobNumber': optional(str),
+        'clientCode': optional(str),
+        'senderEmail': optional(str),
+        'senderName': optional(str),
+        'confidence': optional({'high', 'medium', 'low'}),
+        'reason': optional(str),
+        'clarifyEmail': optional(str),
+        'externalRecipient': optional(str),
+        'attachmentNames': optional([str]),
+        'searchHints': optional(dict)
+    },
+    'triage': (ERROR_OUTPUT, {
+        'clientCode': str,
+        'clientName': optional(str),
+        'projectOwner': optional(str),
+        'jobName': str,
+        'jobSummary': optional(str),
+        'questions': optional([str]),
+        'emailBody': optional(str)
+    }),
+    'update': (ERROR_OUTPUT, {
+        'airtableUpdate': str,
+        'teamsPost': optional(str),
+        'updateTypes': optional([str]),
+        'projectUpdates': optional({
+            'Update': optional(str),
+            'Stage': optional(str),
+            'Status': optional(str),
+            'Live Date': optional(str),
+            'Update due': optional(str),
+            'With Client?': optional((bool, str))
+        })
+    })
+}
+
+
+def json_type(value):
+    if value is None:
+        return 'null'
+    return {dict: 'object', list: 'array', str: 'string', bool: 'boolean'}.get(type(value), 'number')
+
+
+def compile_schema(spec):
+    """Turn a schema spec into check(value, path) -> list of errors."""
+    if isinstance(spec, OptionalField):
+        inner = compile_schema(spec.spec)
+        return lambda value, path: [] if value is None else inner(value, path)
+    
+    if isinstance(spec, type):
+        expected = json_type(spec())
+        return lambda value, path: [] if isinstance(value, spec) else [
+            f"{path or 'reply'}: expected {expected}, got {json_type(value)}"]
+    
+    if isinstance(spec, set):
+        allowed = ', '.join(sorted(spec))
+        return lambda value, path: [] if isinstance(value, str) and value in spec else [
+            f"{path or 'reply'}: {value!r} is not one of {allowed}"]
+    
+    if isinstance(spec, list):
+        check_item = compile_schema(spec[0])
+        
+        def check_array(value, path):
+            if not isinstance(value, list):
+                return [f"{path or 'reply'}: expected array, got {json_type(value)}"]
+            return [error for n, item in enumerate(value) for error in check_item(item, f"{path}[{n}]")]
+        return check_array
+    
+    if isinstance(spec, dict):
+        fields = [(key, compile_schema(field), isinstance(field, OptionalField)) for key, field in spec.items()]
+        
+        def check_object(value, path):
+            if not isinstance(value, dict):
+                return [f"{path or 'reply'}: expected object, got {json_type(value)}"]
+            errors = []
+            for key, check, is_optional in fields:
+                field_path = f"{path}.{key}" if path else key
+                if key in value:
+                    errors.extend(check(value[key], field_path))
+                elif not is_optional:
+                    errors.append(f"{field_path}: missing")
+            return errors
+        return check_object
+    
+    if isinstance(spec, tuple):
+        alternatives = [compile_schema(option) for option in spec]
+        
+        def check_any(value, path):
+            # Errors are reported against the last (main) alternative
+            for check in alternatives:
+                errors = check(value, path)
+                if not errors:
+                    return []
+            return errors
+        return check_any
+    
+    raise TypeError(f"Unsupported schema spec {spec!r}")
+
+
+OUTPUT_SCHEMAS = {endpoint: compile_schema(spec) for endpoint, spec in OUTPUT_SCHEMA_SPECS.items()}
+
+
+class InvalidOutput(ValueError):
+    """Claude's reply failed its schema, repair turn included."""
+
+    def __init__(self, endpoint, errors, raw):
+        super().__init__(f"{endpoint} reply invalid: {'; '.join(errors[:REPAIR_MAX_ERRORS])}")
+        self.endpoint = endpoint
+        self.errors = errors
+        self.raw = raw
+
+
+def parse_output(endpoint, text):
+    """Extract and validate one reply. Returns {'value', 'errors', 'raw'};
+    errors is empty when the value can be used as-is."""
+    with span('parse', endpoint=endpoint):
+        try:
+            value = extract_json(text)
+        except json.JSONDecodeError as e:
+            return {'value': None, 'errors': [f"no JSON object ({e.msg})"], 'raw': text}
+    with span('validate', endpoint=endpoint):
+        errors = OUTPUT_SCHEMAS[endpoint](value, '')
+    return {'value': value, 'errors': errors, 'raw': text}
+
+
+def repair_output(endpoint, params, send, output):
+    """One repair turn: Claude sees its reply and what was wrong with it.
+    Returns the repaired output or raises InvalidOutput."""
+    errors = output['errors'][:REPAIR_MAX_ERRORS]
+    print(f"Repairing {endpoint} reply from {params['model']}: {'; '.join(errors)}")
+    repair_params = {**params, 'messages': [
+        *params['messages'],
+        {'role': 'assistant', 'content': output['raw'].strip() or '(empty)'},
+        {'role': 'user', 'content': REPAIR_PROMPT.format(errors='\n'.join(f"- {error}" for error in errors))}
+    ]}
+    upstream_limiters['anthropic'].acquire()
+    with span('repair', endpoint=endpoint, model=params['model']), upstream_breakers['anthropic'].guard(anthropic_failure):
+        text, _ = send(repair_params)
+    repaired = parse_output(endpoint, text)
+    metrics.inc('dot_output_repairs_total', endpoint=endpoint, result='failed' if repaired['errors'] else 'fixed')
+    if repaired['errors']:
+        raise InvalidOutput(endpoint, repaired['errors'], text)
+    return repaired
+
+
+def ask_claude_structured(endpoint, params, send, check=None):
+    """Run params through MODEL_POLICY[endpoint] and return the parsed reply.
+
+    send(params) -> (reply text, extra) makes one Claude call. A tier whose
+    reply fails the endpoint's schema, or check(value) when given, escalates;
+    the last tier's reply gets one repair turn if it fails the schema.
+    Returns (value, extra, model, escalations)."""
+    def attempt(model):
+        text, extra = send({**params, 'model': model})
+        return parse_output(endpoint, text), extra
+    
+    def reasons(output):
+        if output['errors']:
+            return output['errors'][:REPAIR_MAX_ERRORS]
+        return check(output['value']) if check else []
+    
+    output, extra, model, escalations = run_model_policy(endpoint, attempt, reasons)
+    if output['errors']:
+        output = repair_output(endpoint, {**params, 'model': model}, send, output)
+    return output['value'], extra, model, escalations
+
+
+# ===================
+# AIRTABLE CLIENT
+# ===================
+
+class AirtableClient:
+    """Shared Airtable client - one pooled connection for every helper.
+
+    Keeps connections alive between calls (HTTP/2 when h2 is installed),
+    builds the auth headers once, and retries rate limits and transient
+    failures with exponential backoff."""
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key, base_id, api_url, timeout=10.0, max_retries=3, backoff=0.5):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.http = httpx.Client(
+            base_url=f"{api_url.rstrip('/')}/{base_id}/",
+            headers={
+                'Authorization': f'Bearer {api_key}',
+                'Content-Type': 'application/json'
+            },
+            timeout=timeout,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60.0)
+        )
+
+    def _retry_delay(self, attempt, response=None):
+        """Backoff before the next attempt, honouring Retry-After on 429s."""
+        if response is not None and response.headers.get('Retry-After'):
+            try:
+                return min(float(response.headers['Retry-After']), 30.0)
+            except ValueError:
+                pass
+        return self.backoff * (2 ** attempt)
+
+    def request(self, method, path, **kwargs):
+        """Send a request and return the decoded JSON body.
+
+        GET/PATCH are retried on any transient failure. POST is only retried
+        when Airtable definitely didn't process it (429 or connect errors),
+        so a retry never creates a duplicate record.
+
+        Every attempt takes a slot from the shared rate limiter, and the call
+        as a whole goes through the Airtable circuit breaker - raising
+        UpstreamUnavailable straight away while Airtable is down."""
+        idempotent = method in ('GET', 'PATCH')
+        table = path.split('/', 1)[0]
+        started = time.perf_counter()
+        try:
+            with upstream_breakers['airtable'].guard(airtable_failure):
+                body = self._send(method, path, idempotent, table, **kwargs)
+            record_exchange('airtable', {'method': method, 'path': path, **kwargs}, body, started)
+            return body
+        finally:
+            metrics.observe('dot_airtable_request_seconds', time.perf_counter() - started, method=method, table=table)
+
+    def _send(self, method, path, idempotent, table, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            upstream_limiters['airtable'].acquire()
+            try:
+                response = self.http.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                retryable = idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if last_attempt or not retryable:
+                    raise
+                print(f"Airtable {method} {path} failed ({e}), retrying")
+                metrics.inc('dot_airtable_retries_total', method=method, table=table, reason=type(e).__name__)
+                time.sleep(self._retry_delay(attempt))
+                continue
+
+            retryable = response.status_code == 429 or (idempotent and response.status_code in self.RETRY_STATUSES)
+            if last_attempt or not retryable:
+                response.raise_for_status()
+                return response.json()
+
+            print(f"Airtable {method} {path} returned {response.status_code}, retrying")
+            metrics.inc('dot_airtable_retries_total', method=method, table=table, reason=str(response.status_code))
+            time.sleep(self._retry_delay(attempt, response))
+
+    def list_records(self, table, formula=None, **params):
+        """Return the records from one page of a table, optionally filtered."""
+        if formula:
+            params['filterByFormula'] = formula
+        return self.request('GET', table, params=params).get('records', [])
+
+    def list_all_records(self, table, formula=None, **params):
+        """Return every matching record, following Airtable's offset paging."""
+        if formula:
+            params['filterByFormula'] = formula
+        params.setdefault('pageSize', 100)
+        records = []
+        while True:
+            page = self.request('GET', table, params=params)
+            records.extend(page.get('records', []))
+            if not page.get('offset'):
+                return records
+            params['offset'] = page['offset']
+
+    def create_record(self, table, fields):
+        """Create one record and return it."""
+        return self.request('POST', table, json={'fields': fields})
+
+    def get_record(self, table, record_id):
+        """Fetch one record by id."""
+        return self.request('GET', f"{table}/{record_id}")
+
+    def update_record(self, table, record_id, fields):
+        """PATCH fields on one record and return it."""
+        return self.request('PATCH', f"{table}/{record_id}", json={'fields': fields})
+
+    def create_records(self, table, fields_list):
+        """Create up to AIRTABLE_BATCH_SIZE records in one request, returned in order."""
+        payload = {'records': [{'fields': fields} for fields in fields_list]}
+        return self.request('POST', table, json=payload).get('records', [])
+
+    def update_records(self, table, updates):
+        """PATCH up to AIRTABLE_BATCH_SIZE (record_id, fields) pairs in one request."""
+        payload = {'records': [{'id': record_id, 'fields': fields} for record_id, fields in updates]}
+        return self.request('PATCH', table, json=payload).get('records', [])
+
+
+airtable = AirtableClient(AIRTABLE_API_KEY, AIRTABLE_BASE_ID, AIRTABLE_API_URL)
+
+
+# ===================
+# PROJECT CACHE
+# ===================
+
+class TTLCache:
+    """Thread-safe LRU cache where entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, load):
+        """Cached value, or load() it. Callers that miss while a load for the
+        same key is in flight wait for its result instead of loading again.
+        load is responsible for set()ting what should be cached."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            future = self._loading.get(key)
+            leader = future is None
+            if leader:
+                future = self._loading[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            value = load()
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def get(self, key, count=True):
+        """Return the cached value, or None if missing or expired.
+        Internal peeks pass count=False so they don't skew the hit rate."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                if count:
+                    self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+class ProjectCache(TTLCache):
+    """TTLCache of project records that honours writes from every process.
+
+    Each web worker and worker.py has its own copy, so invalidating locally
+    isn't enough. The write journal stamps project_writes in dot.db whenever
+    it queues or sends a Projects PATCH, and a hit is only served if its
+    record hasn't been written since it was fetched."""
+
+    def get(self, key, count=True):
+        entry = super().get(key, count=False)
+        fresh = entry is not None and not self._written_since(entry[1]['recordId'], entry[0])
+        if entry is not None and not fresh:
+            self.invalidate(key)
+        if count:
+            with self._lock:
+                self.hits += fresh
+                self.misses += not fresh
+        return entry[1] if fresh else None
+
+    def peek(self, key):
+        """The cached value even if a write has been stamped since - for the
+        writer mirroring its own change in."""
+        entry = super().get(key, count=False)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, value, fetched_at=None):
+        """fetched_at is when the Airtable read started - a write stamped
+        after it means the value may already be out of date."""
+        super().set(key, (time.time() if fetched_at is None else fetched_at, value))
+
+    def _written_since(self, record_id, fetched_at):
+        conn = open_db()
+        try:
+            row = conn.execute("SELECT written_at FROM project_writes WHERE record_id = ?", (record_id,)).fetchone()
+        finally:
+            conn.close()
+        return row is not None and row['written_at'] >= fetched_at
+
+
+def record_project_writes(conn, record_ids):
+    """Stamp Projects records as written, for every process's ProjectCache."""
+    now = time.time()
+    conn.executemany("INSERT OR REPLACE INTO project_writes (record_id, written_at) VALUES (?, ?)",
+                     [(record_id, now) for record_id in record_ids])
+
+
+# Project records keyed by normalised job number. Write paths keep it in step
+# so a cached project never outlives a change we made to it - in any process.
+project_cache = ProjectCache(PROJECT_CACHE_SIZE, PROJECT_CACHE_TTL)
+
+# Airtable Project field -> key in the dict returned by get_project_from_airtable
+PROJECT_FIELD_KEYS = {
+    'Stage': 'stage',
+    'Status': 'status',
+    'With Client?': 'withClient'
+}
+
+
+def apply_project_fields_to_cache(job_number, fields):
+    """Mirror a successful Project PATCH into the cached record, if there is one.
+    Other processes refetch - and so does this one once the journal sends it."""
+    key = normalise_job_number(job_number)
+    cached = project_cache.peek(key)
+    if cached is None:
+        return
+    cached = dict(cached)
+    for airtable_field, value in fields.items():
+        if airtable_field in PROJECT_FIELD_KEYS:
+            cached[PROJECT_FIELD_KEYS[airtable_field]] = value
+    project_cache.set(key, cached)
+
+
+# ===================
+# CLIENT DIRECTORY
+# ===================
+# The Clients table barely changes, so it's loaded once at startup and
+# refreshed in the background. Triage takes each client's record id, Teams
+# ID and SharePoint folder from here, and the traffic fast path uses it to map
+# sender domains to client codes.
+
+class ClientDirectory:
+    """In-memory index of the Clients table: client code -> client, and
+    email domain -> client code."""
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.clients = {}
+        self.domains = {}
+        self.loaded_at = None
+        self.stale = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def load(self):
+        """Re-read the whole Clients table and swap the index in."""
+        clients = {}
+        domains = {}
+        for record in airtable.list_all_records(AIRTABLE_CLIENTS_TABLE):
+            fields = record['fields']
+            code = (fields.get('Client code') or '').strip().upper()
+            if not code:
+                continue
+            clients[code] = {
+                'recordId': record['id'],
+                'name': fields.get('Clients', ''),
+                'teamId': fields.get('Teams ID', None),
+                'sharepointUrl': fields.get('Sharepoint ID', None)
+            }
+            for domain in as_list(fields.get('Email domains')):
+                domains.setdefault(domain.lower().lstrip('@'), set()).add(code)
+        
+        # Domains from Airtable add to the traffic prompt's mapping rather than
+        # override it, and a domain two clients claim (one.nz for ONE and ONS)
+        # is left to the prompt's rules
+        domain_codes = dict(CLIENT_DOMAINS)
+        for domain, codes in domains.items():
+            if domain not in domain_codes and len(codes) == 1:
+                domain_codes[domain] = codes.pop()
+        
+        with self._lock:
+            self.clients = clients
+            self.domains = domain_codes
+            self.loaded_at = time.time()
+            self.stale = False
+        print(f"Client directory loaded: {len(clients)} clients, {len(domain_codes)} domains")
+
+    def get(self, client_code):
+        """The client's record id, Teams ID and SharePoint URL, or None if the
+        code isn't known (or the directory hasn't loaded yet)."""
+        with self._lock:
+            client = self.clients.get((client_code or '').upper())
+            return dict(client) if client else None
+
+    def knows(self, client_code):
+        """False only when a loaded directory has no such client code."""
+        with self._lock:
+            return self.loaded_at is None or (client_code or '').upper() in self.clients
+
+    def code_for_domain(self, domain):
+        with self._lock:
+            return (self.domains or CLIENT_DOMAINS).get(domain)
+
+    def codes_named_in(self, text):
+        """Codes of the clients whose Airtable name appears in text."""
+        text = (text or '').lower()
+        with self._lock:
+            clients = list(self.clients.items())
+        return {code for code, client in clients
+                if client['name'] and re.search(rf"\b{re.escape(client['name'].lower())}\b", text)}
+
+    def mark_stale(self):
+        """Called when a cached record id turns out to be gone."""
+        self.stale = True
+
+    def run(self):
+        while True:
+            try:
+                self.load()
+            except Exception as e:
+                print(f"Error loading client directory: {e}")
+                record_error('client_directory', e)
+            # Retry a failed or stale load sooner than the regular refresh
+            deadline = time.monotonic() + (self.refresh_interval if self.loaded_at else 30)
+            while time.monotonic() < deadline and not self.stale:
+                time.sleep(1)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='client-directory', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self.clients),
+                'domains': len(self.domains),
+                'ageSeconds': round(time.time() - self.loaded_at, 1) if self.loaded_at else None
+            }
+
+
+client_directory = ClientDirectory(CLIENT_DIRECTORY_REFRESH)
+
+
+# ===================
+# JOB NUMBER ALLOCATOR
+# ===================
+
+def open_db(path=DOT_DB_PATH):
+    """Connection to the local SQLite store. Autocommit mode - callers manage
+    their own transactions with BEGIN IMMEDIATE when they need a write lock."""
+    os.makedirs(DOT_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+class JobNumberAllocator:
+    """Hands out job numbers without duplicates under concurrent triages.
+
+    The local SQLite high-water mark is what keeps numbers unique: every
+    allocation bumps it in a short write transaction that does no I/O.
+    Numbers are reserved from Airtable's Next # in blocks of `block_size`;
+    a refill reads Next # with only this process's per-client lock held,
+    takes whichever of Airtable or the local counter is further ahead, and
+    queues the new Next # through the write journal in the same transaction
+    that reserves the block. Different clients never wait on each other's
+    Airtable calls."""
+
+    def __init__(self, block_size=1):
+        self.block_size = block_size
+        self._locks = defaultdict(threading.Lock)
+        self._locks_guard = threading.Lock()
+        conn = open_db()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS job_number_blocks (
+                client_code TEXT PRIMARY KEY,
+                next_number INTEGER NOT NULL,
+                block_end INTEGER NOT NULL,
+                record_id TEXT,
+                team_id TEXT,
+                sharepoint_url TEXT
+            )""")
+        finally:
+            conn.close()
+
+    def _lock_for(self, client_code):
+        with self._locks_guard:
+            return self._locks[client_code]
+
+    def _take(self, conn, client_code, block=None):
+        """In one short transaction, hand out the next number from the local
+        block - or from a new block starting at block['airtable_next'] when
+        it's given and the local block has run out. Returns the row used, or
+        None when the block is empty and there's no new one to reserve."""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT * FROM job_number_blocks WHERE client_code = ?', (client_code,)).fetchone()
+            if row is not None and row['next_number'] < row['block_end']:
+                row = dict(row)
+            elif block is None:
+                conn.execute('ROLLBACK')
+                return None
+            else:
+                start = block['airtable_next']
+                if row is not None and row['block_end'] > start:
+                    # Airtable is behind numbers we've already handed out - never reuse them
+                    print(f"Airtable Next # for {client_code} ({start}) is behind local counter ({row['block_end']})")
+                    start = row['block_end']
+                row = {**block, 'next_number': start, 'block_end': start + self.block_size}
+                conn.execute("""INSERT OR REPLACE INTO job_number_blocks
+                    (client_code, next_number, block_end, record_id, team_id, sharepoint_url)
+                    VALUES (:client_code, :next_number, :block_end, :record_id, :team_id, :sharepoint_url)""",
+                    {key: row[key] for key in ('client_code', 'next_number', 'block_end', 'record_id',
+                                               'team_id', 'sharepoint_url')})
+                write_journal.enqueue(AIRTABLE_CLIENTS_TABLE, 'update',
+                                      [(row['record_id'], {'Next #': row['block_end']})], conn=conn)
+            conn.execute('UPDATE job_number_blocks SET next_number = ? WHERE client_code = ?',
+                         (row['next_number'] + 1, client_code))
+            conn.execute('COMMIT')
+            return row
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+
+    def allocate(self, client_code):
+        """Return (number, client record) for the next job, or None if the
+        client code isn't in Airtable. Raises on Airtable failures."""
+        if not client_directory.knows(client_code):
+            print(f"Client code '{client_code}' not in client directory")
+            return None
+        with self._lock_for(client_code):
+            conn = open_db()
+            try:
+                row = self._take(conn, client_code)
+                if row is None:
+                    # Block used up - read Airtable outside any transaction, then
+                    # reserve. Another worker may have refilled in the meantime,
+                    # in which case _take uses its block and the read goes unused.
+                    block = self._airtable_block(client_code)
+                    if block is None:
+                        return None
+                    row = self._take(conn, client_code, block)
+            finally:
+                conn.close()
+        # The directory has the current Teams/SharePoint ids, even if the block is old
+        client = client_directory.get(client_code) or {}
+        return row['next_number'], {
+            'recordId': row['record_id'],
+            'teamId': client.get('teamId', row['team_id']),
+            'sharepointUrl': client.get('sharepointUrl', row['sharepoint_url'])
+        }
+
+    def _airtable_block(self, client_code):
+        """Airtable's Next # and the client record for a new block. Next # is
+        always read fresh, but by record id from the client directory rather
+        than a formula search when it can be."""
+        record = self._client_record(client_code)
+        if record is None:
+            print(f"Client code '{client_code}' not found in Airtable")
+            return None
+        fields = record['fields']
+        return {
+            'client_code': client_code,
+            'airtable_next': fields.get('Next #', 1),
+            'record_id': record['id'],
+            'team_id': fields.get('Teams ID', None),
+            'sharepoint_url': fields.get('Sharepoint ID', None)
+        }
+
+    def _client_record(self, client_code):
+        client = client_directory.get(client_code)
+        if client is not None:
+            try:
+                return airtable.get_record(AIRTABLE_CLIENTS_TABLE, client['recordId'])
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                # Record was deleted or recreated since the directory loaded
+                client_directory.mark_stale()
+        records = airtable.list_records(AIRTABLE_CLIENTS_TABLE, formula=f"{{Client code}}='{client_code}'")
+        return records[0] if records else None
+
+
+job_numbers = JobNumberAllocator(JOB_NUMBER_BLOCK_SIZE)
+
+
+# ===================
+# WRITE JOURNAL
+# ===================
+# Airtable writes are committed to SQLite before the request returns, then
+# sent by one background flusher - whichever worker holds the flusher lease -
+# so a failed write is retried instead of lost. Sends go through the shared
+# Airtable rate limiter like every other call. Queued PATCHes to the same
+# record merge into one.
+
+class WriteJournal:
+    """Durable queue of Airtable creates and PATCHes with a background flusher."""
+
+    def __init__(self, max_attempts):
+        self.max_attempts = max_attempts
+        self.flushed = 0
+        self.retries = 0
+        self._thread = None
+        conn = open_db()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS write_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                op TEXT NOT NULL,
+                record_id TEXT,
+                fields TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claim TEXT,
+                claimed_at REAL,
+                result TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS write_journal_due ON write_journal (state, next_attempt_at)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS project_writes (
+                record_id TEXT PRIMARY KEY,
+                written_at REAL NOT NULL
+            )""")
+        finally:
+            conn.close()
+
+    def enqueue(self, table, op, items, conn=None):
+        """Durably queue writes. items are fields dicts for 'create' and
+        (record_id, fields) pairs for 'update'. Returns the entry ids.
+        Given conn, the writes join the caller's open transaction instead."""
+        if conn is not None:
+            return self._insert(conn, table, op, items)
+        conn = open_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            entry_ids = self._insert(conn, table, op, items)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        return entry_ids
+
+    def _insert(self, conn, table, op, items):
+        now = time.time()
+        entry_ids = []
+        for item in items:
+            record_id, fields = item if op == 'update' else (None, item)
+            pending = None
+            if op == 'update':
+                pending = conn.execute("""SELECT id, fields FROM write_journal
+                    WHERE state = 'pending' AND op = 'update' AND table_name = ? AND record_id = ?""",
+                    (table, record_id)).fetchone()
+            if pending:
+                merged = {**json.loads(pending['fields']), **fields}
+                conn.execute("UPDATE write_journal SET fields = ?, updated_at = ? WHERE id = ?",
+                             (json.dumps(merged), now, pending['id']))
+                entry_ids.append(pending['id'])
+                continue
+            cursor = conn.execute("""INSERT INTO write_journal
+                (table_name, op, record_id, fields, state, next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)""",
+                (table, op, record_id, json.dumps(fields), now, now, now))
+            entry_ids.append(cursor.lastrowid)
+        if table == AIRTABLE_JOBS_TABLE and op == 'update':
+            record_project_writes(conn, [record_id for record_id, _ in items])
+        return entry_ids
+
+    def write(self, table, op, items, wait):
+        """Queue writes and, if wait, send them now. Returns one result per
+        item - the record id (create) or True (update) once written, None
+        while it is still queued for the flusher."""
+        entry_ids = self.enqueue(table, op, items)
+        if not wait:
+            return [None] * len(entry_ids)
+        results = self.flush_entries(entry_ids)
+        return [results.get(entry_id) for entry_id in entry_ids]
+
+    def _claim(self, conn, where, params):
+        """Mark matching rows as sending under a fresh claim token and return them."""
+        token = os.urandom(8).hex()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f"UPDATE write_journal SET state = 'sending', claim = ?, claimed_at = ? WHERE {where}",
+                         (token, now, *params))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return conn.execute("SELECT * FROM write_journal WHERE claim = ? ORDER BY id", (token,)).fetchall()
+
+    @contextmanager
+    def _renewing(self, token):
+        """Keep a claim's claimed_at fresh for the duration of the block. Only
+        a worker that died mid-send stops renewing, so only its rows are
+        reclaimed - never a live send that's waiting on the rate limiter."""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(JOURNAL_CLAIM_TIMEOUT * JOURNAL_CLAIM_RENEW_FRACTION):
+                conn = open_db()
+                try:
+                    conn.execute("UPDATE write_journal SET claimed_at = ? WHERE claim = ? AND state = 'sending'",
+                                 (time.time(), token))
+                except Exception as e:
+                    print(f"Error renewing write journal claim: {e}")
+                finally:
+                    conn.close()
+
+        thread = threading.Thread(target=renew, name='write-journal-claim', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _send(self, conn, rows):
+        """Send up to AIRTABLE_BATCH_SIZE rows sharing a table and op, then
+        record the outcome. Returns {entry_id: result} for the rows written."""
+        table, op = rows[0]['table_name'], rows[0]['op']
+        now = time.time()
+        try:
+            if op == 'create':
+                created = airtable.create_records(table, [json.loads(row['fields']) for row in rows])
+                results = [record.get('id') for record in created]
+            else:
+                airtable.update_records(table, [(row['record_id'], json.loads(row['fields'])) for row in rows])
+                results = [True] * len(rows)
+        except UpstreamUnavailable as e:
+            # Airtable is down or we're over the rate limit - not the write's
+            # fault, so wait it out without using up an attempt
+            for row in rows:
+                conn.execute("""UPDATE write_journal SET state = 'pending', next_attempt_at = ?, claim = NULL,
+                    last_error = ?, updated_at = ? WHERE id = ?""",
+                    (now + (e.retry_after or BREAKER_RESET_TIMEOUT), str(e), now, row['id']))
+            return {}
+        except Exception as e:
+            # Bad requests won't get better with time - everything else is retried
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            permanent = status is not None and status < 500 and status != 429
+            print(f"Error flushing {len(rows)} {op}(s) to {table}: {e}")
+            record_error('write_journal', e)
+            if permanent and len(rows) > 1:
+                # Airtable rejects the whole request for one bad record - send
+                # each on its own so only that one is failed
+                results = {}
+                for row in rows:
+                    results.update(self._send(conn, [row]))
+                return results
+            for row in rows:
+                attempts = row['attempts'] + 1
+                failed = permanent or attempts >= self.max_attempts
+                self.retries += not failed
+                conn.execute("""UPDATE write_journal SET state = ?, attempts = ?, next_attempt_at = ?,
+                    claim = NULL, last_error = ?, updated_at = ? WHERE id = ?""",
+                    ('failed' if failed else 'pending', attempts, now + min(2 ** attempts, 300),
+                     str(e)[:500], now, row['id']))
+            return {}
+
+        for row, result in zip(rows, results):
+            conn.execute("""UPDATE write_journal SET state = 'done', claim = NULL, result = ?, updated_at = ?
+                WHERE id = ?""", (json.dumps(result), now, row['id']))
+        if table == AIRTABLE_JOBS_TABLE and op == 'update':
+            # Reads from before Airtable had the change are stale now too
+            record_project_writes(conn, [row['record_id'] for row in rows])
+        self.flushed += len(rows)
+        project_snapshot.mark_stale()
+        return {row['id']: result for row, result in zip(rows, results)}
+
+    def _send_all(self, conn, rows):
+        results = {}
+        groups = {}
+        for row in rows:
+            groups.setdefault((row['table_name'], row['op']), []).append(row)
+        for group in groups.values():
+            for start in range(0, len(group), AIRTABLE_BATCH_SIZE):
+                results.update(self._send(conn, group[start:start + AIRTABLE_BATCH_SIZE]))
+        return results
+
+    def flush_entries(self, entry_ids):
+        """Send specific queued entries now (write-through). Entries already
+        claimed by the flusher are left to it."""
+        conn = open_db()
+        try:
+            placeholders = ','.join('?' * len(entry_ids))
+            rows = self._claim(conn, f"id IN ({placeholders}) AND state = 'pending'", entry_ids)
+            if not rows:
+                return {}
+            with self._renewing(rows[0]['claim']):
+                return self._send_all(conn, rows)
+        finally:
+            conn.close()
+
+    def flush_once(self):
+        """Send the next batch of due writes (one table and op). Returns rows sent."""
+        now = time.time()
+        conn = open_db()
+        try:
+            # Claims older than JOURNAL_CLAIM_TIMEOUT belong to a worker that died mid-send
+            due = conn.execute("""SELECT table_name, op FROM write_journal
+                WHERE (state = 'pending' AND next_attempt_at <= ?) OR (state = 'sending' AND claimed_at < ?)
+                ORDER BY id LIMIT 1""", (now, now - JOURNAL_CLAIM_TIMEOUT)).fetchone()
+            if not due:
+                return 0
+            rows = self._claim(conn, f"""id IN (SELECT id FROM write_journal
+                WHERE table_name = ? AND op = ?
+                AND ((state = 'pending' AND next_attempt_at <= ?) OR (state = 'sending' AND claimed_at < ?))
+                ORDER BY id LIMIT {AIRTABLE_BATCH_SIZE})""", (due['table_name'], due['op'], now, now - JOURNAL_CLAIM_TIMEOUT))
+            if rows:
+                with self._renewing(rows[0]['claim']):
+                    self._send(conn, rows)
+            return len(rows)
+        finally:
+            conn.close()
+
+    def _hold_lease(self, conn, name, ttl):
+        """Take or renew a named lease for this process. True if we hold it."""
+        owner = f"{os.uname().nodename}:{os.getpid()}"
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            held = row is None or row['owner'] == owner or row['expires_at'] < now
+            if held:
+                conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                             (name, owner, now + ttl))
+            conn.execute('COMMIT')
+            return held
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def prune(self):
+        conn = open_db()
+        try:
+            conn.execute("DELETE FROM write_journal WHERE state = 'done' AND updated_at < ?",
+                         (time.time() - JOURNAL_RETENTION,))
+        finally:
+            conn.close()
+
+    def run(self):
+        last_prune = 0.0
+        while True:
+            try:
+                conn = open_db()
+                try:
+                    leader = self._hold_lease(conn, 'write_journal_flusher', JOURNAL_CLAIM_TIMEOUT)
+                finally:
+                    conn.close()
+                if leader and self.flush_once():
+                    continue
+                if leader and time.time() - last_prune > 3600:
+                    self.prune()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"Write journal flusher error: {e}")
+                record_error('write_journal', e)
+            time.sleep(JOURNAL_POLL_INTERVAL)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='write-journal', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        conn = open_db()
+        try:
+            counts = dict(conn.execute("""SELECT state, COUNT(*) FROM write_journal
+                WHERE state != 'done' GROUP BY state""").fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM write_journal WHERE state IN ('pending', 'sending')").fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'failed': counts.get('failed', 0),
+            'oldestPendingSeconds': round(time.time() - oldest, 1) if oldest else None,
+            'flushed': self.flushed,
+            'retries': self.retries
+        }
+
+
+write_journal = WriteJournal(JOURNAL_MAX_ATTEMPTS)
+
+
+# ===================
+# AIRTABLE HELPERS
+# ===================
+
+@traced('get_job_info_from_airtable')
+def get_job_info_from_airtable(client_code):
+    """Allocate the client's next job number, return job number, team ID, SharePoint URL, and client record ID
+    Used by TRIAGE for new jobs. Raises UpstreamUnavailable when Airtable
+    can't hand out a number, rather than falling back to TBC."""
+    if not AIRTABLE_API_KEY:
+        print("No Airtable API key configured")
+        return f"{client_code} TBC", None, None, None
+    
+    try:
+        allocation = job_numbers.allocate(client_code)
+        if allocation is None:
+            return f"{client_code} TBC", None, None, None
+        
+        current_number, client_record = allocation
+        
+        # Format job number (e.g., "TOW 023")
+        job_number = f"{client_code} {str(current_number).zfill(3)}"
+        
+        return job_number, client_record['teamId'], client_record['sharepointUrl'], client_record['recordId']
+        
+    except Exception as e:
+        print(f"Error getting job info from Airtable: {e}")
+        record_error('get_job_info_from_airtable', e)
+        if isinstance(e, UpstreamUnavailable):
+            raise
+        if airtable_failure(e):
+            raise UpstreamUnavailable('airtable', str(e)) from e
+        return f"{client_code} TBC", None, None, None
+
+
+@traced('get_project_from_airtable')
+def get_project_from_airtable(job_number):
+    """Look up existing project by job number. Returns project details or None.
+    Used by TRAFFIC to validate job numbers and enrich routing data.
+    Served from project_cache when fresh; misses are not cached, but
+    concurrent lookups of one job share a single Airtable read.
+    Raises UpstreamUnavailable when Airtable can't answer, so callers can
+    tell "not found" from "couldn't look"."""
+    if not AIRTABLE_API_KEY:
+        print("No Airtable API key configured")
+        return None
+    
+    job_number = normalise_job_number(job_number)
+    project = project_cache.get_or_load(job_number, lambda: fetch_project_from_airtable(job_number))
+    return dict(project) if project else None
+
+
+def fetch_project_from_airtable(job_number):
+    """Read one project from Airtable and cache it - get_project_from_airtable's miss path."""
+    fetched_at = time.time()
+    try:
+        # Search for the job number
+        records = airtable.list_records(AIRTABLE_JOBS_TABLE, formula=f"{{Job Number}}='{job_number}'")
+        
+        if not records:
+            print(f"Job '{job_number}' not found in Airtable")
+            return None
+        
+        record = records[0]
+        fields = record['fields']
+        
+        # Get client name from linked record if available
+        client_name = fields.get('Client', '')
+        if isinstance(client_name, list):
+            client_name = client_name[0] if client_name else ''
+        
+        project = {
+            'recordId': record['id'],
+            'jobNumber': fields.get('Job Number', job_number),
+            'jobName': fields.get('Project Name', ''),
+            'clientName': client_name,
+            'stage': fields.get('Stage', ''),
+            'status': fields.get('Status', ''),
+            'round': fields.get('Round', 0),
+            'withClient': fields.get('With Client?', False),
+            'teamsChannelId': fields.get('Teams Channel ID', None)
+        }
+        project_cache.set(job_number, project, fetched_at)
+        return project
+        
+    except Exception as e:
+        print(f"Error looking up project in Airtable: {e}")
+        record_error('get_project_from_airtable', e)
+        if isinstance(e, UpstreamUnavailable):
+            raise
+        if airtable_failure(e):
+            raise UpstreamUnavailable('airtable', str(e)) from e
+        return None
+
+
+def build_update_fields(project_record_id, update_text, update_due=None):
+    """Fields for a new Updates record."""
+    # Default to 5 working days if no due date provided
+    if not update_due:
+        update_due = get_next_working_day(date.today(), 5).isoformat()
+    
+    return {
+        'Project Link': [project_record_id],
+        'Update': update_text,
+        'Updated on': date.today().isoformat(),
+        'Update due': update_due
+    }
+
+
+def build_project_fields(updates):
+    """Project fields to PATCH from Claude's projectUpdates - only non-null values.
+    Note: We DON'T update 'Update' field here - it's a lookup from Updates table"""
+    field_mapping = {
+        'Stage': 'Stage',
+        'Status': 'Status',
+        'Live Date': 'Live Date',
+        'With Client?': 'With Client?'
+    }
+    
+    return {
+        airtable_field: updates[key]
+        for key, airtable_field in field_mapping.items()
+        if key in updates and updates[key] is not None
+    }
+
+
+def build_job_fields(job_number, job_name, description, project_owner, client_record_id):
+    """Fields for a new Projects record created by triage."""
+    job_fields = {
+        'Job Number': job_number,
+        'Project Name': job_name,
+        'Description': description,
+        'Status': 'In Progress',
+        'Stage': 'Triage',
+        'Project Owner': project_owner,
+        'Start Date': date.today().isoformat()
+    }
+    
+    # Add client link if we have the record ID
+    if client_record_id:
+        job_fields['Client Link'] = [client_record_id]
+    
+    return job_fields
+
+
+@traced('create_update_in_airtable')
+def create_update_in_airtable(project_record_id, update_text, update_due=None):
+    """Create a new update record in the Updates table. Returns 'written',
+    'queued' while it waits in the write journal, or False."""
+    if not AIRTABLE_API_KEY:
+        print("No Airtable API key configured")
+        return False
+    
+    try:
+        # Journal the record - written now, or by the flusher in write-behind mode
+        fields = build_update_fields(project_record_id, update_text, update_due)
+        written = write_journal.write(AIRTABLE_UPDATES_TABLE, 'create', [fields], wait=not AIRTABLE_WRITE_BEHIND)[0]
+        
+        print(f"{'Created' if written else 'Queued'} update for project {project_record_id}: {update_text}")
+        return 'written' if written else 'queued'
+        
+    except Exception as e:
+        print(f"Error creating update in Airtable: {e}")
+        record_error('create_update_in_airtable', e)
+        return False
+
+
+@traced('update_project_fields_in_airtable')
+def update_project_fields_in_airtable(job_number, updates, record_id=None):
+    """Update specific fields on the Project record (Stage, Status, Live Date, With Client).
+    NOT used for Update field - that comes from Updates table lookup.
+    Pass record_id when the caller already has it; otherwise it comes from the project cache.
+    Returns 'written', 'queued' while it waits in the write journal, or False."""
+    if not AIRTABLE_API_KEY:
+        print("No Airtable API key configured")
+        return False
+    
+    try:
+        # Find the record only if the caller didn't hand us its id
+        if not record_id:
+            project = get_project_from_airtable(job_number)
+            if not project:
+                print(f"Job '{job_number}' not found for update")
+                return False
+            record_id = project['recordId']
+        
+        # Build update payload - only include non-null values
+        update_fields = build_project_fields(updates)
+        
+        if not update_fields:
+            print("No project fields to update")
+            return 'written'
+        
+        # Journal the PATCH - the cache reflects it as soon as it's durably queued
+        written = write_journal.write(AIRTABLE_JOBS_TABLE, 'update', [(record_id, update_fields)],
+                                      wait=not AIRTABLE_WRITE_BEHIND)[0]
+        apply_project_fields_to_cache(job_number, update_fields)
+        
+        print(f"{'Updated' if written else 'Queued update to'} project {job_number}: {update_fields}")
+        return 'written' if written else 'queued'
+        
+    except Exception as e:
+        print(f"Error updating project in Airtable: {e}")
+        record_error('update_project_fields_in_airtable', e)
+        return False
+
+
+@traced('create_job_in_airtable')
+def create_job_in_airtable(job_number, job_name, client_code, description, project_owner, client_record_id):
+    """Create a new job record in the Jobs table.
+    Used by TRIAGE for new jobs. Returns the record id, or None while the
+    create is still queued in the write journal."""
+    if not AIRTABLE_API_KEY:
+        print("No Airtable API key configured")
+        return None
+    
+    try:
+        # Build and create the job record
+        job_fields = build_job_fields(job_number, job_name, description, project_owner, client_record_id)
+        record_id = write_journal.write(AIRTABLE_JOBS_TABLE, 'create', [job_fields], wait=not AIRTABLE_WRITE_BEHIND)[0]
+        project_cache.invalidate(normalise_job_number(job_number))
+        print(f"{'Created' if record_id else 'Queued'} job record {job_number}: {record_id}")
+        return record_id
+        
+    except Exception as e:
+        print(f"Error creating job in Airtable: {e}")
+        record_error('create_job_in_airtable', e)
+        return None
+
+
+@traced('create_records_in_batches')
+def create_records_in_batches(table, fields_list, conn=None):
+    """Create many records through the write journal, AIRTABLE_BATCH_SIZE per request.
+    Returns the new record ids in input order, None where a batch failed to
+    send (it stays queued and the flusher retries it), False where it
+    couldn't be journalled. Given conn, the creates are only queued, in the
+    caller's transaction, and errors are left to roll it back."""
+    if conn is not None:
+        write_journal.enqueue(table, 'create', fields_list, conn=conn)
+        return [None] * len(fields_list)
+    try:
+        return write_journal.write(table, 'create', fields_list, wait=True)
+    except Exception as e:
+        print(f"Error batch creating {len(fields_list)} records in {table}: {e}")
+        record_error('create_records_in_batches', e)
+        return [False] * len(fields_list)
+
+
+@traced('update_records_in_batches')
+def update_records_in_batches(table, updates, conn=None):
+    """PATCH many (record_id, fields) pairs through the write journal,
+    AIRTABLE_BATCH_SIZE per request. Returns 'written' or 'queued' (failed to
+    send, retried by the flusher) per pair, False if it couldn't be journalled.
+    Given conn, the PATCHes are only queued, in the caller's transaction."""
+    if conn is not None:
+        write_journal.enqueue(table, 'update', updates, conn=conn)
+        return ['queued'] * len(updates)
+    try:
+        return ['written' if written else 'queued' for written in write_journal.write(table, 'update', updates, wait=True)]
+    except Exception as e:
+        print(f"Error batch updating {len(updates)} records in {table}: {e}")
+        record_error('update_records_in_batches', e)
+        return [False] * len(updates)
+
+
+# ===================
+# WIP SNAPSHOT
+# ===================
+
+class ProjectSnapshot:
+    """Local copy of Projects plus each project's latest Update, for /wip.
+
+    Indexed by client code, stage, status and With Client? so a WIP query is
+    a few set intersections. Kept fresh incrementally - each refresh only
+    fetches records modified since the previous one - with an occasional
+    full re-fetch to drop deleted records."""
+
+    INDEXED = {
+        'clientCode': lambda fields: normalise_job_number(fields.get('Job Number', '')).split(' ')[0],
+        'stage': lambda fields: fields.get('Stage', ''),
+        'status': lambda fields: fields.get('Status', ''),
+        'withClient': lambda fields: bool(fields.get('With Client?', False))
+    }
+
+    def __init__(self):
+        self.projects = {}
+        self.latest_updates = {}
+        self.indexes = {name: defaultdict(set) for name in self.INDEXED}
+        self.synced_at = None
+        self.last_refresh = 0.0
+        self.last_full_sync = 0.0
+        self.stale = True
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def mark_stale(self):
+        """Called after our own writes so the next /wip picks them up."""
+        self.stale = True
+
+    def _index(self, record_id, fields, add=True):
+        for name, key_of in self.INDEXED.items():
+            bucket = self.indexes[name][key_of(fields)]
+            if add:
+                bucket.add(record_id)
+            else:
+                bucket.discard(record_id)
+
+    def _upsert_project(self, record):
+        previous = self.projects.get(record['id'])
+        if previous is not None:
+            self._index(record['id'], previous, add=False)
+        self.projects[record['id']] = record['fields']
+        self._index(record['id'], record['fields'])
+
+    def _upsert_update(self, record):
+        fields = record['fields']
+        for project_id in fields.get('Project Link', []):
+            current = self.latest_updates.get(project_id)
+            if current is None or (fields.get('Updated on') or '') >= (current.get('Updated on') or ''):
+                self.latest_updates[project_id] = fields
+
+    def refresh(self, force=False):
+        """Pull changes from Airtable if the snapshot is due for it."""
+        now = time.monotonic()
+        if not force and not self.stale and now - self.last_refresh < WIP_REFRESH_INTERVAL:
+            return
+        # One refresher at a time - everyone else serves the current snapshot
+        if not self._refresh_lock.acquire(blocking=self.synced_at is None):
+            return
+        try:
+            full = self.synced_at is None or now - self.last_full_sync > WIP_FULL_SYNC_INTERVAL
+            # Overlap a little so records modified mid-sync aren't missed
+            started = datetime.now(timezone.utc) - timedelta(seconds=5)
+            formula = None
+            if not full:
+                formula = f"IS_AFTER(LAST_MODIFIED_TIME(), '{self.synced_at}')"
+            self.stale = False
+            projects = airtable.list_all_records(AIRTABLE_JOBS_TABLE, formula=formula)
+            updates = airtable.list_all_records(AIRTABLE_UPDATES_TABLE, formula=formula)
+
+            with self._lock:
+                if full:
+                    self.projects = {}
+                    self.latest_updates = {}
+                    self.indexes = {name: defaultdict(set) for name in self.INDEXED}
+                    self.last_full_sync = now
+                for record in projects:
+                    self._upsert_project(record)
+                for record in updates:
+                    self._upsert_update(record)
+                self.synced_at = started.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                self.last_refresh = now
+            print(f"WIP snapshot {'full' if full else 'incremental'} sync: "
+                  f"{len(projects)} projects, {len(updates)} updates")
+        except Exception:
+            self.stale = True
+            raise
+        finally:
+            self._refresh_lock.release()
+
+    def query(self, **filters):
+        """Projects matching every given indexed filter (None = don't filter)."""
+        with self._lock:
+            matches = None
+            for name, value in filters.items():
+                if value is None:
+                    continue
+                ids = self.indexes[name].get(value, set())
+                matches = set(ids) if matches is None else matches & ids
+            if matches is None:
+                matches = set(self.projects)
+            return [(record_id, self.projects[record_id], self.latest_updates.get(record_id, {}))
+                    for record_id in matches]
+
+    def stats(self):
+        return {'projects': len(self.projects), 'syncedAt': self.synced_at}
+
+
+project_snapshot = ProjectSnapshot()
+
+
+# ===================
+# SIDE EFFECTS
+# ===================
+
+# Shared pool for post-LLM Airtable writes, sized well above steps per request
+side_effect_pool = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SIDE_EFFECT_WORKERS', 16)),
+    thread_name_prefix='side-effect'
+)
+
+
+def run_side_effects(steps):
+    """Run a small dependency graph of side effects concurrently.
+
+    steps maps name -> (fn, deps). Each fn is called with the results so far
+    once all of its deps have finished. Returns (results, timings) where
+    timings are per-step wall times in milliseconds."""
+    results = {}
+    timings = {}
+    pending = dict(steps)
+    running = {}
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        try:
+            return fn(results)
+        finally:
+            timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    while pending or running:
+        ready = [name for name, (fn, deps) in pending.items() if all(dep in results for dep in deps)]
+        for name in ready:
+            fn, _ = pending.pop(name)
+            running[side_effect_pool.submit(in_request_context(timed), name, fn)] = name
+        if not running:
+            raise ValueError(f"Side effects with unmet dependencies: {sorted(pending)}")
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+
+    return results, timings
+
+
+# ===================
+# IDEMPOTENCY
+# ===================
+# Power Automate retries on timeouts. Without this a retried /triage burns a
+# second job number and Projects record, and every retry pays for Claude again.
+# Completed responses and in-flight claims live in SQLite so duplicates are
+# caught across gunicorn workers, not just within one process.
+
+class IdempotencyStore:
+    """Bounded store of completed responses plus in-flight request claims."""
+
+    def __init__(self, ttl, max_entries, wait_timeout):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self.replays = 0
+        conn = open_db()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                status INTEGER,
+                body TEXT,
+                created_at REAL NOT NULL
+            )""")
+        finally:
+            conn.close()
+
+    def claim(self, key):
+        """Returns ('owner', None) if this request should run, ('done', (body, status))
+        if it already completed, or ('in_flight', None) if another request is running it."""
+        now = time.time()
+        conn = open_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM idempotency WHERE state = ? AND created_at < ?', ('done', now - self.ttl))
+            row = conn.execute('SELECT * FROM idempotency WHERE key = ?', (key,)).fetchone()
+            if row is not None and row['state'] == 'done':
+                conn.execute('COMMIT')
+                return 'done', (row['body'], row['status'])
+            if row is not None and row['created_at'] > now - self.wait_timeout:
+                conn.execute('COMMIT')
+                return 'in_flight', None
+            # New key, or an in-flight claim whose owner died - take it over
+            conn.execute('INSERT OR REPLACE INTO idempotency (key, state, created_at) VALUES (?, ?, ?)',
+                         (key, 'in_flight', now))
+            conn.execute('COMMIT')
+            return 'owner', None
+        finally:
+            conn.close()
+
+    def complete(self, key, body, status):
+        conn = open_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE idempotency SET state = ?, status = ?, body = ?, created_at = ? WHERE key = ?',
+                         ('done', status, body, time.time(), key))
+            # Keep the store bounded - drop the oldest completed entries
+            conn.execute("""DELETE FROM idempotency WHERE state = 'done' AND key NOT IN (
+                SELECT key FROM idempotency WHERE state = 'done' ORDER BY created_at DESC LIMIT ?)""",
+                         (self.max_entries,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def release(self, key):
+        """Drop an in-flight claim without storing a result, so a retry runs for real."""
+        conn = open_db()
+        try:
+            conn.execute('DELETE FROM idempotency WHERE key = ? AND state = ?', (key, 'in_flight'))
+        finally:
+            conn.close()
+
+    def wait_for(self, key):
+        """Wait for an in-flight duplicate to finish. Returns (body, status) or None."""
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(0.2)
+            state, result = self.peek(key)
+            if state == 'done':
+                return result
+            if state is None:
+                return None
+        return None
+
+    def peek(self, key):
+        conn = open_db()
+        try:
+            row = conn.execute('SELECT state, status, body FROM idempotency WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None, None
+        return row['state'], (row['body'], row['status'])
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_WAIT)
+
+
+def idempotency_key(endpoint):
+    """Idempotency-Key header if sent, otherwise a hash of the email itself."""
+    header = request.headers.get('Idempotency-Key')
+    if header:
+        return f"{endpoint}:{header}"
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        fingerprint = [data.get(field) for field in ('subjectLine', 'senderEmail', 'emailContent', 'jobNumber',
+                                                     'attachments', 'callbackUrl')]
+    elif request.files:
+        # Multipart /feedback - the form fields plus what each file contains
+        fingerprint = [request.form.to_dict(), sorted(stream_digest(f.stream) for _, f in request.files.items(multi=True))]
+    else:
+        fingerprint = data
+    digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{endpoint}:{digest}"
+
+
+def replay(body, status):
+    idempotency_store.replays += 1
+    response = app.response_class(body, status=status, mimetype='application/json')
+    response.headers['Idempotent-Replay'] = 'true'
+    return response
+
+
+def idempotent(endpoint):
+    """Serve duplicate deliveries from the first request's response.
+
+    Completed 2xx/4xx responses are replayed immediately. A duplicate that
+    arrives while the original is still running waits for its result instead
+    of calling Claude again. 5xx responses aren't stored, so retries of a
+    failed request run again."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Queued jobs were deduplicated when they were accepted
+            if running_as_job():
+                return view(*args, **kwargs)
+            key = idempotency_key(endpoint)
+            state, result = idempotency_store.claim(key)
+            if state == 'done':
+                return replay(*result)
+            if state == 'in_flight':
+                result = idempotency_store.wait_for(key)
+                if result:
+                    return replay(*result)
+                return jsonify({
+                    'error': 'duplicate_in_progress',
+                    'message': 'An identical request is still being processed'
+                }), 409
+
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except Exception:
+                idempotency_store.release(key)
+                raise
+            if response.status_code >= 500:
+                idempotency_store.release(key)
+            else:
+                idempotency_store.complete(key, response.get_data(as_text=True), response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+
+# ===================
+# JOB QUEUE
+# ===================
+# Power Automate waits on /triage and /update for Claude plus the Airtable
+# round trips, which can run close to its timeout. Callers that opt in get a
+# 202 with a job id straight away. The request is queued in SQLite and run by
+# whichever worker - worker.py or a web worker's job threads - claims it
+# first, through the same view it would have hit. Results are polled from
+# /jobs/<id> or POSTed to the caller's callbackUrl.
+
+JOB_ENVIRON_KEY = 'dot.job_id'
+
+
+def job_timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc).isoformat() if value else None
+
+
+class JobQueue:
+    """Durable queue of endpoint requests, run by worker threads in any process."""
+
+    def __init__(self, max_attempts, callback_attempts, retention):
+        self.max_attempts = max_attempts
+        self.callback_attempts = callback_attempts
+        self.retention = retention
+        self.worker_id = f"{os.uname().nodename}:{os.getpid()}"
+        self.http = httpx.Client(timeout=10.0)
+        self._stop = threading.Event()
+        self._threads = []
+        conn = open_db()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                path TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at REAL NOT NULL,
+                worker TEXT,
+                status INTEGER,
+                result TEXT,
+                callback_url TEXT,
+                callback_state TEXT,
+                callback_attempts INTEGER NOT NULL DEFAULT 0,
+                callback_at REAL,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, run_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_callbacks ON jobs (callback_state, callback_at)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS job_workers (
+                id TEXT PRIMARY KEY,
+                threads INTEGER NOT NULL,
+                seen_at REAL NOT NULL
+            )""")
+        finally:
+            conn.close()
+
+    def enqueue(self, endpoint, path, payload, callback_url=None):
+        """Durably queue one request. Returns the job id."""
+        job_id = os.urandom(12).hex()
+        now = time.time()
+        conn = open_db()
+        try:
+            conn.execute("""INSERT INTO jobs (id, endpoint, path, payload, state, run_at, callback_url, created_at)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                (job_id, endpoint, path, json.dumps(payload), now, callback_url, now))
+        finally:
+            conn.close()
+        return job_id
+
+    def get(self, job_id):
+        conn = open_db()
+        try:
+            return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+    def report(self, row):
+        """A job as /jobs/<id> and callbacks show it."""
+        report = {
+            'jobId': row['id'],
+            'endpoint': row['endpoint'],
+            'status': row['state'],
+            'attempts': row['attempts'],
+            'createdAt': job_timestamp(row['created_at']),
+            'startedAt': job_timestamp(row['started_at']),
+            'finishedAt': job_timestamp(row['finished_at'])
+        }
+        if row['state'] in ('done', 'failed'):
+            report['resultStatus'] = row['status']
+            report['result'] = json.loads(row['result']) if row['result'] else None
+        if row['callback_url']:
+            report['callback'] = {'state': row['callback_state'], 'attempts': row['callback_attempts']}
+        return report
+
+    def _finish(self, conn, job_id, state, status, result):
+        now = time.time()
+        conn.execute("""UPDATE jobs SET state = ?, status = ?, result = ?, finished_at = ?,
+            callback_state = CASE WHEN callback_url IS NULL THEN NULL ELSE 'pending' END, callback_at = ?
+            WHERE id = ?""", (state, status, json.dumps(result), now, now, job_id))
+
+    def claim(self):
+        """Take the next due job for this process. Returns its row or None.
+
+        Jobs left running by a worker that stopped heartbeating are failed
+        rather than rerun - a triage may already have used its job number."""
+        now = time.time()
+        conn = open_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                lost = conn.execute("""SELECT id FROM jobs WHERE state = 'running' AND worker NOT IN (
+                    SELECT id FROM job_workers WHERE seen_at >= ?)""", (now - 3 * JOB_HEARTBEAT_INTERVAL,)).fetchall()
+                for row in lost:
+                    self._finish(conn, row['id'], 'failed', 500,
+                                 {'error': 'job_interrupted', 'message': 'The worker running this job stopped'})
+                row = conn.execute("""SELECT * FROM jobs WHERE state = 'queued' AND run_at <= ?
+                    ORDER BY run_at LIMIT 1""", (now,)).fetchone()
+                if row:
+                    conn.execute("""UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?,
+                        started_at = ? WHERE id = ?""", (self.worker_id, now, row['id']))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return row
+
+    def run(self, row):
+        """Run a claimed job through its endpoint's view and store the response.
+        A 503 (upstream unavailable) is requeued until JOB_MAX_ATTEMPTS."""
+        try:
+            with app.test_request_context(row['path'], method='POST', json=json.loads(row['payload']),
+                                          environ_base={JOB_ENVIRON_KEY: row['id']}):
+                response = app.full_dispatch_request()
+            status, result = response.status_code, response.get_json(silent=True)
+            retry_after = response.headers.get('Retry-After')
+        except Exception as e:
+            record_error('job_queue', e)
+            status, result, retry_after = 500, {'error': 'Internal server error', 'details': str(e)}, None
+        
+        conn = open_db()
+        try:
+            if status == 503 and row['attempts'] + 1 < self.max_attempts:
+                delay = float(retry_after) if retry_after else BREAKER_RESET_TIMEOUT
+                conn.execute("""UPDATE jobs SET state = 'queued', run_at = ?, worker = NULL, status = ?, result = ?
+                    WHERE id = ?""", (time.time() + delay, status, json.dumps(result), row['id']))
+            else:
+                self._finish(conn, row['id'], 'done' if status < 500 else 'failed', status, result)
+        finally:
+            conn.close()
+
+    def send_callback(self):
+        """POST one due callback. Returns True if there was one."""
+        now = time.time()
+        conn = open_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("""SELECT * FROM jobs WHERE callback_state = 'pending' AND callback_at <= ?
+                    ORDER BY callback_at LIMIT 1""", (now,)).fetchone()
+                if row:
+                    # Hold it for the length of the POST so no other worker sends it too
+                    conn.execute("UPDATE jobs SET callback_at = ? WHERE id = ?", (now + 60, row['id']))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if not row:
+                return False
+            
+            attempts = row['callback_attempts'] + 1
+            if not callback_allowed(row['callback_url']):
+                print(f"Callback for job {row['id']} refused - {row['callback_url']} is not an allowed public host")
+                conn.execute("UPDATE jobs SET callback_state = 'failed', callback_attempts = ? WHERE id = ?",
+                             (attempts, row['id']))
+                return True
+            try:
+                response = self.http.post(row['callback_url'], json=self.report(row))
+                sent = response.is_success
+                error = None if sent else f"callback returned {response.status_code}"
+            except httpx.HTTPError as e:
+                sent, error = False, str(e)
+            if sent:
+                state = 'sent'
+            else:
+                print(f"Callback for job {row['id']} failed ({error})")
+                state = 'failed' if attempts >= self.callback_attempts else 'pending'
+            conn.execute("UPDATE jobs SET callback_state = ?, callback_attempts = ?, callback_at = ? WHERE id = ?",
+                         (state, attempts, time.time() + min(5 * 2 ** attempts, 300), row['id']))
+            return True
+        finally:
+            conn.close()
+
+    def heartbeat(self, threads):
+        now = time.time()
+        conn = open_db()
+        try:
+            conn.execute("INSERT OR REPLACE INTO job_workers (id, threads, seen_at) VALUES (?, ?, ?)",
+                         (self.worker_id, threads, now))
+            conn.execute("DELETE FROM job_workers WHERE seen_at < ?", (now - 3600,))
+        finally:
+            conn.close()
+
+    def workers_alive(self):
+        """Job threads heartbeating across every process sharing the queue."""
+        conn = open_db()
+        try:
+            return conn.execute("SELECT COALESCE(SUM(threads), 0) FROM job_workers WHERE seen_at >= ?",
+                                (time.time() - 3 * JOB_HEARTBEAT_INTERVAL,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def prune(self):
+        conn = open_db()
+        try:
+            conn.execute("""DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished_at < ?
+                AND COALESCE(callback_state, 'sent') != 'pending'""", (time.time() - self.retention,))
+        finally:
+            conn.close()
+
+    def work(self):
+        while not self._stop.is_set():
+            try:
+                if self.send_callback():
+                    continue
+                row = self.claim()
+                if row:
+                    self.run(row)
+                    continue
+            except Exception as e:
+                print(f"Job worker error: {e}")
+                record_error('job_queue', e)
+            self._stop.wait(JOB_POLL_INTERVAL)
+
+    def keep_alive(self, threads):
+        last_prune = 0.0
+        while not self._stop.is_set():
+            try:
+                self.heartbeat(threads)
+                if time.time() - last_prune > 3600:
+                    self.prune()
+                    last_prune = time.time()
+            except Exception as e:
+                print(f"Job worker heartbeat error: {e}")
+                record_error('job_queue', e)
+            self._stop.wait(JOB_HEARTBEAT_INTERVAL)
+
+    def start(self, threads):
+        """Run jobs on this many threads in this process."""
+        if self._threads or threads < 1:
+            return
+        self.heartbeat(threads)
+        self._threads = [threading.Thread(target=self.keep_alive, args=(threads,), name='job-heartbeat', daemon=True)]
+        self._threads += [threading.Thread(target=self.work, name=f"job-worker-{n}", daemon=True)
+                          for n in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Let running jobs finish, then stop this process's job threads."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        conn = open_db()
+        try:
+            conn.execute("DELETE FROM job_workers WHERE id = ?", (self.worker_id,))
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = open_db()
+        try:
+            counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            oldest = conn.execute("SELECT MIN(created_at) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            callbacks = dict(conn.execute("""SELECT callback_state, COUNT(*) FROM jobs
+                WHERE callback_state IS NOT NULL GROUP BY callback_state""").fetchall())
+        finally:
+            conn.close()
+        return {
+            'queued': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'oldestQueuedSeconds': round(time.time() - oldest, 1) if oldest else None,
+            'callbacks': {state: callbacks.get(state, 0) for state in ('pending', 'sent', 'failed')},
+            'workerThreads': self.workers_alive()
+        }
+
+
+job_queue = JobQueue(JOB_MAX_ATTEMPTS, JOB_CALLBACK_ATTEMPTS, JOB_RETENTION)
+
+
+def running_as_job():
+    return JOB_ENVIRON_KEY in request.environ
+
+
+def wants_async():
+    return parse_bool(request.args.get('async')) or 'respond-async' in request.headers.get('Prefer', '').lower()
+
+
+def callback_allowed(url):
+    """True for http(s) URLs on a JOB_CALLBACK_HOSTS host that resolves only
+    to public addresses. Checked when the job is queued and again before
+    each POST, so a name re-pointed at an internal address in between is
+    still refused."""
+    try:
+        parsed = httpx.URL(url)
+    except httpx.InvalidURL:
+        return False
+    host = (parsed.host or '').lower()
+    if parsed.scheme not in ('http', 'https') or not host:
+        return False
+    if not any(host == allowed or host.endswith(f".{allowed}") for allowed in JOB_CALLBACK_HOSTS):
+        return False
+    return resolves_to_public(host, parsed.port or (443 if parsed.scheme == 'https' else 80))
+
+
+def resolves_to_public(host, port):
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return False
+    addresses = {ipaddress.ip_address(info[4][0].split('%')[0]) for info in infos}
+    return bool(addresses) and all(address.is_global for address in addresses)
+
+
+REQUIRED_FIELD_ERRORS = {'jobNumber': 'No job number provided', 'emailContent': 'No email content provided'}
+
+
+def required_fields(*fields):
+    """Input check for queueable - the view's own 400 for a missing field."""
+    def validate(data):
+        for field in fields:
+            if not (isinstance(data, dict) and data.get(field)):
+                return {'error': REQUIRED_FIELD_ERRORS[field]}, 400
+        return None
+    return validate
+
+
+def queueable(endpoint, validate):
+    """Queue the request as a job when the caller asks for it.
+
+    Goes under @idempotent, so a retried delivery gets the same job id back.
+    Bad input is still rejected up front. With no job workers running the
+    request is processed synchronously, as if async hadn't been asked for."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if running_as_job():
+                return view(*args, **kwargs)
+            data = request.get_json(silent=True)
+            callback_url = (data.get('callbackUrl') if isinstance(data, dict) else None) or request.headers.get('X-Callback-Url')
+            if not callback_url and not wants_async():
+                return view(*args, **kwargs)
+            
+            error = validate(data)
+            if error:
+                return jsonify(error[0]), error[1]
+            if callback_url and not callback_allowed(callback_url):
+                return jsonify({'error': 'callback_not_allowed', 'message': f"Callbacks can't be sent to {callback_url}"}), 400
+            if not job_queue.workers_alive():
+                print(f"No job workers running - processing {endpoint} synchronously")
+                return view(*args, **kwargs)
+            
+            payload = {k: v for k, v in data.items() if k != 'callbackUrl'} if isinstance(data, dict) else data
+            job_id = job_queue.enqueue(endpoint, request.path, payload, callback_url)
+            g.job_queued = True
+            response = jsonify({'jobId': job_id, 'status': 'queued', 'statusUrl': f"/jobs/{job_id}"})
+            response.status_code = 202
+            response.headers['Location'] = f"/jobs/{job_id}"
+            return response
+        return wrapper
+    return decorator
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status of a queued job, with the endpoint's response once it has run."""
+    row = job_queue.get(job_id)
+    if row is None:
+        return jsonify({'error': 'job_not_found', 'jobId': job_id}), 404
+    return jsonify(job_queue.report(row))
+
+
+# ===================
+# TRAFFIC FAST PATH
+# ===================
+# Deterministic pre-router for the mechanical rules in dot_traffic_prompt.txt.
+# It only claims an email when the prompt leaves no room for judgement and
+# returns None otherwise, so everything ambiguous still goes to Claude.
+
+VALID_CLIENT_CODES = ['ONE', 'ONS', 'SKY', 'TOW', 'FIS', 'FST', 'WKA', 'HUN', 'LAB', 'OTH']
+
+# Sender/recipient domain -> client code (CLIENT CODE MAPPING in the traffic prompt)
+CLIENT_DOMAINS = {
+    'one.nz': 'ONE',
+    'sky.co.nz': 'SKY',
+    'tower.co.nz': 'TOW',
+    'tower.com': 'TOW',
+    'fisherfunds.co.nz': 'FIS',
+    'firestop.co.nz': 'FST',
+    'whakarongorau.nz': 'WKA',
+    'labour.org.nz': 'LAB'
+}
+
+# Client names as they appear in WIP requests ("WIP for Sky", "One NZ WIP")
+CLIENT_NAMES = {
+    'one nz': 'ONE',
+    'sky': 'SKY',
+    'tower': 'TOW',
+    'fisher funds': 'FIS',
+    'firestop': 'FST',
+    'whakarongorau': 'WKA',
+    'healthline': 'WKA',
+    'labour': 'LAB'
+}
+
+INTERNAL_DOMAIN = 'hunch.co.nz'
+
+JOB_NUMBER_PATTERN = re.compile(
+    r'(?<![A-Za-z0-9])(' + '|'.join(VALID_CLIENT_CODES) + r')[ _](\d{3})(?!\d)',
+    re.IGNORECASE
+)
+EMAIL_PATTERN = re.compile(r"[\w.+'-]+@([\w-]+(?:\.[\w-]+)+)")
+WIP_PATTERN = re.compile(r'\bwip\b|\bwork in progress\b', re.IGNORECASE)
+TRIAGE_PATTERN = re.compile(r'\btriage\b', re.IGNORECASE)
+CLIENT_NAME_PATTERN = re.compile(
+    r'\b(' + '|'.join(re.escape(name) for name in CLIENT_NAMES) + r')\b',
+    re.IGNORECASE
+)
+
+# Keywords only count in command position - the subject or the sole line of
+# new text starts with them ("WIP for Sky", "One NZ WIP", "Triage: new brief").
+# A keyword mid-sentence ("add the banner to the WIP list") or in quoted
+# history (a reply to Dot's own clarify email) needs Claude.
+WIP_COMMAND_PATTERN = re.compile(
+    r'(?:(?:' + '|'.join(re.escape(name) for name in CLIENT_NAMES) + r')\s+)?(?:wip|work in progress)\b',
+    re.IGNORECASE
+)
+TRIAGE_COMMAND_PATTERN = re.compile(r'(?:please\s+)?triage\b', re.IGNORECASE)
+# What may follow the keyword without turning the command into a sentence
+COMMAND_FILLER = {'for', 'please', 'pls', 'the', 'this', 'a', 'latest', 'current', 'report', 'update', 'thanks'}
+COMMAND_SEPARATOR_PATTERN = re.compile(r'\s*[:\-\u2013]')
+GREETING_LINE_PATTERN = re.compile(r'^(?:hi|hey|hello|kia ora|morning|dear)\b[^.?\n]{0,30}$', re.IGNORECASE)
+# A bare sign-off: the word itself, punctuation, and at most a name after it
+SIGN_OFF_LINE_PATTERN = re.compile(
+    r"^(?i:thanks|thank you|thanks heaps|many thanks|cheers|regards|kind regards|best regards|warm regards"
+    r"|best|ngā mihi|nga mihi)[\s,.!-]*(?:[A-Z][\w.'-]*[\s,.]*){0,3}$"
+)
+
+
+def as_list(value):
+    """Power Automate sends lists either as arrays or as ';'/',' separated strings."""
+    if isinstance(value, list):
+        return [str(v) for v in value if v]
+    if not value:
+        return []
+    return [v.strip() for v in re.split(r'[;,]', str(value)) if v.strip()]
+
+
+def email_domain(address):
+    match = EMAIL_PATTERN.search(address or '')
+    return match.group(1).lower() if match else ''
+
+
+def client_code_for_domain(domain, sender_name='', text=''):
+    """Map an email domain to a client code, applying the ONE/ONS split.
+    Domains come from the client directory on top of CLIENT_DOMAINS."""
+    code = client_directory.code_for_domain(domain)
+    if code == 'ONE' and ('tracey barclay' in sender_name.lower() or 'simplification' in text.lower()):
+        return 'ONS'
+    return code
+
+
+def find_job_numbers(text):
+    """Distinct job numbers in text, normalised to 'ONE 125' form, in order of appearance."""
+    found = []
+    for code, digits in JOB_NUMBER_PATTERN.findall(text or ''):
+        job_number = f"{code.upper()} {digits}"
+        if job_number not in found:
+            found.append(job_number)
+    return found
+
+
+def new_text(email_content):
+    """The sender's own words: everything above the first quoted message,
+    without '>' quoting or the trimmer's earlier-in-thread note."""
+    separator = THREAD_SEPARATOR_PATTERN.search(email_content or '')
+    text = email_content[:separator.start()] if separator else (email_content or '')
+    return '\n'.join(line for line in text.splitlines()
+                     if not line.lstrip().startswith('>') and not line.startswith('[Earlier in thread'))
+
+
+def command_lines(email_content):
+    """Non-empty lines of new text between any greeting and the sign-off."""
+    lines = [line.strip() for line in new_text(email_content).splitlines() if line.strip()]
+    while lines and GREETING_LINE_PATTERN.match(lines[0]):
+        lines.pop(0)
+    for i, line in enumerate(lines):
+        if SIGN_OFF_LINE_PATTERN.match(line):
+            return lines[:i]
+    return lines
+
+
+def keyword_command(pattern, subject_line, lines):
+    """The subject or sole body line when it starts with the keyword and is
+    a command rather than a sentence, else None."""
+    candidates = [SUBJECT_PREFIX_PATTERN.sub('', subject_line or '').strip()]
+    if len(lines) == 1:
+        candidates.append(lines[0])
+    for candidate in candidates:
+        match = pattern.match(candidate)
+        if not match:
+            continue
+        rest = candidate[match.end():]
+        words = re.findall(r"[\w']+", CLIENT_NAME_PATTERN.sub(' ', rest).lower())
+        if COMMAND_SEPARATOR_PATTERN.match(rest) or all(word in COMMAND_FILLER for word in words):
+            return candidate
+    return None
+
+
+def fast_route(subject_line, email_content, sender_email, sender_name, all_recipients, has_attachments, attachment_names):
+    """Route an email without Claude when the rules are unambiguous.
+
+    Returns routing JSON in the same shape as the traffic prompt, or None
+    when the email needs the model's judgement."""
+    recipients = as_list(all_recipients)
+    attachments = as_list(attachment_names)
+    text = f"{subject_line}\n{email_content}"
+
+    routing = {
+        'route': None,
+        'jobNumber': None,
+        'clientCode': None,
+        'senderEmail': sender_email,
+        'senderName': sender_name
+    }
+
+    # Job number lookup order: attachment names -> subject -> body.
+    # The first source with a match decides; two different numbers in it is ambiguous.
+    job_numbers = []
+    for source in ('\n'.join(attachments), subject_line, email_content):
+        job_numbers = find_job_numbers(source)
+        if job_numbers:
+            break
+    if len(job_numbers) > 1:
+        return None
+
+    if job_numbers:
+        # WIP is checked first in the prompt, so a WIP ask on a job email needs judgement
+        if WIP_PATTERN.search(text):
+            return None
+        # Work-to-client needs an external recipient AND attachments - without
+        # both the prompt can only land on Update
+        external = [r for r in recipients if email_domain(r) and email_domain(r) != INTERNAL_DOMAIN]
+        if external and (has_attachments or attachments):
+            return None
+        routing.update({
+            'route': 'update',
+            'jobNumber': job_numbers[0],
+            'clientCode': job_numbers[0].split(' ')[0],
+            'reason': 'Job number found, no external recipient with attachments'
+        })
+        return routing
+
+    sender_domain = email_domain(sender_email)
+    sender_code = None
+    if sender_domain != INTERNAL_DOMAIN:
+        sender_code = client_code_for_domain(sender_domain, sender_name or '', text)
+
+    lines = command_lines(email_content)
+    command = keyword_command(WIP_COMMAND_PATTERN, subject_line, lines)
+    if command:
+        named = {CLIENT_NAMES[name.lower()] for name in CLIENT_NAME_PATTERN.findall(command)}
+        if sender_code:
+            named.add(sender_code)
+        if len(named) > 1:
+            return None
+        routing.update({
+            'route': 'wip',
+            'clientCode': named.pop() if named else None,
+            'reason': 'WIP report requested'
+        })
+        return routing
+
+    if keyword_command(TRIAGE_COMMAND_PATTERN, subject_line, lines):
+        routing.update({
+            'route': 'triage',
+            'clientCode': sender_code,
+            'reason': 'No job number, triage requested'
+        })
+        return routing
+
+    return None
+
+
+# ===================
+# INPUT TRIMMING
+# ===================
+# Long reply chains carry every earlier message, plus signatures and legal
+# footers, into the prompt. We keep the newest message and the one it
+# replies to or forwards (a forwarded brief is the whole point of a triage),
+# drop the rest, and cap the result at the endpoint's budget.
+
+# Where an earlier message starts in a thread
+THREAD_SEPARATOR_PATTERN = re.compile(
+    r'^(?:On .{5,200}wrote:\s*$'
+    r'|-{2,}\s*(?:Original|Forwarded) Message\s*-{2,}'
+    r'|_{10,}\s*$'
+    r'|From:\s.+\n(?:.*\n){0,3}?(?:Sent|Date):\s)',
+    re.IGNORECASE | re.MULTILINE
+)
+SIGNATURE_PATTERN = re.compile(
+    r'^(?:--\s*$|Sent from my \w+|Get Outlook for \w+)',
+    re.IGNORECASE | re.MULTILINE
+)
+# Lines a signature block is made of - anything longer, a list item or a
+# sentence means the "sign-off" above it was really the start of the message
+SIGNATURE_LINE_MAX = 60
+LIST_ITEM_PATTERN = re.compile(r'^(?:\d+[.)]|[-*\u2022])\s')
+DISCLAIMER_PATTERN = re.compile(
+    r'confidential|intended (?:only )?for the (?:named |addressee|recipient)|received this (?:e-?mail|message) in error'
+    r'|caution: this email originated|please consider the environment|unsubscribe',
+    re.IGNORECASE
+)
+THREAD_MESSAGES_KEPT = 2
+SIGNATURE_LINES_KEPT = 3
+
+
+def trim_message(message, quote_depth=0):
+    """Strip disclaimer paragraphs, signature blocks and '>' quotes deeper than
+    quote_depth (kept quotes are unquoted) from one message."""
+    lines = []
+    for line in message.splitlines():
+        quoted = re.match(r'^\s*((?:>\s?)+)', line)
+        depth = quoted.group(1).count('>') if quoted else 0
+        if depth > quote_depth:
+            continue
+        lines.append(line[quoted.end():].rstrip() if quoted else line.rstrip())
+    message = '\n'.join(lines)
+
+    match = SIGNATURE_PATTERN.search(message)
+    if match:
+        message = message[:match.start()]
+
+    paragraphs = re.split(r'\n\s*\n', message)
+    paragraphs = [p for p in paragraphs if not (len(p) > 80 and DISCLAIMER_PATTERN.search(p))]
+    lines = '\n\n'.join(p.strip('\n') for p in paragraphs if p.strip()).splitlines()
+
+    # Keep a bare sign-off and the name/title lines under it, drop the rest of the block
+    for i, line in enumerate(lines):
+        if SIGN_OFF_LINE_PATTERN.match(line.strip()) and is_signature_block(lines[i + 1:]):
+            lines = lines[:i + 1 + SIGNATURE_LINES_KEPT]
+            break
+    return '\n'.join(lines).strip('\n')
+
+
+def is_signature_block(lines):
+    """Short name/title/contact lines - no list items, no sentences."""
+    for line in lines:
+        line = line.strip()
+        words = line.split()
+        if (len(line) > SIGNATURE_LINE_MAX or LIST_ITEM_PATTERN.match(line)
+                or (len(words) >= 4 and line[-1] in '.?!:') or len(words) >= 8):
+            return False
+    return True
+
+
+@traced('trim_email')
+def trim_email(text, endpoint):
+    """Trim one email body for an endpoint. Returns (trimmed text, stats)."""
+    original_tokens = estimate_tokens(text or '')
+    if not INPUT_TRIMMING or not text:
+        return text, {'originalTokens': original_tokens, 'trimmedTokens': original_tokens, 'tokensSaved': 0}
+
+    starts = [0] + [m.start() for m in THREAD_SEPARATOR_PATTERN.finditer(text) if m.start() > 0]
+    starts.append(len(text))
+    messages = []
+    for a, b in zip(starts, starts[1:]):
+        # A separator followed straight by a header block ("Forwarded message"
+        # then "From:/Date:") is one boundary, not two
+        if len(messages) > 1 and len([line for line in messages[-1].splitlines() if line.strip()]) <= 1:
+            messages[-1] += text[a:b]
+        else:
+            messages.append(text[a:b])
+    # The reply's own quote of the previous message ('> ' lines) is that message
+    kept = [trim_message(m, quote_depth=n) for n, m in enumerate(messages[:THREAD_MESSAGES_KEPT])]
+    trimmed = '\n\n'.join(m for m in kept if m)
+
+    # Job numbers only mentioned further down the thread still matter for routing
+    dropped = [n for n in find_job_numbers(text) if n not in find_job_numbers(trimmed)]
+    if dropped:
+        trimmed += f"\n\n[Earlier in thread: {', '.join(dropped)}]"
+
+    budget_chars = INPUT_TOKEN_BUDGETS.get(endpoint, 4000) * 4
+    if len(trimmed) > budget_chars:
+        trimmed = trimmed[:budget_chars] + f"\n\n[... {len(trimmed) - budget_chars} characters trimmed ...]"
+
+    trimmed_tokens = estimate_tokens(trimmed)
+    stats = {
+        'originalTokens': original_tokens,
+        'trimmedTokens': trimmed_tokens,
+        'tokensSaved': max(0, original_tokens - trimmed_tokens)
+    }
+    if stats['tokensSaved']:
+        print(f"Trimmed {endpoint} input: {original_tokens} -> {trimmed_tokens} tokens")
+    return trimmed, stats
+
+
+def trim_payload(data, endpoint):
+    """Copy of a request payload with emailContent trimmed. Returns (payload, stats)."""
+    email_content, stats = trim_email(data.get('emailContent', ''), endpoint)
+    return {**data, 'emailContent': email_content}, stats
+
+
+# ===================
+# RESPONSE CACHE
+# ===================
+# Forwards and reply-all chains send /traffic and /triage near-identical
+# emails. Claude's decision for one is reused for the next when everything
+# that can change the answer (sender, job numbers, recipients, attachments)
+# matches exactly and the text is near-identical by MinHash. Only Claude's
+# output is cached - job numbers, Airtable writes and job lookups still run
+# for every request - and endpoints whose output is the content written or
+# posted for that one email are excluded outright.
+
+RESPONSE_CACHE_EXCLUDED = {'update', 'update/batch', 'feedback'}
+SUBJECT_PREFIX_PATTERN = re.compile(r'^(?:\s*(?:re|fw|fwd)\s*:\s*)+', re.IGNORECASE)
+
+# MinHash signature of MINHASH_BANDS x MINHASH_ROWS values. Two emails share
+# a band (and become candidates) with probability 1 - (1 - J^rows)^bands for
+# shingle Jaccard similarity J: ~100% at 0.9, ~64% at 0.5, ~6% at 0.25.
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{n}".encode(), digest_size=8).digest(), 'big') % (MINHASH_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f"b{n}".encode(), digest_size=8).digest(), 'big') % MINHASH_PRIME)
+    for n in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+
+def minhash(text):
+    """MinHash signature over word 3-shingles. Returns (signature, token count)."""
+    tokens = re.findall(r'\w+', text.lower())
+    shingles = {' '.join(tokens[n:n + 3]) for n in range(max(1, len(tokens) - 2))}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+              for shingle in shingles]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_PERMUTATIONS), len(tokens)
+
+
+def client_signals(text):
+    """Every hint in text of which client an email is about - client names,
+    and the client code (or, if unknown, the domain) of external addresses.
+    Near-duplicate emails only share an answer when these match."""
+    signals = {CLIENT_NAMES[name.lower()] for name in CLIENT_NAME_PATTERN.findall(text or '')}
+    signals |= client_directory.codes_named_in(text)
+    for domain in EMAIL_PATTERN.findall(text or ''):
+        domain = domain.lower()
+        if domain != INTERNAL_DOMAIN:
+            signals.add(client_directory.code_for_domain(domain) or domain)
+    return sorted(signals)
+
+
+def content_fingerprint(text, **exact):
+    """(exact key, MinHash signature, token count) for the response cache.
+    exact holds what must match exactly; text is matched by similarity."""
+    return (json.dumps(exact, sort_keys=True), *minhash(text))
+
+
+class ResponseCache:
+    """LRU cache of Claude outputs found by near-duplicate lookup.
+
+    Entries are bucketed by each band of their MinHash signature. A lookup
+    compares the entries sharing any band with it and takes the most similar
+    one at or above `similarity` (estimated Jaccard). TTLs are per endpoint;
+    an endpoint without one isn't cached."""
+
+    def __init__(self, maxsize, ttls, similarity, min_tokens):
+        excluded = RESPONSE_CACHE_EXCLUDED & {endpoint for endpoint, ttl in ttls.items() if ttl}
+        if excluded:
+            raise ValueError(f"Response cache can't reuse side-effecting endpoints: {sorted(excluded)}")
+        self.maxsize = maxsize
+        self.ttls = ttls
+        self.similarity = similarity
+        self.min_tokens = min_tokens
+        self.counts = defaultdict(lambda: {'lookups': 0, 'hits': 0, 'nearHits': 0, 'savedMs': 0.0})
+        self._entries = OrderedDict()
+        self._buckets = defaultdict(set)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _bands(self, endpoint, exact, signature):
+        return [(endpoint, exact, band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS])
+                for band in range(MINHASH_BANDS)]
+
+    def _drop(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        for bucket in self._bands(entry['endpoint'], entry['exact'], entry['signature']):
+            self._buckets[bucket].discard(entry_id)
+            if not self._buckets[bucket]:
+                del self._buckets[bucket]
+
+    def get(self, endpoint, fingerprint):
+        """The cached output for a near-duplicate, as {'content', 'model', 'ms',
+        'similarity'}, or None."""
+        if not self.ttls.get(endpoint):
+            return None
+        exact, signature, tokens = fingerprint
+        # Short emails ("thanks, approved") are only reused when identical
+        threshold = self.similarity if tokens >= self.min_tokens else 1.0
+        now = time.monotonic()
+        with self._lock:
+            counts = self.counts[endpoint]
+            counts['lookups'] += 1
+            best, best_similarity = None, 0.0
+            buckets = self._bands(endpoint, exact, signature)
+            for entry_id in set().union(*(self._buckets.get(bucket, ()) for bucket in buckets)):
+                entry = self._entries[entry_id]
+                if entry['expires'] < now:
+                    self._drop(entry_id)
+                    continue
+                similarity = sum(x == y for x, y in zip(entry['signature'], signature)) / len(signature)
+                if similarity >= threshold and similarity > best_similarity:
+                    best, best_similarity = entry_id, similarity
+            if best is None:
+                metrics.inc('dot_response_cache_lookups_total', endpoint=endpoint, result='miss')
+                return None
+            self._entries.move_to_end(best)
+            entry = self._entries[best]
+            counts['hits'] += 1
+            counts['nearHits'] += best_similarity < 1.0
+            counts['savedMs'] += entry['ms']
+        metrics.inc('dot_response_cache_lookups_total', endpoint=endpoint, result='near' if best_similarity < 1.0 else 'hit')
+        metrics.inc('dot_response_cache_saved_seconds_total', entry['ms'] / 1000, endpoint=endpoint)
+        return {'content': entry['content'], 'model': entry['model'], 'ms': entry['ms'],
+                'similarity': round(best_similarity, 3)}
+
+    def set(self, endpoint, fingerprint, content, model, ms):
+        if endpoint in RESPONSE_CACHE_EXCLUDED:
+            raise ValueError(f"Response cache can't reuse side-effecting endpoint {endpoint}")
+        if not self.ttls.get(endpoint):
+            return
+        exact, signature, _ = fingerprint
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {'endpoint': endpoint, 'exact': exact, 'signature': signature,
+                                       'content': content, 'model': model, 'ms': ms,
+                                       'expires': time.monotonic() + self.ttls[endpoint]}
+            for bucket in self._bands(endpoint, exact, signature):
+                self._buckets[bucket].add(entry_id)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            report = {'size': len(self._entries)}
+            for endpoint, counts in self.counts.items():
+                report[endpoint] = {
+                    **counts,
+                    'savedMs': round(counts['savedMs'], 1),
+                    'hitRate': round(counts['hits'] / counts['lookups'], 3) if counts['lookups'] else None
+                }
+            return report
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_SIMILARITY,
+                               RESPONSE_CACHE_MIN_TOKENS)
+
+
+def traffic_fingerprint(data):
+    """Routing depends on the sender, clients, job numbers, external recipients
+    and attachments as much as on the wording - those must match exactly."""
+    subject_line = data.get('subjectLine', '') or ''
+    email_content = data.get('emailContent', '') or ''
+    text = f"{subject_line}\n{email_content}"
+    recipients = as_list(data.get('allRecipients'))
+    attachments = as_list(data.get('attachmentNames'))
+    return content_fingerprint(
+        f"{SUBJECT_PREFIX_PATTERN.sub('', subject_line)}\n{email_content}",
+        sender=(data.get('senderEmail') or '').lower(),
+        jobNumbers=find_job_numbers(text),
+        attachmentJobNumbers=find_job_numbers('\n'.join(attachments)),
+        external=any(email_domain(r) and email_domain(r) != INTERNAL_DOMAIN for r in recipients),
+        attachments=bool(data.get('hasAttachments') or attachments),
+        wip=bool(WIP_PATTERN.search(text)),
+        triage=bool(TRIAGE_PATTERN.search(text)),
+        clients=client_signals(text)
+    )
+
+
+def cache_report(hit):
+    return {'similarity': hit['similarity'], 'model': hit['model'], 'savedMs': round(hit['ms'], 1)}
+
+
+# ===================
+# TRAFFIC ENDPOINT
+# ===================
+def traffic_message_params(data):
+    """Claude request for routing one email - shared by /traffic and offline batches."""
+    subject_line = data.get('subjectLine', '')
+    sender_email = data.get('senderEmail', '')
+    sender_name = data.get('senderName', '')
+    all_recipients = data.get('allRecipients', [])
+    has_attachments = data.get('hasAttachments', False)
+    attachment_names = data.get('attachmentNames', [])
+    
+    # Build content for Claude
+    full_content = f"""Subject: {subject_line}
+
+From: {sender_name} <{sender_email}>
+Recipients: {', '.join(all_recipients) if isinstance(all_recipients, list) else all_recipients}
+Has Attachments: {has_attachments}
+Attachment Names: {', '.join(attachment_names) if isinstance(attachment_names, list) else attachment_names}
+
+Email Body:
+{data.get('emailContent', '')}"""
+    
+    return {
+        'model': MODEL_POLICY['traffic'][-1],
+        'max_tokens': 1000,
+        'temperature': 0.1,
+        'system': TRAFFIC_SYSTEM,
+        'messages': [
+            {'role': 'user', 'content': f'Email to route:\n\n{full_content}'}
+        ]
+    }
+
+
+def fast_route_email(data):
+    """Run the fast path over a /traffic payload. None means ask Claude."""
+    if not TRAFFIC_FAST_PATH:
+        return None
+    routing = fast_route(
+        data.get('subjectLine', ''),
+        data.get('emailContent', ''),
+        data.get('senderEmail', ''),
+        data.get('senderName', ''),
+        data.get('allRecipients', []),
+        data.get('hasAttachments', False),
+        data.get('attachmentNames', [])
+    )
+    if routing:
+        routing['routedBy'] = 'fast-path'
+    return routing
+
+
+def traffic_escalation_reasons(routing):
+    """Why a cheap-tier routing answer that passed its schema still shouldn't
+    be trusted (empty = accept)."""
+    reasons = []
+    route = routing.get('route')
+    if route in ('update', 'work-to-client') and not find_job_numbers(routing.get('jobNumber') or ''):
+        reasons.append('route needs a job number')
+    if route == 'clarify' and not routing.get('clarifyEmail'):
+        reasons.append('clarify without clarifyEmail')
+    if routing.get('confidence') not in ('high', 'medium'):
+        reasons.append(f"{routing.get('confidence') or 'no'} confidence")
+    return reasons
+
+
+def ask_claude_traffic(data):
+    """Call Claude to determine routing. Returns (routing, prefetched projects, meta).
+
+    Models are tried per MODEL_POLICY['traffic'], escalating when an answer
+    fails traffic_escalation_reasons. In streaming mode the project lookup
+    for jobNumber starts the moment that field has streamed in, overlapping
+    Airtable with the rest of the generation (usually the clarifyEmail HTML).
+    meta has timings, the model that decided and any escalations."""
+    started = time.perf_counter()
+    timings = {}
+    prefetched = {}
+    lookups = {}
+    params = traffic_message_params(data)
+    
+    def send(tier_params):
+        attempt_started = time.perf_counter()
+        if not TRAFFIC_STREAMING:
+            response = client.messages.create(**tier_params)
+        else:
+            scanner = JSONFieldScanner()
+            with client.messages.stream(**tier_params) as stream:
+                for text in stream.text_stream:
+                    if 'jobNumber' in scanner.fields:
+                        continue
+                    scanner.feed(text)
+                    if 'jobNumber' in scanner.fields:
+                        timings.setdefault('jobNumberMs', round((time.perf_counter() - started) * 1000, 1))
+                        job_number = scanner.fields['jobNumber']
+                        key = normalise_job_number(job_number or '')
+                        if job_number and key not in lookups:
+                            lookups[key] = side_effect_pool.submit(in_request_context(get_project_from_airtable), job_number)
+                response = stream.get_final_message()
+        record_claude_call('traffic', tier_params, response, attempt_started)
+        return response.content[0].text, None
+    
+    routing, _, model, escalations = ask_claude_structured('traffic', params, send, traffic_escalation_reasons)
+    for key, lookup in lookups.items():
+        prefetched[key] = lookup.exception() or lookup.result()
+    
+    timings['claudeMs'] = round((time.perf_counter() - started) * 1000, 1)
+    return routing, prefetched, {'timings': timings, 'model': model, 'escalations': escalations}
+
+
+def enrich_routing(routing, prefetched=None):
+    """If job number found, validate against Airtable and enrich.
+    prefetched maps normalised job numbers to lookups already done (None = not
+    found, or the exception the lookup raised).
+    
+    jobStatus says how validation went. When Airtable is unavailable the
+    route is kept as-is rather than sent to clarify for a job that may exist."""
+    if routing.get('jobNumber'):
+        key = normalise_job_number(routing['jobNumber'])
+        try:
+            if prefetched and key in prefetched:
+                project = prefetched[key]
+                if isinstance(project, Exception):
+                    raise project
+            else:
+                project = get_project_from_airtable(routing['jobNumber'])
+        except UpstreamUnavailable as e:
+            routing['jobStatus'] = 'unavailable'
+            routing['upstreamUnavailable'] = e.upstream
+            return routing
+        
+        routing['jobStatus'] = 'found' if project else 'not_found'
+        if project:
+            # Enrich routing with project data
+            routing['jobName'] = project['jobName']
+            routing['clientName'] = project['clientName']
+            routing['currentRound'] = project['round']
+            routing['currentStage'] = project['stage']
+            routing['withClient'] = project['withClient']
+            routing['teamsChannelId'] = project['teamsChannelId']
+            routing['projectRecordId'] = project['recordId']
+        else:
+            # Job number not found - reroute to clarify
+            routing['route'] = 'clarify'
+            routing['reason'] = f"Job {routing['jobNumber']} not found in system"
+            routing['clarifyEmail'] = f"""<p>Hi {routing.get('senderName', 'there')},</p>
+<p>I couldn't find job {routing['jobNumber']} in our system.</p>
+<p>Could you double-check the job number? Or if this is a new job, just reply "Triage" and I'll set it up.</p>
+<p>Thanks,<br>Dot</p>"""
+    
+    return routing
+
+
+@app.route('/traffic', methods=['POST'])
+@idempotent('traffic')
+def traffic():
+    """Route incoming emails to the correct handler.
+    
+    Accepts additional fields and validates job numbers against Airtable.
+    """
+    try:
+        data = request.get_json()
+        
+        # Required field
+        email_content = data.get('emailContent', '')
+        if not email_content:
+            return jsonify({'error': 'No email content provided'}), 400
+        
+        data, input_trim = trim_payload(data, 'traffic')
+        
+        # Settle mechanical cases locally, only ambiguous emails go to Claude
+        routing = fast_route_email(data)
+        
+        prefetched = None
+        fingerprint = None
+        hit = None
+        if not routing:
+            # Reuse the routing Claude gave a near-identical email
+            fingerprint = traffic_fingerprint(data)
+            hit = response_cache.get('traffic', fingerprint)
+        if hit:
+            routing = json.loads(hit['content'])
+            routing['routedBy'] = 'cache'
+            routing['senderName'] = data.get('senderName', routing.get('senderName'))
+            routing['model'] = hit['model']
+            routing['cache'] = cache_report(hit)
+        elif not routing:
+            # Call Claude to determine routing - its reply comes back validated
+            routing, prefetched, meta = ask_claude_traffic(data)
+            # Only answers the escalation checks would accept are worth reusing
+            if not traffic_escalation_reasons(routing):
+                response_cache.set('traffic', fingerprint, json.dumps(routing), meta['model'],
+                                   meta['timings']['claudeMs'])
+            routing['routedBy'] = 'claude'
+            routing['model'] = meta['model']
+            routing['timings'] = meta['timings']
+            if meta['escalations']:
+                routing['escalations'] = meta['escalations']
         
-        return jsonify(routing)
+        routing['inputTrim'] = input_trim
+        return jsonify(enrich_routing(routing, prefetched))
         
-    except json.JSONDecodeError as e:
+    except UpstreamUnavailable as e:
+        record_error('traffic', e)
+        return upstream_unavailable(e)
+    except InvalidOutput as e:
+        record_error('traffic', e)
         return jsonify({
             'error': 'Claude returned invalid JSON',
             'details': str(e),
-            'raw_response': content
+            'raw_response': e.raw
         }), 500
     except Exception as e:
+        record_error('traffic', e)
         return jsonify({
             'error': 'Internal server error',
             'details': str(e)
@@ -404,12 +3619,86 @@ Email Body:
 # ===================
 # TRIAGE ENDPOINT
 # ===================
+
+def triage_message_params(email_content):
+    """Claude request for triaging one email - shared by /triage and offline batches."""
+    return {
+        'model': MODEL_POLICY['triage'][-1],
+        'max_tokens': 2000,
+        'temperature': 0.2,
+        'system': TRIAGE_SYSTEM,
+        'messages': [
+            {'role': 'user', 'content': f'Email content:\n\n{email_content}'}
+        ]
+    }
+
+
+def ask_claude_triage(email_content):
+    """Call Claude with the Triage prompt per MODEL_POLICY['triage'].
+    Returns (analysis, model), validated against the triage schema."""
+    params = triage_message_params(email_content)
+    
+    def send(tier_params):
+        started = time.perf_counter()
+        response = client.messages.create(**tier_params)
+        record_claude_call('triage', tier_params, response, started)
+        return response.content[0].text, None
+    
+    analysis, _, model, _ = ask_claude_structured('triage', params, send)
+    return analysis, model
+
+
+def triage_analysis(email_content, subject_line=''):
+    """Claude's triage analysis, reused for a near-duplicate brief.
+    Returns (analysis, cache hit or None)."""
+    # The analysis picks the client, and the job number and Projects record
+    # follow from it - so the client signals must match, not just the wording
+    text = f"{subject_line}\n{email_content}"
+    fingerprint = content_fingerprint(email_content, jobNumbers=find_job_numbers(text), clients=client_signals(text))
+    hit = response_cache.get('triage', fingerprint)
+    if hit:
+        return json.loads(hit['content']), hit
+    started = time.perf_counter()
+    analysis, model = ask_claude_triage(email_content)
+    if not analysis.get('error'):
+        response_cache.set('triage', fingerprint, json.dumps(analysis), model, (time.perf_counter() - started) * 1000)
+    return analysis, None
+
+
+def assign_job_number(analysis):
+    """Get job number and client info from Airtable for a triage analysis.
+    Returns job_number, team_id, sharepoint_url, client_record_id."""
+    client_code = analysis.get('clientCode', 'TBC')
+    if client_code not in ['HUN', 'TBC']:
+        return get_job_info_from_airtable(client_code)
+    return f'{client_code} TBC', None, None, None
+
+
+def needs_job_record(job_number):
+    return bool(job_number) and 'TBC' not in job_number
+
+
+def triage_result(analysis, job_number, team_id, sharepoint_url, job_record_id):
+    """Complete analysis with job info, as returned by /triage."""
+    return {
+        'jobNumber': job_number,
+        'jobName': analysis.get('jobName', 'Untitled'),
+        'clientCode': analysis.get('clientCode', 'TBC'),
+        'clientName': analysis.get('clientName', ''),
+        'projectOwner': analysis.get('projectOwner', ''),
+        'teamId': team_id,
+        'sharepointUrl': sharepoint_url,
+        'jobRecordId': job_record_id,
+        'emailBody': analysis.get('emailBody', ''),
+        'fullAnalysis': analysis
+    }
+
+
 @app.route('/triage', methods=['POST'])
+@idempotent('triage')
+@queueable('triage', required_fields('emailContent'))
 def triage():
-    """Process new job triage.
-    
-    UNCHANGED - keeping exactly as it was since it works.
-    """
+    """Process new job triage."""
     try:
         data = request.get_json()
         email_content = data.get('emailContent', '')
@@ -417,65 +3706,47 @@ def triage():
         if not email_content:
             return jsonify({'error': 'No email content provided'}), 400
         
-        # Call Claude with Triage prompt
-        response = client.messages.create(
-            model='claude-sonnet-4-20250514',
-            max_tokens=2000,
-            temperature=0.2,
-            system=TRIAGE_PROMPT,
-            messages=[
-                {'role': 'user', 'content': f'Email content:\n\n{email_content}'}
-            ]
-        )
+        email_content, input_trim = trim_email(email_content, 'triage')
         
-        # Parse Claude's JSON response
-        content = response.content[0].text
-        content = strip_markdown_json(content)
-        analysis = json.loads(content)
+        # Call Claude with Triage prompt (or reuse a near-identical brief's analysis)
+        analysis, hit = triage_analysis(email_content, data.get('subjectLine', ''))
         
         # Get job number and client info from Airtable
-        client_code = analysis.get('clientCode', 'TBC')
-        if client_code not in ['HUN', 'TBC']:
-            job_number, team_id, sharepoint_url, client_record_id = get_job_info_from_airtable(client_code)
-        else:
-            job_number = f'{client_code} TBC'
-            team_id = None
-            sharepoint_url = None
-            client_record_id = None
+        job_number, team_id, sharepoint_url, client_record_id = assign_job_number(analysis)
         
         # Create job record in Airtable
         job_record_id = None
-        if job_number and 'TBC' not in job_number:
+        if needs_job_record(job_number):
             job_record_id = create_job_in_airtable(
                 job_number=job_number,
                 job_name=analysis.get('jobName', 'Untitled'),
-                client_code=client_code,
+                client_code=analysis.get('clientCode', 'TBC'),
                 description=analysis.get('jobSummary', ''),
                 project_owner=analysis.get('projectOwner', 'TBC'),
                 client_record_id=client_record_id
             )
         
         # Return complete analysis with job info
-        return jsonify({
-            'jobNumber': job_number,
-            'jobName': analysis.get('jobName', 'Untitled'),
-            'clientCode': client_code,
-            'clientName': analysis.get('clientName', ''),
-            'projectOwner': analysis.get('projectOwner', ''),
-            'teamId': team_id,
-            'sharepointUrl': sharepoint_url,
-            'jobRecordId': job_record_id,
-            'emailBody': analysis.get('emailBody', ''),
-            'fullAnalysis': analysis
-        })
+        result = triage_result(analysis, job_number, team_id, sharepoint_url, job_record_id)
+        # jobRecordId is null while the create waits in the write journal
+        result['jobRecordQueued'] = AIRTABLE_WRITE_BEHIND and needs_job_record(job_number) and not job_record_id
+        result['inputTrim'] = input_trim
+        if hit:
+            result['cache'] = cache_report(hit)
+        return jsonify(result)
         
-    except json.JSONDecodeError as e:
+    except UpstreamUnavailable as e:
+        record_error('triage', e)
+        return upstream_unavailable(e)
+    except InvalidOutput as e:
+        record_error('triage', e)
         return jsonify({
             'error': 'Claude returned invalid JSON',
             'details': str(e),
-            'raw_response': content
+            'raw_response': e.raw
         }), 500
     except Exception as e:
+        record_error('triage', e)
         return jsonify({
             'error': 'Internal server error',
             'details': str(e)
@@ -485,7 +3756,69 @@ def triage():
 # ===================
 # UPDATE ENDPOINT
 # ===================
+
+def update_message_params(job_number, project, email_content):
+    """Claude request for one job update - shared by /update and offline batches."""
+    # Build content for Claude
+    update_content = f"""Job Number: {job_number}
+Client Name: {project['clientName']}
+Current Stage: {project['stage']}
+Email/Message Content:
+{email_content}"""
+    
+    return {
+        'model': MODEL_POLICY['update'][-1],
+        'max_tokens': 1500,
+        'temperature': 0.2,
+        'system': UPDATE_SYSTEM,
+        'messages': [
+            {'role': 'user', 'content': update_content}
+        ]
+    }
+
+
+def ask_claude_update(job_number, project, email_content):
+    """Call Claude with the Update prompt per MODEL_POLICY['update'].
+    Returns the analysis, validated against the update schema."""
+    params = update_message_params(job_number, project, email_content)
+    
+    def send(tier_params):
+        started = time.perf_counter()
+        response = client.messages.create(**tier_params)
+        record_claude_call('update', tier_params, response, started)
+        return response.content[0].text, None
+    
+    return ask_claude_structured('update', params, send)[0]
+
+
+def planned_update_writes(analysis):
+    """What an update analysis should write to Airtable.
+    Returns update_text, update_due, project_fields."""
+    # Get the update text
+    update_text = analysis.get('airtableUpdate', '')
+    
+    # Get due date from analysis - if not specified the Updates record defaults to 5 working days
+    project_updates = analysis.get('projectUpdates') or {}
+    update_due = project_updates.get('Update due') or None
+    
+    # Remove 'Update' and 'Update due' from project updates - those go to Updates table
+    project_fields = {k: v for k, v in project_updates.items()
+                      if k not in ['Update', 'Update due']}
+    
+    return update_text, update_due, project_fields
+
+
+def job_not_found(job_number):
+    return {
+        'error': 'job_not_found',
+        'jobNumber': job_number,
+        'message': f"Could not find job {job_number} in the system"
+    }
+
+
 @app.route('/update', methods=['POST'])
+@idempotent('update')
+@queueable('update', required_fields('jobNumber', 'emailContent'))
 def update():
     """Process job updates.
     
@@ -508,87 +3841,1032 @@ def update():
         project = get_project_from_airtable(job_number)
         
         if not project:
-            return jsonify({
-                'error': 'job_not_found',
-                'jobNumber': job_number,
-                'message': f"Could not find job {job_number} in the system"
-            }), 404
-        
-        # Build content for Claude
-        update_content = f"""Job Number: {job_number}
-Client Name: {project['clientName']}
-Current Stage: {project['stage']}
-Email/Message Content:
-{email_content}"""
+            return jsonify(job_not_found(job_number)), 404
         
-        # Call Claude with Update prompt
-        response = client.messages.create(
-            model='claude-sonnet-4-20250514',
-            max_tokens=1500,
-            temperature=0.2,
-            system=UPDATE_PROMPT,
-            messages=[
-                {'role': 'user', 'content': update_content}
-            ]
-        )
+        email_content, input_trim = trim_email(email_content, 'update')
         
-        # Parse Claude's JSON response
-        content = response.content[0].text
-        content = strip_markdown_json(content)
-        analysis = json.loads(content)
+        # Call Claude with Update prompt
+        analysis = ask_claude_update(job_number, project, email_content)
         
         # Check for errors from Claude
         if analysis.get('error'):
             return jsonify(analysis), 400
         
-        # Get the update text
-        update_text = analysis.get('airtableUpdate', '')
+        update_text, update_due, project_fields = planned_update_writes(analysis)
         
-        # Get due date from analysis, or default to 5 working days
-        update_due = None
-        if analysis.get('projectUpdates', {}).get('Update due'):
-            update_due = analysis['projectUpdates']['Update due']
-        # If no due date specified, create_update_in_airtable will default to 5 working days
+        # The two writes hit different tables and both use the record id in hand,
+        # so neither depends on the other and they run concurrently
+        steps = {}
         
         # Create the update record in Updates table
-        update_created = False
         if update_text:
-            update_created = create_update_in_airtable(
+            steps['createUpdate'] = (lambda _: create_update_in_airtable(
                 project_record_id=project['recordId'],
                 update_text=update_text,
                 update_due=update_due
-            )
+            ), [])
         
         # Update Project fields if needed (Stage, Status, Live Date, With Client)
-        project_updated = False
-        if analysis.get('projectUpdates'):
-            # Remove 'Update' and 'Update due' from project updates - those go to Updates table
-            project_fields = {k: v for k, v in analysis['projectUpdates'].items() 
-                           if k not in ['Update', 'Update due']}
-            if project_fields:
-                project_updated = update_project_fields_in_airtable(job_number, project_fields)
+        if project_fields:
+            steps['updateProject'] = (lambda _: update_project_fields_in_airtable(
+                job_number, project_fields, record_id=project['recordId']
+            ), [])
+        
+        results, timings = run_side_effects(steps)
         
         # Add results to response
-        analysis['updateCreated'] = update_created
-        analysis['projectUpdated'] = project_updated
+        # Queued writes are durable but not in Airtable yet - the flusher sends them
+        analysis['updateCreated'] = bool(results.get('createUpdate', False))
+        analysis['projectUpdated'] = bool(results.get('updateProject', False))
+        analysis['timings'] = timings
+        analysis['writesQueued'] = 'queued' in results.values()
+        analysis['inputTrim'] = input_trim
         analysis['teamsChannelId'] = project['teamsChannelId']
         analysis['projectRecordId'] = project['recordId']
         
         return jsonify(analysis)
         
-    except json.JSONDecodeError as e:
+    except UpstreamUnavailable as e:
+        record_error('update', e)
+        return upstream_unavailable(e)
+    except InvalidOutput as e:
+        record_error('update', e)
         return jsonify({
             'error': 'Claude returned invalid JSON',
             'details': str(e),
-            'raw_response': content
+            'raw_response': e.raw
+        }), 500
+    except Exception as e:
+        record_error('update', e)
+        return jsonify({
+            'error': 'Internal server error',
+            'details': str(e)
+        }), 500
+
+
+# ===================
+# ATTACHMENT EXTRACTION
+# ===================
+# Feedback lives in Word comments, tracked changes and PDF margin notes as
+# much as in the email. Uploads are spooled to disk rather than held in
+# memory, .docx XML is parsed as it decompresses, PDFs are read a page at a
+# time, and body text stops at FEEDBACK_EXTRACT_MAX_CHARS. Results are cached
+# by content hash - the same deck often comes back from several reviewers.
+
+EXTRACTOR_VERSION = 1
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+TEXT_EXTENSIONS = {'.txt', '.md', '.csv', '.eml', '.htm', '.html'}
+READ_CHUNK = 1024 * 1024
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+# Comments and tracked changes kept per attachment, and characters of the
+# text a comment is anchored to
+EXTRACT_MAX_ITEMS = 2000
+ANCHOR_MAX_CHARS = 200
+
+# PDF annotations that carry a reviewer's note in /Contents
+PDF_NOTE_SUBTYPES = {'/Text', '/FreeText', '/Highlight', '/Underline', '/StrikeOut', '/Squiggly', '/Caret',
+                     '/Square', '/Circle', '/Line', '/Polygon', '/PolyLine'}
+
+
+class AttachmentRejected(Exception):
+    """An attachment the endpoint won't take - too many or too big."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def stream_digest(stream):
+    """sha256 of a seekable file, read in chunks, leaving it rewound."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(READ_CHUNK), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def spool_base64(encoded):
+    """Decode base64 into a temp file a chunk at a time (spills to disk past 1MB).
+    Whitespace anywhere (MIME line breaks) is skipped; anything else that
+    isn't base64 raises ValueError."""
+    spooled = tempfile.SpooledTemporaryFile(max_size=READ_CHUNK)
+    step = READ_CHUNK // 3 * 4
+    carry = ''
+    try:
+        # Chunks are cut at multiples of 4 once whitespace is gone - the
+        # remainder carries into the next one
+        for start in range(0, len(encoded), step):
+            chunk = carry + WHITESPACE_PATTERN.sub('', encoded[start:start + step])
+            usable = len(chunk) - len(chunk) % 4
+            spooled.write(base64.b64decode(chunk[:usable], validate=True))
+            carry = chunk[usable:]
+        if carry:
+            raise ValueError('truncated base64')
+    except ValueError:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled
+
+
+def request_attachments(data):
+    """Attachments from a multipart upload, or from the JSON 'attachments'
+    list as {name, contentBytes} (the shape Power Automate's Outlook
+    connector sends; contentBase64 also accepted). Returns
+    [{'name', 'stream', 'size'}]."""
+    attachments = []
+    if request.files:
+        for _, upload in request.files.items(multi=True):
+            attachments.append({'name': upload.filename or 'attachment', 'stream': upload.stream})
+    else:
+        items = data.get('attachments') or []
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            name = item.get('name') or item.get('Name') or 'attachment'
+            encoded = item.get('contentBytes') or item.get('ContentBytes') or item.get('contentBase64') or ''
+            if not isinstance(encoded, str):
+                raise AttachmentRejected(f"{name} is not base64 encoded", 400)
+            if len(encoded) * 3 // 4 > FEEDBACK_MAX_ATTACHMENT_BYTES:
+                raise AttachmentRejected(f"{name} is over {FEEDBACK_MAX_ATTACHMENT_BYTES} bytes", 413)
+            try:
+                attachments.append({'name': name, 'stream': spool_base64(encoded)})
+            except ValueError as e:
+                for attachment in attachments:
+                    attachment['stream'].close()
+                raise AttachmentRejected(f"{name} is not valid base64 ({e})", 400) from e
+    
+    if len(attachments) > FEEDBACK_MAX_ATTACHMENTS:
+        raise AttachmentRejected(f"At most {FEEDBACK_MAX_ATTACHMENTS} attachments per request", 400)
+    for attachment in attachments:
+        stream = attachment['stream']
+        stream.seek(0, os.SEEK_END)
+        attachment['size'] = stream.tell()
+        stream.seek(0)
+        if attachment['size'] > FEEDBACK_MAX_ATTACHMENT_BYTES:
+            raise AttachmentRejected(f"{attachment['name']} is over {FEEDBACK_MAX_ATTACHMENT_BYTES} bytes", 413)
+    return attachments
+
+
+def attachment_kind(name, stream):
+    """'docx', 'pdf', 'text' or 'unsupported' - by content first, then extension."""
+    head = stream.read(8)
+    stream.seek(0)
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head.startswith(b'PK'):
+        try:
+            with zipfile.ZipFile(stream) as archive:
+                is_docx = 'word/document.xml' in archive.namelist()
+        except zipfile.BadZipFile:
+            is_docx = False
+        stream.seek(0)
+        return 'docx' if is_docx else 'unsupported'
+    if os.path.splitext(name.lower())[1] in TEXT_EXTENSIONS:
+        return 'text'
+    return 'unsupported'
+
+
+def extraction(text='', comments=None, changes=None, pages=None, truncated=False, notes=None):
+    return {'text': text, 'comments': comments or [], 'changes': changes or [], 'pages': pages,
+            'truncated': truncated, 'notes': notes or []}
+
+
+def parse_docx_comments(xml):
+    """Comments from word/comments.xml as [{'id', 'author', 'text'}]."""
+    comments = []
+    parts = None
+    for event, elem in ET.iterparse(xml, events=('start', 'end')):
+        if elem.tag == WORD_NS + 'comment':
+            if event == 'start':
+                parts = []
+                continue
+            comments.append({'id': elem.get(WORD_NS + 'id'), 'author': elem.get(WORD_NS + 'author', ''),
+                             'text': ''.join(parts).strip()})
+            parts = None
+            elem.clear()
+            if len(comments) >= EXTRACT_MAX_ITEMS:
+                break
+        elif event == 'end' and parts is not None:
+            if elem.tag == WORD_NS + 't':
+                parts.append(elem.text or '')
+            elif elem.tag == WORD_NS + 'p':
+                parts.append('\n')
+    return comments
+
+
+def parse_docx_body(xml):
+    """One pass over word/document.xml. Returns the body text, tracked
+    changes (with the paragraph they sit in) and, by comment id, the text
+    each comment is anchored to - in document order.
+
+    Each top-level block is dropped once read, so memory stays flat however
+    long the document is."""
+    paragraphs = []
+    text_chars = 0
+    truncated = False
+    paragraph = []
+    changes = []
+    awaiting_context = []
+    revisions = []
+    anchors = {}
+    open_anchors = set()
+    body = None
+    body_depth = None
+    depth = 0
+    
+    for event, elem in ET.iterparse(xml, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            depth += 1
+            if tag == WORD_NS + 'body':
+                body, body_depth = elem, depth
+            elif tag in (WORD_NS + 'ins', WORD_NS + 'del'):
+                kind = 'inserted' if tag == WORD_NS + 'ins' else 'deleted'
+                revisions.append((kind, elem.get(WORD_NS + 'author', ''), []))
+            elif tag == WORD_NS + 'commentRangeStart':
+                open_anchors.add(elem.get(WORD_NS + 'id'))
+                anchors.setdefault(elem.get(WORD_NS + 'id'), [])
+            elif tag == WORD_NS + 'commentRangeEnd':
+                open_anchors.discard(elem.get(WORD_NS + 'id'))
+            continue
+        
+        depth -= 1
+        if tag in (WORD_NS + 't', WORD_NS + 'delText'):
+            piece = elem.text or ''
+            if revisions:
+                revisions[-1][2].append(piece)
+            if tag == WORD_NS + 't':
+                paragraph.append(piece)
+                for comment_id in open_anchors:
+                    if sum(map(len, anchors[comment_id])) < ANCHOR_MAX_CHARS:
+                        anchors[comment_id].append(piece)
+        elif tag == WORD_NS + 'tab':
+            paragraph.append('\t')
+        elif tag in (WORD_NS + 'br', WORD_NS + 'cr'):
+            paragraph.append('\n')
+        elif tag in (WORD_NS + 'ins', WORD_NS + 'del') and revisions:
+            kind, author, parts = revisions.pop()
+            changed = ''.join(parts).strip()
+            if changed and len(changes) < EXTRACT_MAX_ITEMS:
+                changes.append({'type': kind, 'author': author, 'text': changed})
+                awaiting_context.append(changes[-1])
+        elif tag == WORD_NS + 'p':
+            line = ''.join(paragraph).strip()
+            paragraph = []
+            for change in awaiting_context:
+                change['context'] = line[:ANCHOR_MAX_CHARS]
+            awaiting_context = []
+            if line and not truncated:
+                if text_chars + len(line) > FEEDBACK_EXTRACT_MAX_CHARS:
+                    truncated = True
+                else:
+                    paragraphs.append(line)
+                    text_chars += len(line) + 1
+        
+        if body is not None and depth == body_depth:
+            body.clear()
+    
+    anchors = {comment_id: ''.join(parts).strip()[:ANCHOR_MAX_CHARS] for comment_id, parts in anchors.items()}
+    return '\n'.join(paragraphs), changes, anchors, truncated
+
+
+def extract_docx(stream):
+    """Body text, comments (with the text they're anchored to) and tracked
+    changes from a Word document. Members are decompressed as they're parsed."""
+    with zipfile.ZipFile(stream) as docx:
+        comments = []
+        if 'word/comments.xml' in docx.namelist():
+            with docx.open('word/comments.xml') as xml:
+                comments = parse_docx_comments(xml)
+        with docx.open('word/document.xml') as xml:
+            text, changes, anchors, truncated = parse_docx_body(xml)
+    
+    # Document order, so the summary can follow the document top to bottom
+    position = {comment_id: n for n, comment_id in enumerate(anchors)}
+    comments.sort(key=lambda comment: position.get(comment['id'], len(position)))
+    for comment in comments:
+        anchor = anchors.get(comment.pop('id'))
+        if anchor:
+            comment['anchor'] = anchor
+    return extraction(text, comments, changes, truncated=truncated)
+
+
+def extract_pdf(stream):
+    """Page text and annotation notes from a PDF, one page at a time. Ink
+    (handwritten) marks can't be read, so their pages are flagged instead."""
+    reader = pypdf.PdfReader(stream)
+    page_count = len(reader.pages)
+    texts = []
+    text_chars = 0
+    truncated = page_count > FEEDBACK_MAX_PDF_PAGES
+    comments = []
+    ink_pages = []
+    unnoted_marks = 0
+    
+    for number, page in enumerate(reader.pages, 1):
+        if number > FEEDBACK_MAX_PDF_PAGES:
+            break
+        # Annotations are cheap - keep reading them after the text budget is spent
+        if text_chars < FEEDBACK_EXTRACT_MAX_CHARS:
+            text = (page.extract_text() or '').strip()
+            if text:
+                text = text[:FEEDBACK_EXTRACT_MAX_CHARS - text_chars]
+                texts.append(f"[Page {number}]\n{text}")
+                text_chars += len(text)
+                truncated = truncated or text_chars >= FEEDBACK_EXTRACT_MAX_CHARS
+        
+        for annotation in page.get('/Annots') or []:
+            annotation = annotation.get_object()
+            subtype = annotation.get('/Subtype')
+            if subtype == '/Ink':
+                if number not in ink_pages:
+                    ink_pages.append(number)
+                continue
+            if subtype not in PDF_NOTE_SUBTYPES:
+                continue
+            contents = str(annotation.get('/Contents') or '').strip()
+            if not contents:
+                unnoted_marks += 1
+                continue
+            if len(comments) < EXTRACT_MAX_ITEMS:
+                comments.append({'author': str(annotation.get('/T') or ''), 'text': contents, 'page': number,
+                                 'mark': subtype.lstrip('/')})
+    
+    notes = []
+    if ink_pages:
+        notes.append(f"Handwritten marks on page(s) {', '.join(map(str, ink_pages))} - needs manual review")
+    if unnoted_marks:
+        notes.append(f"{unnoted_marks} highlight/strike-through mark(s) with no note")
+    if page_count > FEEDBACK_MAX_PDF_PAGES:
+        notes.append(f"Only the first {FEEDBACK_MAX_PDF_PAGES} of {page_count} pages were read")
+    return extraction('\n\n'.join(texts), comments, pages=page_count, truncated=truncated, notes=notes)
+
+
+def extract_text_file(stream):
+    raw = stream.read(FEEDBACK_EXTRACT_MAX_CHARS * 4)
+    text = raw.decode('utf-8', errors='replace')
+    truncated = len(text) > FEEDBACK_EXTRACT_MAX_CHARS or bool(stream.read(1))
+    return extraction(text[:FEEDBACK_EXTRACT_MAX_CHARS].strip(), truncated=truncated)
+
+
+EXTRACTORS = {
+    'docx': extract_docx,
+    'pdf': extract_pdf,
+    'text': extract_text_file
+}
+
+
+class ExtractionCache:
+    """Attachment extractions by content hash, shared by every worker via
+    SQLite and bounded to the most recently used max_entries."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        conn = open_db()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS attachment_extracts (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )""")
+        finally:
+            conn.close()
+
+    def get(self, digest):
+        key = f"{EXTRACTOR_VERSION}:{digest}"
+        conn = open_db()
+        try:
+            row = conn.execute('SELECT result FROM attachment_extracts WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                conn.execute('UPDATE attachment_extracts SET used_at = ? WHERE key = ?', (time.time(), key))
+        finally:
+            conn.close()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row['result'])
+
+    def set(self, digest, result):
+        conn = open_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO attachment_extracts (key, result, used_at) VALUES (?, ?, ?)',
+                         (f"{EXTRACTOR_VERSION}:{digest}", json.dumps(result), time.time()))
+            conn.execute("""DELETE FROM attachment_extracts WHERE key NOT IN (
+                SELECT key FROM attachment_extracts ORDER BY used_at DESC LIMIT ?)""", (self.max_entries,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / lookups, 3) if lookups else None
+        }
+
+
+extraction_cache = ExtractionCache(EXTRACTION_CACHE_MAX_ENTRIES)
+
+
+def extract_attachment(attachment):
+    """Extraction for one attachment, from the cache when the same file has
+    been seen before. Unreadable files come back with a note, not an error."""
+    stream = attachment['stream']
+    digest = stream_digest(stream)
+    extracted = extraction_cache.get(digest)
+    cached = extracted is not None
+    if not cached:
+        kind = attachment_kind(attachment['name'], stream)
+        with span('extract', kind=kind):
+            if kind == 'unsupported':
+                extracted = extraction(notes=['File type not read - check it manually'])
+            elif kind == 'pdf' and not PDF_AVAILABLE:
+                extracted = extraction(notes=['PDF not read (pypdf is not installed) - check it manually'])
+            else:
+                try:
+                    extracted = EXTRACTORS[kind](stream)
+                except Exception as e:
+                    print(f"Error extracting {attachment['name']}: {e}")
+                    record_error('extract', e)
+                    extracted = extraction(notes=[f"Couldn't read this file ({type(e).__name__}) - check it manually"])
+        extracted['kind'] = kind
+        if kind != 'pdf' or PDF_AVAILABLE:
+            extraction_cache.set(digest, extracted)
+    return {'name': attachment['name'], 'bytes': attachment['size'], 'cached': cached, **extracted}
+
+
+def render_attachment(extracted):
+    """Prompt text for one attachment - notes, comments and tracked changes
+    first, then the document text, so trimming cuts the text before the feedback."""
+    pages = f", {extracted['pages']} pages" if extracted['pages'] else ''
+    lines = [f"=== ATTACHMENT: {extracted['name']} ({extracted['kind']}{pages}) ==="]
+    lines += [f"[Note: {note}]" for note in extracted['notes']]
+    if extracted['comments']:
+        lines.append('Comments:')
+        for comment in extracted['comments']:
+            where = f" (page {comment['page']})" if comment.get('page') else ''
+            on = f" [on: \"{comment['anchor']}\"]" if comment.get('anchor') else ''
+            lines.append(f"- {comment['author'] or 'Unknown'}{where}: {comment['text']}{on}")
+    if extracted['changes']:
+        lines.append('Tracked changes:')
+        for change in extracted['changes']:
+            context = f" [in: \"{change['context']}\"]" if change.get('context') else ''
+            lines.append(f"- {change['author'] or 'Unknown'} {change['type']}: \"{change['text']}\"{context}")
+    if extracted['text']:
+        lines.append('Document text:')
+        lines.append(extracted['text'])
+    return '\n'.join(lines)
+
+
+def fit_to_budget(sections, budget_chars):
+    """Share budget_chars between sections. Short sections are kept whole
+    and the rest are cut to an equal share of what's left."""
+    fitted = list(sections)
+    remaining = budget_chars
+    order = sorted(range(len(sections)), key=lambda n: len(sections[n]))
+    for position, n in enumerate(order):
+        share = remaining // (len(order) - position)
+        if len(sections[n]) > share:
+            fitted[n] = sections[n][:share] + f"\n[... {len(sections[n]) - share} characters trimmed ...]"
+        remaining -= min(len(sections[n]), share)
+    return fitted
+
+
+def attachment_report(extracted):
+    """What was read from one attachment, for the /feedback response."""
+    return {
+        'name': extracted['name'],
+        'kind': extracted['kind'],
+        'bytes': extracted['bytes'],
+        'pages': extracted['pages'],
+        'comments': len(extracted['comments']),
+        'trackedChanges': len(extracted['changes']),
+        'truncated': extracted['truncated'],
+        'cached': extracted['cached'],
+        'notes': extracted['notes']
+    }
+
+
+# ===================
+# FEEDBACK ENDPOINT
+# ===================
+
+def feedback_message_params(job_number, project, data, email_content, attachment_sections):
+    """Claude request for one feedback summary."""
+    feedback_content = f"""Job Number: {job_number}
+Client Name: {project['clientName']}
+Current Stage: {project['stage']}
+Current Round: {project['round']}
+From: {data.get('senderName') or data.get('senderEmail') or 'Unknown'}
+Subject: {data.get('subjectLine', '')}
+Email/Message Content:
+{email_content}
+
+{(chr(10) * 2).join(attachment_sections) or 'No attachments'}"""
+    
+    return {
+        'model': MODEL_POLICY['feedback'][-1],
+        'max_tokens': 4000,
+        'temperature': 0.2,
+        'system': FEEDBACK_SYSTEM,
+        'messages': [
+            {'role': 'user', 'content': feedback_content}
+        ]
+    }
+
+
+def feedback_escalation_reasons(content):
+    """The summary is free text for Teams - only an empty one is rejected."""
+    return [] if content.strip() else ['empty summary']
+
+
+def ask_claude_feedback(job_number, project, data, email_content, attachment_sections):
+    """Call Claude with the Feedback prompt per MODEL_POLICY['feedback'].
+    Returns the Teams summary text."""
+    params = feedback_message_params(job_number, project, data, email_content, attachment_sections)
+    
+    def attempt(model):
+        tier_params = {**params, 'model': model}
+        started = time.perf_counter()
+        response = client.messages.create(**tier_params)
+        record_claude_call('feedback', tier_params, response, started)
+        return response.content[0].text.strip(), None
+    
+    return run_model_policy('feedback', attempt, feedback_escalation_reasons)[0]
+
+
+def feedback_counts(summary):
+    """Item counts and effort from the summary's header lines, when present."""
+    counts = {}
+    match = re.search(r'(\d+)\s*Clear\s*\|\s*(\d+)\s*Ambiguous\s*\|\s*(\d+)\s*Question', summary, re.IGNORECASE)
+    if match:
+        counts['clear'], counts['ambiguous'], counts['questions'] = map(int, match.groups())
+    match = re.search(r'Estimated effort:\s*(.+)', summary)
+    if match:
+        counts['estimatedEffort'] = match.group(1).strip()
+    return counts
+
+
+@app.route('/feedback', methods=['POST'])
+@idempotent('feedback')
+def feedback():
+    """Summarise feedback on a job from the email and its attachments.
+    
+    Takes JSON with base64 attachments, or multipart/form-data with the
+    attachments as files. Nothing is written to Airtable.
+    """
+    attachments = []
+    try:
+        data = request.get_json(silent=True) if request.is_json else request.form.to_dict()
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Expected a JSON object or form fields'}), 400
+        
+        # Required fields
+        job_number = data.get('jobNumber')
+        email_content = data.get('emailContent', '')
+        
+        if not job_number:
+            return jsonify({'error': 'No job number provided'}), 400
+        
+        attachments = request_attachments(data)
+        if not email_content and not attachments:
+            return jsonify({'error': 'No email content or attachments provided'}), 400
+        
+        project = get_project_from_airtable(job_number)
+        
+        if not project:
+            return jsonify(job_not_found(job_number)), 404
+        
+        email_content, input_trim = trim_email(email_content, 'feedback')
+        
+        # Extract each attachment, then share the budget between them
+        extracted = [extract_attachment(attachment) for attachment in attachments]
+        sections = [render_attachment(item) for item in extracted]
+        fitted = fit_to_budget(sections, FEEDBACK_ATTACHMENT_BUDGET * 4)
+        input_trim['attachmentTokens'] = estimate_tokens(''.join(sections))
+        input_trim['attachmentTokensSent'] = estimate_tokens(''.join(fitted))
+        
+        summary = ask_claude_feedback(job_number, project, data, email_content, fitted)
+        
+        return jsonify({
+            'jobNumber': job_number,
+            'summary': summary,
+            **feedback_counts(summary),
+            'attachments': [attachment_report(item) for item in extracted],
+            'inputTrim': input_trim,
+            'teamsChannelId': project['teamsChannelId'],
+            'projectRecordId': project['recordId']
+        })
+        
+    except AttachmentRejected as e:
+        return jsonify({'error': 'attachment_rejected', 'message': str(e)}), e.status
+    except UpstreamUnavailable as e:
+        record_error('feedback', e)
+        return upstream_unavailable(e)
+    except Exception as e:
+        record_error('feedback', e)
+        return jsonify({
+            'error': 'Internal server error',
+            'details': str(e)
         }), 500
+    finally:
+        for attachment in attachments:
+            attachment['stream'].close()
+
+
+# ===================
+# BATCH ENDPOINTS
+# ===================
+# Backlog replays (e.g. after a Power Automate outage) send a list of emails.
+# Claude calls run with bounded concurrency, then the Airtable writes for the
+# whole batch are coalesced into AIRTABLE_BATCH_SIZE-record requests.
+
+def get_batch_items(data):
+    """Accept either a bare list of emails or {'emails': [...]}."""
+    items = data.get('emails') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return None, ({'error': 'No emails provided'}, 400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, ({'error': f'Too many emails - max {BATCH_MAX_ITEMS} per batch'}, 400)
+    return items, None
+
+
+def run_bounded(fn, items):
+    """Map fn over items with at most BATCH_CONCURRENCY running at once."""
+    with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch') as pool:
+        return list(pool.map(in_request_context(fn), items))
+
+
+def claude_error(e, where):
+    record_error(where, e)
+    if isinstance(e, UpstreamUnavailable):
+        return {'status': 503, 'error': 'upstream_unavailable', 'upstream': e.upstream, 'message': str(e)}
+    if isinstance(e, InvalidOutput):
+        return {'status': 500, 'error': 'Claude returned invalid JSON', 'details': str(e), 'raw_response': e.raw}
+    return {'status': 500, 'error': 'Internal server error', 'details': str(e)}
+
+
+def analyse_triage_item(item):
+    """Claude analysis and job number for one batch email - no record created yet."""
+    email_content = item.get('emailContent', '') if isinstance(item, dict) else ''
+    if not email_content:
+        return {'status': 400, 'error': 'No email content provided'}
+    
+    email_content, input_trim = trim_email(email_content, 'triage')
+    try:
+        analysis, _ = triage_analysis(email_content, item.get('subjectLine', ''))
+    except Exception as e:
+        return claude_error(e, 'triage/batch')
+    
+    return {**triage_item(analysis), 'inputTrim': input_trim}
+
+
+def triage_item(analysis):
+    """Allocate the job number for a parsed triage analysis (batch item form)."""
+    try:
+        job_number, team_id, sharepoint_url, client_record_id = assign_job_number(analysis)
+    except UpstreamUnavailable as e:
+        return claude_error(e, 'triage/batch')
+    return {
+        'status': 200,
+        'analysis': analysis,
+        'jobNumber': job_number,
+        'teamId': team_id,
+        'sharepointUrl': sharepoint_url,
+        'clientRecordId': client_record_id
+    }
+
+
+@app.route('/triage/batch', methods=['POST'])
+@idempotent('triage/batch')
+@queueable('triage/batch', lambda data: get_batch_items(data)[1])
+def triage_batch():
+    """Triage a list of new job emails. Results are reported per item, in order."""
+    items, error = get_batch_items(request.get_json())
+    if error:
+        return jsonify(error[0]), error[1]
+    
+    analysed = run_bounded(analyse_triage_item, items)
+    return jsonify({'results': finish_triage_batch(analysed)})
+
+
+def finish_triage_batch(analysed, conn=None):
+    """Create the Projects records for analysed triage items and shape per-item results.
+    Given conn, the creates are queued in the caller's transaction instead of sent."""
+    # One Projects create per 10 new jobs instead of one per job
+    to_create = [i for i, item in enumerate(analysed)
+                 if item['status'] == 200 and needs_job_record(item['jobNumber'])]
+    record_ids = {}
+    if to_create and AIRTABLE_API_KEY:
+        fields_list = [build_job_fields(
+            job_number=analysed[i]['jobNumber'],
+            job_name=analysed[i]['analysis'].get('jobName', 'Untitled'),
+            description=analysed[i]['analysis'].get('jobSummary', ''),
+            project_owner=analysed[i]['analysis'].get('projectOwner', 'TBC'),
+            client_record_id=analysed[i]['clientRecordId']
+        ) for i in to_create]
+        record_ids = dict(zip(to_create, create_records_in_batches(AIRTABLE_JOBS_TABLE, fields_list, conn=conn)))
+        for i in to_create:
+            project_cache.invalidate(normalise_job_number(analysed[i]['jobNumber']))
+    
+    results = []
+    for i, item in enumerate(analysed):
+        if item['status'] != 200:
+            results.append({'index': i, **item})
+            continue
+        result = triage_result(item['analysis'], item['jobNumber'], item['teamId'],
+                               item['sharepointUrl'], record_ids.get(i) or None)
+        # jobRecordId is null while the create waits in the write journal
+        result['jobRecordQueued'] = i in record_ids and record_ids[i] is None
+        if 'inputTrim' in item:
+            result['inputTrim'] = item['inputTrim']
+        results.append({'index': i, 'status': 200, **result})
+    
+    return results
+
+
+def analyse_update_item(item):
+    """Project lookup and Claude analysis for one batch update - nothing written yet."""
+    item = item if isinstance(item, dict) else {}
+    job_number = item.get('jobNumber')
+    email_content = item.get('emailContent', '')
+    if not job_number:
+        return {'status': 400, 'error': 'No job number provided'}
+    if not email_content:
+        return {'status': 400, 'error': 'No email content provided'}
+    
+    try:
+        project = get_project_from_airtable(job_number)
+    except UpstreamUnavailable as e:
+        return claude_error(e, 'update/batch')
+    if not project:
+        return {'status': 404, **job_not_found(job_number)}
+    
+    email_content, input_trim = trim_email(email_content, 'update')
+    try:
+        analysis = ask_claude_update(job_number, project, email_content)
+    except Exception as e:
+        return claude_error(e, 'update/batch')
+    
+    return {**update_item(job_number, project, analysis), 'inputTrim': input_trim}
+
+
+def update_item(job_number, project, analysis):
+    """Batch item form of a parsed update analysis."""
+    if analysis.get('error'):
+        return {'status': 400, **analysis}
+    return {'status': 200, 'jobNumber': job_number, 'project': project, 'analysis': analysis}
+
+
+@app.route('/update/batch', methods=['POST'])
+@idempotent('update/batch')
+@queueable('update/batch', lambda data: get_batch_items(data)[1])
+def update_batch():
+    """Process a list of job updates. Results are reported per item, in order."""
+    items, error = get_batch_items(request.get_json())
+    if error:
+        return jsonify(error[0]), error[1]
+    
+    analysed = run_bounded(analyse_update_item, items)
+    results, timings = finish_update_batch(analysed)
+    return jsonify({'results': results, 'timings': timings})
+
+
+def finish_update_batch(analysed, conn=None):
+    """Write Updates/Project changes for analysed update items and shape per-item results.
+    Given conn, the writes are queued in the caller's transaction instead of sent."""
+    # Plan every write up front, coalescing Project PATCHes per record (later emails win)
+    update_creates = []
+    project_patches = {}
+    project_updated = {}
+    for i, item in enumerate(analysed):
+        if item['status'] != 200:
+            continue
+        update_text, update_due, project_fields = planned_update_writes(item['analysis'])
+        record_id = item['project']['recordId']
+        if update_text:
+            update_creates.append((i, build_update_fields(record_id, update_text, update_due)))
+        if not project_fields:
+            continue
+        patch_fields = build_project_fields(project_fields)
+        if not patch_fields:
+            # Matches /update - all-null projectUpdates count as done
+            project_updated[i] = bool(AIRTABLE_API_KEY)
+            continue
+        patch = project_patches.setdefault(record_id, {'fields': {}, 'items': [], 'jobNumber': item['jobNumber']})
+        patch['fields'].update(patch_fields)
+        patch['items'].append(i)
+    
+    # Updates creates and Project PATCHes hit different tables - run them side by side
+    steps = {}
+    if update_creates and AIRTABLE_API_KEY:
+        steps['createUpdates'] = (lambda _: create_records_in_batches(
+            AIRTABLE_UPDATES_TABLE, [fields for _, fields in update_creates], conn=conn
+        ), [])
+    if project_patches and AIRTABLE_API_KEY:
+        steps['updateProjects'] = (lambda _: update_records_in_batches(
+            AIRTABLE_JOBS_TABLE, [(record_id, patch['fields']) for record_id, patch in project_patches.items()],
+            conn=conn
+        ), [])
+    if conn is None:
+        writes, timings = run_side_effects(steps)
+    else:
+        # Only queueing - and a SQLite connection stays on its own thread
+        writes, timings = {name: fn({}) for name, (fn, _) in steps.items()}, {}
+    
+    update_created = {}
+    writes_queued = set()
+    for (i, _), record_id in zip(update_creates, writes.get('createUpdates', [])):
+        update_created[i] = record_id is not False
+        if record_id is None:
+            writes_queued.add(i)
+    
+    for patch, status in zip(project_patches.values(), writes.get('updateProjects', [])):
+        if status:
+            apply_project_fields_to_cache(patch['jobNumber'], patch['fields'])
+        for i in patch['items']:
+            project_updated[i] = bool(status)
+            if status == 'queued':
+                writes_queued.add(i)
+    
+    results = []
+    for i, item in enumerate(analysed):
+        if item['status'] != 200:
+            results.append({'index': i, **item})
+            continue
+        analysis = item['analysis']
+        analysis['updateCreated'] = update_created.get(i, False)
+        analysis['projectUpdated'] = project_updated.get(i, False)
+        analysis['writesQueued'] = i in writes_queued
+        if 'inputTrim' in item:
+            analysis['inputTrim'] = item['inputTrim']
+        analysis['teamsChannelId'] = item['project']['teamsChannelId']
+        analysis['projectRecordId'] = item['project']['recordId']
+        results.append({'index': i, 'status': 200, **analysis})
+    
+    return results, timings
+
+
+# ===================
+# WIP ENDPOINT
+# ===================
+
+def parse_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    return str(value).lower() in ('true', '1', 'yes')
+
+
+def wip_project(fields, latest_update):
+    return {
+        'jobNumber': fields.get('Job Number', ''),
+        'jobName': fields.get('Project Name', ''),
+        'stage': fields.get('Stage', ''),
+        'status': fields.get('Status', ''),
+        'withClient': fields.get('With Client?', False),
+        'liveDate': fields.get('Live Date', None),
+        'projectOwner': fields.get('Project Owner', ''),
+        'update': latest_update.get('Update', ''),
+        'updateDue': latest_update.get('Update due', None),
+        'updatedOn': latest_update.get('Updated on', None)
+    }
+
+
+@app.route('/wip', methods=['GET', 'POST'])
+def wip():
+    """Work In Progress report, served from the local project snapshot.
+    
+    Filters come from query params or a JSON body (e.g. Traffic's wip routing):
+    clientCode, stage, status, withClient, includeCompleted.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        params = {**data, **request.args.to_dict()}
+        
+        client_code = params.get('clientCode') or None
+        filters = {
+            'clientCode': client_code.upper() if client_code else None,
+            'stage': params.get('stage') or None,
+            'status': params.get('status') or None,
+            'withClient': parse_bool(params.get('withClient'))
+        }
+        include_completed = parse_bool(params.get('includeCompleted')) or filters['status'] == 'Completed'
+        
+        if not AIRTABLE_API_KEY:
+            return jsonify({'error': 'No Airtable API key configured'}), 503
+        
+        project_snapshot.refresh()
+        
+        projects = [wip_project(fields, latest_update)
+                    for _, fields, latest_update in project_snapshot.query(**filters)
+                    if include_completed or fields.get('Status') != 'Completed']
+        projects.sort(key=lambda project: project['jobNumber'])
+        
+        return jsonify({
+            'clientCode': filters['clientCode'],
+            'count': len(projects),
+            'projects': projects,
+            'snapshot': project_snapshot.stats()
+        })
+        
     except Exception as e:
+        record_error('wip', e)
         return jsonify({
             'error': 'Internal server error',
             'details': str(e)
         }), 500
 
 
+# ===================
+# METRICS ENDPOINT
+# ===================
+# Every request is timed into dot_request_seconds. Send ?timings=1 (or an
+# X-Dot-Timings: 1 header) to get the request's spans back as "timingBreakdown".
+
+def wants_breakdown():
+    return parse_bool(request.args.get('timings') or request.headers.get('X-Dot-Timings'))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.trace_token = current_trace.set([] if wants_breakdown() else None)
+    if RECORDING_PATH and request.url_rule and request.url_rule.rule in RECORDED_ENDPOINTS:
+        g.recording_token = current_recording.set([])
+
+
+@app.after_request
+def finish_request_timer(response):
+    elapsed = time.perf_counter() - g.request_started
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('dot_request_seconds', elapsed, endpoint=rule, method=request.method, status=response.status_code)
+    
+    exchanges = current_recording.get()
+    # A queued job is recorded when it runs, not when it's accepted
+    if exchanges is not None and not g.get('job_queued'):
+        try:
+            write_recording(request.get_json(silent=True), exchanges, response.status_code,
+                            response.get_json(silent=True), elapsed)
+        except Exception as e:
+            print(f"Error writing recording: {e}")
+            record_error('recording', e)
+    
+    trace = current_trace.get()
+    if trace is not None and response.is_json:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict):
+            body['timingBreakdown'] = {'totalMs': round(elapsed * 1000, 1), 'spans': list(trace)}
+            response.set_data(app.json.dumps(body))
+    return response
+
+
+@app.teardown_request
+def reset_request_trace(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        current_trace.reset(token)
+    token = g.pop('recording_token', None)
+    if token is not None:
+        current_recording.reset(token)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint for this worker process."""
+    cache = project_cache.stats()
+    journal = write_journal.stats()
+    breakers = {name: breaker.stats() for name, breaker in upstream_breakers.items()}
+    jobs = job_queue.stats()
+    body = metrics.render([
+        *[('dot_circuit_state', {'upstream': name}, CircuitBreaker.STATES[stats['state']])
+          for name, stats in breakers.items()],
+        *[('dot_circuit_opens_total', {'upstream': name}, stats['opens']) for name, stats in breakers.items()],
+        *[('dot_circuit_rejected_total', {'upstream': name}, stats['rejected']) for name, stats in breakers.items()],
+        ('dot_project_cache_lookups_total', {'result': 'hit'}, cache['hits']),
+        ('dot_project_cache_lookups_total', {'result': 'miss'}, cache['misses']),
+        ('dot_idempotent_replays_total', {}, idempotency_store.replays),
+        ('dot_extraction_cache_lookups_total', {'result': 'hit'}, extraction_cache.hits),
+        ('dot_extraction_cache_lookups_total', {'result': 'miss'}, extraction_cache.misses),
+        ('dot_write_journal_flushed_total', {}, journal['flushed']),
+        ('dot_write_journal_retries_total', {}, journal['retries']),
+        *[('dot_write_journal_entries', {'state': state}, journal[state]) for state in ('pending', 'sending', 'failed')],
+        ('dot_write_journal_oldest_pending_seconds', {}, journal['oldestPendingSeconds'] or 0),
+        *[('dot_jobs', {'state': state}, jobs[state]) for state in ('queued', 'running', 'done', 'failed')],
+        ('dot_job_oldest_queued_seconds', {}, jobs['oldestQueuedSeconds'] or 0),
+        *[('dot_job_callbacks', {'state': state}, count) for state, count in jobs['callbacks'].items()],
+        ('dot_job_worker_threads', {}, jobs['workerThreads'])
+    ])
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
 # ===================
 # HEALTH CHECK
 # ===================
@@ -598,10 +4876,31 @@ def health():
     return jsonify({
         'status': 'healthy',
         'service': 'Dot Main',
-        'endpoints': ['/traffic', '/triage', '/update', '/health']
+        'endpoints': ['/traffic', '/triage', '/update', '/feedback', '/triage/batch', '/update/batch', '/wip', '/jobs/<id>', '/metrics', '/health'],
+        'projectCache': project_cache.stats(),
+        'claudeUsage': claude_usage_stats(),
+        'models': model_stats_report(),
+        'clientDirectory': client_directory.stats(),
+        'responseCache': response_cache.stats(),
+        'extractionCache': extraction_cache.stats(),
+        'idempotentReplays': idempotency_store.replays,
+        'writeJournal': write_journal.stats(),
+        'jobQueue': job_queue.stats(),
+        'upstreams': upstream_stats()
     })
 
 
+# Start flushing the write journal and loading the client directory once
+# everything they call is defined
+if AIRTABLE_API_KEY:
+    write_journal.start()
+    client_directory.start()
+
+# Job threads in the web process - worker.py runs them in their own process
+job_queue.start(JOB_QUEUE_WORKERS)
+
+
+# Local development only - production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
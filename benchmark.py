@@ -0,0 +1,516 @@
+"""Offline benchmark and load test - no real Anthropic or Airtable needed.
+
+Starts a fake Anthropic Messages API (canned JSON, configurable latency,
+streaming included) and a fake Airtable REST API (the filterByFormula
+lookups, creates and patches app.py makes), boots the app against them,
+drives /traffic, /triage and /update at a fixed concurrency and reports
+p50/p95/p99 latency and throughput per endpoint.
+
+    python benchmark.py --requests 300 --concurrency 20
+    python benchmark.py --claude-latency 2 --airtable-latency 0.2 --out before.json
+    python benchmark.py --baseline before.json
+
+--mix weights the endpoints (default traffic=2,triage=1,update=1, wip also
+accepted). --canned CANNED.json overrides the fake Claude reply per kind,
+in the same format as offline_batch.py --stub. --server picks gunicorn
+(the production setup) or the Flask dev server; --url skips starting the
+app and benchmarks one that is already pointed at the fakes.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import httpx
+
+CLIENT_CODES = ['ONE', 'SKY', 'TOW', 'FIS', 'FST', 'WKA', 'LAB']
+CLIENT_DOMAINS = {'ONE': 'one.nz', 'SKY': 'sky.co.nz', 'TOW': 'tower.co.nz', 'FIS': 'fisherfunds.co.nz',
+                  'FST': 'firestop.co.nz', 'WKA': 'whakarongorau.nz', 'LAB': 'labour.org.nz'}
+PROJECTS_PER_CLIENT = 40
+JOB_NUMBER_PATTERN = re.compile(r'\b([A-Z]{3})[ _](\d{3})\b')
+
+
+# ===================
+# FAKE SERVERS
+# ===================
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(handler, state):
+    """Serve handler on a free localhost port in a daemon thread. Returns the server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def sleep_for(latency, jitter):
+    time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+
+def default_reply(kind, prompt):
+    """Plausible canned output for each prompt, keyed off the request text."""
+    match = JOB_NUMBER_PATTERN.search(prompt)
+    job_number = f"{match.group(1)} {match.group(2)}" if match else None
+    client_code = job_number.split()[0] if job_number else random.choice(CLIENT_CODES)
+
+    if kind == 'traffic':
+        return {
+            'route': 'update' if job_number else 'triage',
+            'jobNumber': job_number,
+            'clientCode': client_code,
+            'senderEmail': 'someone@example.com',
+            'senderName': 'Someone',
+            'reason': 'Benchmark reply',
+            'confidence': 'high'
+        }
+    if kind == 'triage':
+        return {
+            'clientCode': client_code,
+            'clientName': client_code,
+            'projectOwner': 'TBC',
+            'jobName': 'Benchmark job',
+            'jobSummary': 'A job created by the benchmark harness.',
+            'emailBody': '<b>Client:</b> Benchmark<br>'
+        }
+    return {
+        'jobNumber': job_number,
+        'clientName': client_code,
+        'updateTypes': ['stage'],
+        'airtableUpdate': 'Moved to Craft',
+        'teamsPost': '<p><b>UPDATE | Moved to Craft</b></p>',
+        'projectUpdates': {'Update': 'Moved to Craft', 'Stage': 'Craft', 'Status': None,
+                           'Live Date': None, 'Update due': None, 'With Client?': None},
+        'source': 'email'
+    }
+
+
+class FakeAnthropicHandler(QuietHandler):
+    """POST /v1/messages - answers with canned JSON, streamed as SSE when asked.
+
+    Prompt caching is imitated: the first call with a given system prompt
+    writes the cache, later ones read it."""
+
+    def do_POST(self):
+        body = self.read_json()
+        text, usage, latency = self.reply(body)
+        self.send_message(body, text, usage, latency)
+
+    def reply(self, body):
+        """(reply text, usage, latency seconds) for one Messages request."""
+        state = self.server.state
+        system = ''.join(block.get('text', '') for block in body.get('system') or [] if isinstance(block, dict))
+        kind = next((k for k in ('traffic', 'triage', 'update') if f'Dot {k.title()}' in system), 'traffic')
+        prompt = json.dumps(body.get('messages', []))
+        text = json.dumps(state['canned'].get(kind) or default_reply(kind, prompt))
+
+        with state['lock']:
+            cached = system in state['cached_systems']
+            state['cached_systems'].add(system)
+        usage = {
+            'input_tokens': len(prompt) // 4,
+            'output_tokens': len(text) // 4,
+            'cache_creation_input_tokens': 0 if cached else len(system) // 4,
+            'cache_read_input_tokens': len(system) // 4 if cached else 0
+        }
+        return text, usage, state['latency'] + random.uniform(-state['jitter'], state['jitter'])
+
+    def send_message(self, body, text, usage, latency):
+        """Answer as the Messages API would - SSE events when body asks to stream."""
+        message = {'id': f"msg_bench_{time.time_ns()}", 'type': 'message', 'role': 'assistant',
+                   'model': body.get('model'), 'stop_reason': 'end_turn', 'stop_sequence': None}
+        if not body.get('stream'):
+            time.sleep(max(0.0, latency))
+            return self.send_json({**message, 'content': [{'type': 'text', 'text': text}], 'usage': usage})
+
+        # Time to first token, then the rest of the latency spread over the chunks
+        chunks = [text[n:n + 40] for n in range(0, len(text), 40)] or ['']
+        events = [('message_start', {'type': 'message_start', 'message': {
+            **message, 'content': [], 'stop_reason': None, 'usage': {**usage, 'output_tokens': 1}}}),
+            ('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                     'content_block': {'type': 'text', 'text': ''}})]
+        events += [('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                            'delta': {'type': 'text_delta', 'text': chunk}}) for chunk in chunks]
+        events += [('content_block_stop', {'type': 'content_block_stop', 'index': 0}),
+                   ('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                      'usage': {'output_tokens': usage['output_tokens']}}),
+                   ('message_stop', {'type': 'message_stop'})]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(max(0.0, latency * 0.2))
+        for name, data in events:
+            if name == 'content_block_delta':
+                time.sleep(max(0.0, latency * 0.8 / len(chunks)))
+            payload = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(payload):x}\r\n".encode('ascii') + payload + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class FakeAirtableHandler(QuietHandler):
+    """The slice of the Airtable REST API app.py uses: filtered list, single
+    and batch create, single and batch patch. Tables live in server.state."""
+
+    def route(self):
+        parsed = urlparse(self.path)
+        parts = [unquote(part) for part in parsed.path.split('/') if part]
+        # /v0/<base>/<table>[/<record id>]
+        return parts[2], (parts[3] if len(parts) > 3 else None), parse_qs(parsed.query)
+
+    def matches(self, record, formula):
+        if not formula:
+            return True
+        equals = re.fullmatch(r"\{(.+?)\}='(.*)'", formula)
+        if equals:
+            return str(record['fields'].get(equals.group(1))) == equals.group(2)
+        after = re.fullmatch(r"IS_AFTER\(LAST_MODIFIED_TIME\(\), '(.+)'\)", formula)
+        if after:
+            return record['modified'] > after.group(1)
+        return True
+
+    def save(self, table, record_id, fields, create):
+        state = self.server.state
+        records = state['tables'].setdefault(table, {})
+        if create:
+            state['next_id'] += 1
+            record_id = f"recBench{state['next_id']:07d}"
+            records[record_id] = {'id': record_id, 'fields': {}}
+        records[record_id]['fields'].update(fields)
+        records[record_id]['modified'] = datetime.now(timezone.utc).isoformat()
+        return {'id': record_id, 'fields': records[record_id]['fields']}
+
+    def do_GET(self):
+        table, record_id, query = self.route()
+        self.respond('GET', table, record_id, query, None)
+
+    def do_POST(self):
+        table, record_id, query = self.route()
+        self.respond('POST', table, record_id, query, self.read_json())
+
+    def do_PATCH(self):
+        table, record_id, query = self.route()
+        self.respond('PATCH', table, record_id, query, self.read_json())
+
+    def respond(self, method, table, record_id, query, body):
+        state = self.server.state
+        sleep_for(state['latency'], state['jitter'])
+        status, payload = self.apply(method, table, record_id, query, body)
+        self.send_json(payload, status)
+
+    def apply(self, method, table, record_id, query, body):
+        """Apply one request to the in-memory tables. Returns (status, body)."""
+        state = self.server.state
+        with state['lock']:
+            if method == 'GET' and record_id:
+                record = state['tables'].get(table, {}).get(record_id)
+                if record is None:
+                    return 404, {'error': 'NOT_FOUND'}
+                return 200, {'id': record_id, 'fields': dict(record['fields'])}
+            if method == 'GET':
+                formula = query.get('filterByFormula', [None])[0]
+                return 200, {'records': [{'id': r['id'], 'fields': dict(r['fields'])}
+                                         for r in state['tables'].get(table, {}).values() if self.matches(r, formula)]}
+            create = method == 'POST'
+            if 'records' in body:
+                return 200, {'records': [self.save(table, r.get('id'), r['fields'], create) for r in body['records']]}
+            if not create and record_id not in state['tables'].get(table, {}):
+                return 404, {'error': 'NOT_FOUND'}
+            return 200, self.save(table, record_id, body['fields'], create)
+
+
+def seed_tables():
+    """Clients with job number counters, plus PROJECTS_PER_CLIENT projects each."""
+    now = datetime.now(timezone.utc).isoformat()
+    clients = {}
+    projects = {}
+    for code in CLIENT_CODES:
+        clients[f"rec{code}"] = {'id': f"rec{code}", 'modified': now, 'fields': {
+            'Client code': code, 'Clients': code, 'Next #': PROJECTS_PER_CLIENT + 1,
+            'Teams ID': f"team-{code.lower()}", 'Sharepoint ID': f"https://sharepoint.example/{code}"}}
+        for n in range(1, PROJECTS_PER_CLIENT + 1):
+            record_id = f"rec{code}{n:03d}"
+            projects[record_id] = {'id': record_id, 'modified': now, 'fields': {
+                'Job Number': f"{code} {n:03d}", 'Project Name': f"{code} project {n}", 'Client': [code],
+                'Stage': 'Craft', 'Status': 'In Progress', 'With Client?': False,
+                'Teams Channel ID': f"channel-{code.lower()}-{n:03d}"}}
+    return {'Clients': clients, 'Projects': projects, 'Updates': {}}
+
+
+# ===================
+# LOAD GENERATION
+# ===================
+
+def random_job_number():
+    return f"{random.choice(CLIENT_CODES)} {random.randint(1, PROJECTS_PER_CLIENT):03d}"
+
+
+def make_payload(endpoint, n):
+    """A unique email for endpoint - the sequence number keeps idempotency replays out of the numbers."""
+    code = random.choice(CLIENT_CODES)
+    sender = f"client{n}@{CLIENT_DOMAINS[code]}"
+    if endpoint == 'traffic':
+        job_number = random_job_number()
+        shapes = [
+            # Job number in the subject - usually settled by the fast path
+            {'subjectLine': f"{job_number} - latest", 'emailContent': f"Moving this along. Ref {n}",
+             'senderEmail': f"pm{n}@hunch.co.nz", 'allRecipients': ['dot@hunch.co.nz']},
+            # No job number - goes to Claude
+            {'subjectLine': 'Quick question', 'emailContent': f"Can you help with something for us? Ref {n}",
+             'senderEmail': sender, 'allRecipients': ['dot@hunch.co.nz']},
+            # Job number buried in a forwarded chain - goes to Claude and streams the lookup
+            {'subjectLine': 'Fwd: thoughts', 'emailContent': f"See below re {job_number}, thoughts? Ref {n}",
+             'senderEmail': sender, 'allRecipients': ['dot@hunch.co.nz', f"pm@{CLIENT_DOMAINS[code]}"]},
+        ]
+        return {'senderName': 'Bench', 'hasAttachments': False, 'attachmentNames': [], **random.choice(shapes)}
+    if endpoint == 'triage':
+        return {'emailContent': f"New brief from {sender}: please quote a campaign refresh. Ref {n}",
+                'senderEmail': sender}
+    if endpoint == 'update':
+        return {'jobNumber': random_job_number(), 'emailContent': f"Please move this to Craft. Ref {n}",
+                'senderEmail': f"pm{n}@hunch.co.nz"}
+    return {'clientCode': code}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_load(base_url, mix, total, concurrency, timeout):
+    """Send total requests spread over mix, concurrency at a time. Returns per-request samples."""
+    endpoints = [endpoint for endpoint, weight in mix.items() for _ in range(weight)]
+    plan = [(n, random.choice(endpoints)) for n in range(total)]
+    samples = []
+    lock = threading.Lock()
+
+    with httpx.Client(base_url=base_url, timeout=timeout,
+                      limits=httpx.Limits(max_connections=concurrency)) as http:
+        def send(item):
+            n, endpoint = item
+            payload = make_payload(endpoint, n)
+            started = time.perf_counter()
+            try:
+                if endpoint == 'wip':
+                    response = http.get('/wip', params=payload)
+                else:
+                    response = http.post(f'/{endpoint}', json=payload)
+                status = response.status_code
+                body = response.json() if status < 500 else {}
+            except httpx.HTTPError as e:
+                status, body = type(e).__name__, {}
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples.append({'endpoint': endpoint, 'status': status, 'seconds': elapsed,
+                                'routedBy': body.get('routedBy') if isinstance(body, dict) else None})
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(send, plan))
+        wall = time.perf_counter() - started
+    return samples, wall
+
+
+def summarise(samples, wall):
+    """Latency percentiles (ms) and throughput per endpoint, plus an 'all' row."""
+    report = {}
+    groups = {'all': samples}
+    for sample in samples:
+        groups.setdefault(sample['endpoint'], []).append(sample)
+    for endpoint, group in groups.items():
+        latencies = sorted(sample['seconds'] * 1000 for sample in group)
+        routed = {}
+        for sample in group:
+            if sample['routedBy']:
+                routed[sample['routedBy']] = routed.get(sample['routedBy'], 0) + 1
+        report[endpoint] = {
+            'requests': len(group),
+            'errors': sum(1 for sample in group if not isinstance(sample['status'], int) or sample['status'] >= 500),
+            'rps': round(len(group) / wall, 2) if wall else None,
+            'meanMs': round(sum(latencies) / len(latencies), 1),
+            'p50Ms': round(percentile(latencies, 50), 1),
+            'p95Ms': round(percentile(latencies, 95), 1),
+            'p99Ms': round(percentile(latencies, 99), 1),
+            'maxMs': round(latencies[-1], 1),
+            **({'routedBy': routed} if routed else {})
+        }
+    return report
+
+
+def print_report(report, baseline=None):
+    columns = ['requests', 'errors', 'rps', 'meanMs', 'p50Ms', 'p95Ms', 'p99Ms', 'maxMs']
+    print(f"{'endpoint':<10}" + ''.join(f"{column:>10}" for column in columns))
+    for endpoint, row in report.items():
+        print(f"{endpoint:<10}" + ''.join(f"{row[column]:>10}" for column in columns))
+        before = (baseline or {}).get(endpoint)
+        if before:
+            deltas = []
+            for column in columns[2:]:
+                if before.get(column):
+                    deltas.append(f"{(row[column] - before[column]) / before[column] * 100:+.0f}%")
+                else:
+                    deltas.append('-')
+            print(f"{'  vs base':<10}{'':>10}{'':>10}" + ''.join(f"{delta:>10}" for delta in deltas))
+        if row.get('routedBy'):
+            print(f"{'':<10}routedBy {row['routedBy']}")
+
+
+# ===================
+# APP UNDER TEST
+# ===================
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(server, env, port):
+    """Boot the app in a subprocess and wait for /health."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    if server == 'gunicorn':
+        command = ['gunicorn', 'app:app', '-c', 'gunicorn.conf.py', '-b', f"127.0.0.1:{port}",
+                   '--access-logfile', '/dev/null']
+    else:
+        command = [sys.executable, 'app.py']
+    process = subprocess.Popen(command, cwd=here, env={**os.environ, **env, 'PORT': str(port)},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"App exited during startup (code {process.returncode})")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    sys.exit("App did not become healthy within 30s")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        endpoint, _, weight = part.partition('=')
+        if endpoint not in ('traffic', 'triage', 'update', 'wip'):
+            sys.exit(f"Unknown endpoint in --mix: {endpoint}")
+        mix[endpoint] = int(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests to send (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests in flight (default: 10)')
+    parser.add_argument('--warmup', type=int, default=20, help='requests sent and discarded first (default: 20)')
+    parser.add_argument('--mix', default='traffic=2,triage=1,update=1', help='endpoint weights')
+    parser.add_argument('--claude-latency', type=float, default=1.0, help='seconds per fake Claude call')
+    parser.add_argument('--claude-jitter', type=float, default=0.2)
+    parser.add_argument('--airtable-latency', type=float, default=0.1, help='seconds per fake Airtable call')
+    parser.add_argument('--airtable-jitter', type=float, default=0.03)
+    parser.add_argument('--canned', metavar='CANNED.json', help='fixed Claude reply per kind')
+    parser.add_argument('--server', choices=['gunicorn', 'flask'],
+                        default='gunicorn' if shutil.which('gunicorn') else 'flask')
+    parser.add_argument('--url', help='benchmark an app that is already running instead of starting one')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='write the report as JSON, for use as a later --baseline')
+    parser.add_argument('--baseline', help='compare against a report written by --out')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    canned = {}
+    if args.canned:
+        with open(args.canned, 'r') as f:
+            canned = json.load(f)
+
+    anthropic = start_server(FakeAnthropicHandler, {
+        'latency': args.claude_latency, 'jitter': args.claude_jitter, 'canned': canned,
+        'cached_systems': set(), 'lock': threading.Lock()})
+    airtable = start_server(FakeAirtableHandler, {
+        'latency': args.airtable_latency, 'jitter': args.airtable_jitter, 'tables': seed_tables(),
+        'next_id': 0, 'lock': threading.Lock()})
+    print(f"Fake Anthropic at {server_url(anthropic)}, fake Airtable at {server_url(airtable)}/v0")
+
+    process = None
+    base_url = args.url
+    data_dir = tempfile.mkdtemp(prefix='dot-bench-')
+    if not base_url:
+        process, base_url = start_app(args.server, {
+            'ANTHROPIC_BASE_URL': server_url(anthropic),
+            'ANTHROPIC_API_KEY': 'bench',
+            'AIRTABLE_API_URL': f"{server_url(airtable)}/v0",
+            'AIRTABLE_API_KEY': 'bench',
+            'DOT_DATA_DIR': data_dir
+        }, free_port())
+        print(f"Started app ({args.server}) at {base_url}")
+
+    try:
+        mix = parse_mix(args.mix)
+        if args.warmup:
+            run_load(base_url, mix, args.warmup, args.concurrency, args.timeout)
+        samples, wall = run_load(base_url, mix, args.requests, args.concurrency, args.timeout)
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = summarise(samples, wall)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['report']
+    print(f"\n{args.requests} requests at concurrency {args.concurrency} in {wall:.1f}s "
+          f"(claude {args.claude_latency}s, airtable {args.airtable_latency}s)\n")
+    print_report(report, baseline)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'settings': vars(args), 'wallSeconds': round(wall, 2), 'report': report}, f, indent=2)
+        print(f"\nWrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
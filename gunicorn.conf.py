@@ -0,0 +1,22 @@
+"""Gunicorn config for Railway.
+
+Claude and Airtable calls are blocking I/O, so each worker process runs a
+pool of threads - a slow Sonnet call only ties up its own thread instead of
+queueing the rest of a Power Automate burst behind it.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# Processes x threads = emails that can be in flight at once
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 25))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+# Sonnet calls can take a while - don't let gunicorn kill a busy worker
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
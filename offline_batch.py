@@ -0,0 +1,333 @@
+"""Offline Message Batches mode for backlog replays and nightly reprocessing.
+
+Routing, triage and update jobs go through Claude's Message Batches API
+(half price, and no load on the live endpoints) instead of one synchronous
+call each. Once the batch has ended the Airtable side effects are applied,
+exactly once, using the same code as /triage/batch and /update/batch.
+
+    python offline_batch.py submit jobs.jsonl
+    python offline_batch.py poll <batch_id> [--wait]
+    python offline_batch.py apply <batch_id> [--out results.jsonl]
+
+Each line of jobs.jsonl is {"kind": "traffic" | "triage" | "update", ...}
+with the rest of the line being the payload the matching endpoint takes.
+Pass --stub CANNED.json to run submit/poll/apply against StubBatchClient,
+which answers every request with the canned reply for its kind, e.g.
+{"triage": {"clientCode": "ONE", ...}, "update": {...}, "traffic": {...}}.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import app
+
+BATCH_DIR = os.path.join(app.DOT_DATA_DIR, 'batches')
+KINDS = ['traffic', 'triage', 'update']
+
+
+# ===================
+# BATCH STATE
+# ===================
+
+def state_path(batch_id):
+    return os.path.join(BATCH_DIR, f"{batch_id}.json")
+
+
+def load_state(batch_id):
+    if not os.path.exists(state_path(batch_id)):
+        sys.exit(f"No local state for batch {batch_id}")
+    with open(state_path(batch_id), 'r') as f:
+        return json.load(f)
+
+
+def save_state(state):
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    with open(state_path(state['batchId']), 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def open_applied_db():
+    """dot.db, where applied jobs are recorded alongside the write journal
+    rows they queued."""
+    conn = app.open_db()
+    conn.execute("""CREATE TABLE IF NOT EXISTS offline_batch_applied (
+        batch_id TEXT NOT NULL,
+        custom_id TEXT NOT NULL,
+        result TEXT NOT NULL,
+        applied_at REAL NOT NULL,
+        PRIMARY KEY (batch_id, custom_id)
+    )""")
+    return conn
+
+
+def load_applied(conn, batch_id):
+    rows = conn.execute("SELECT custom_id, result FROM offline_batch_applied WHERE batch_id = ?",
+                        (batch_id,)).fetchall()
+    return {row['custom_id']: json.loads(row['result']) for row in rows}
+
+
+# ===================
+# STUB CLIENT
+# ===================
+
+class StubBatchClient:
+    """Local stand-in for client.beta.messages.batches.
+
+    Batches end as soon as they are created and every request succeeds with
+    the canned reply for its kind. State is kept on disk so submit, poll and
+    apply can run as separate commands."""
+
+    def __init__(self, canned):
+        self.canned = canned
+
+    def _path(self, batch_id):
+        return os.path.join(BATCH_DIR, f"{batch_id}.stub.json")
+
+    def create(self, requests):
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        batch_id = f"msgbatch_stub_{int(time.time() * 1000)}"
+        with open(self._path(batch_id), 'w') as f:
+            json.dump([request['custom_id'] for request in requests], f)
+        return self.retrieve(batch_id)
+
+    def retrieve(self, batch_id):
+        with open(self._path(batch_id), 'r') as f:
+            count = len(json.load(f))
+        return SimpleNamespace(
+            id=batch_id,
+            processing_status='ended',
+            request_counts=SimpleNamespace(processing=0, succeeded=count, errored=0, canceled=0, expired=0)
+        )
+
+    def results(self, batch_id):
+        with open(self._path(batch_id), 'r') as f:
+            custom_ids = json.load(f)
+        for custom_id in custom_ids:
+            reply = self.canned.get(custom_id.split('-', 1)[0], {})
+            usage = SimpleNamespace(input_tokens=0, output_tokens=0,
+                                    cache_creation_input_tokens=0, cache_read_input_tokens=0)
+            message = SimpleNamespace(content=[SimpleNamespace(type='text', text=json.dumps(reply))], usage=usage)
+            yield SimpleNamespace(custom_id=custom_id, result=SimpleNamespace(type='succeeded', message=message))
+
+
+# ===================
+# SUBMIT / POLL / APPLY
+# ===================
+
+def plan_job(kind, payload):
+    """Return (params, project, settled) for one job. settled is a final result
+    when the job never needs Claude (bad input, fast path, unknown job)."""
+    if kind not in KINDS:
+        return None, None, {'status': 400, 'error': f"Unknown kind '{kind}'"}
+    if not payload.get('emailContent'):
+        return None, None, {'status': 400, 'error': 'No email content provided'}
+    payload, _ = app.trim_payload(payload, kind)
+
+    if kind == 'traffic':
+        routing = app.fast_route_email(payload)
+        if routing:
+            return None, None, {'status': 200, 'routing': routing}
+        return app.traffic_message_params(payload), None, None
+
+    if kind == 'triage':
+        return app.triage_message_params(payload['emailContent']), None, None
+
+    job_number = payload.get('jobNumber')
+    if not job_number:
+        return None, None, {'status': 400, 'error': 'No job number provided'}
+    try:
+        project = app.get_project_from_airtable(job_number)
+    except app.UpstreamUnavailable as e:
+        return None, None, app.claude_error(e, 'offline_batch')
+    if not project:
+        return None, None, {'status': 404, **app.job_not_found(job_number)}
+    return app.update_message_params(job_number, project, payload['emailContent']), project, None
+
+
+def submit(batch_client, jobs):
+    """Plan every job, submit the ones that need Claude and save local state."""
+    state = {'batchId': None, 'submittedAt': time.time(), 'applied': False, 'jobs': {}}
+    requests = []
+    for n, job in enumerate(jobs):
+        kind = job.get('kind')
+        payload = {k: v for k, v in job.items() if k != 'kind'}
+        custom_id = f"{kind}-{n}"
+        params, project, settled = plan_job(kind, payload)
+        state['jobs'][custom_id] = {'kind': kind, 'payload': payload, 'project': project, 'settled': settled}
+        if params:
+            requests.append({'custom_id': custom_id, 'params': params})
+
+    if requests:
+        batch = batch_client.create(requests=requests)
+        state['batchId'] = batch.id
+    else:
+        # Everything settled locally - nothing to send to Anthropic
+        state['batchId'] = f"local_{int(state['submittedAt'] * 1000)}"
+    state['remote'] = bool(requests)
+    save_state(state)
+    print(f"Submitted batch {state['batchId']}: {len(requests)} to Claude, "
+          f"{len(jobs) - len(requests)} settled locally")
+    return state['batchId']
+
+
+def poll(batch_client, batch_id, wait=False, interval=60):
+    """Return the batch's processing status, optionally waiting for it to end."""
+    state = load_state(batch_id)
+    if not state['remote']:
+        return 'ended'
+    while True:
+        batch = batch_client.retrieve(batch_id)
+        counts = batch.request_counts
+        print(f"Batch {batch_id}: {batch.processing_status} "
+              f"(processing={counts.processing} succeeded={counts.succeeded} errored={counts.errored})")
+        if batch.processing_status == 'ended' or not wait:
+            return batch.processing_status
+        time.sleep(interval)
+
+
+def parse_reply(kind, text):
+    """Extract and validate a batch reply against the endpoint's schema. There's
+    no repair turn here - an invalid reply is reported for a live rerun."""
+    output = app.parse_output(kind, text)
+    if output['errors']:
+        return None, app.claude_error(app.InvalidOutput(kind, output['errors'], text), 'offline_batch')
+    return output['value'], None
+
+
+def apply(batch_client, batch_id):
+    """Apply Airtable side effects for an ended batch. Returns {custom_id: result}.
+
+    Every job's Airtable writes are queued in the write journal in the same
+    dot.db transaction that records the job as applied, then sent. A crash
+    before that commit leaves nothing queued (at worst some job numbers go
+    unused); after it, rerunning apply returns the recorded results and the
+    journal sends whatever hadn't gone yet - nothing is written twice."""
+    state = load_state(batch_id)
+    if state['applied']:
+        sys.exit(f"Batch {batch_id} has already been applied")
+    conn = open_applied_db()
+    try:
+        applied = load_applied(conn, batch_id)
+        if not applied:
+            applied = apply_jobs(batch_client, batch_id, state, conn)
+    finally:
+        conn.close()
+
+    # Send what was just queued rather than waiting for a web worker's flusher
+    while app.write_journal.flush_once():
+        pass
+
+    state['applied'] = True
+    state['appliedAt'] = time.time()
+    save_state(state)
+    return {custom_id: applied[custom_id] for custom_id in state['jobs']}
+
+
+def apply_jobs(batch_client, batch_id, state, conn):
+    """Shape every job's result and queue its writes, recording them all as
+    applied in one transaction. Returns {custom_id: result}."""
+    if poll(batch_client, batch_id) != 'ended':
+        sys.exit(f"Batch {batch_id} is still processing")
+
+    replies = {}
+    if state['remote']:
+        for entry in batch_client.results(batch_id):
+            kind = state['jobs'][entry.custom_id]['kind']
+            if entry.result.type != 'succeeded':
+                replies[entry.custom_id] = (None, {'status': 500, 'error': f"Batch request {entry.result.type}"})
+                continue
+            app.record_usage(f"{kind}-batch", entry.result.message)
+            replies[entry.custom_id] = parse_reply(kind, entry.result.message.content[0].text)
+
+    results = {}
+    triage_items = []
+    update_items = []
+    for custom_id, job in state['jobs'].items():
+        if job['settled'] and 'routing' not in job['settled']:
+            results[custom_id] = job['settled']
+            continue
+
+        if job['settled']:
+            analysis, error = job['settled']['routing'], None
+        else:
+            analysis, error = replies.get(custom_id, (None, {'status': 500, 'error': 'No batch result'}))
+        if error:
+            results[custom_id] = error
+        elif job['kind'] == 'traffic':
+            analysis.setdefault('routedBy', 'claude-batch')
+            results[custom_id] = {'status': 200, **app.enrich_routing(analysis)}
+        elif job['kind'] == 'triage':
+            triage_items.append((custom_id, app.triage_item(analysis)))
+        else:
+            update_items.append((custom_id, app.update_item(job['payload']['jobNumber'], job['project'], analysis)))
+
+    # Side effects go through the same coalesced writes as the batch endpoints,
+    # queued in the transaction that marks the jobs applied
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if triage_items:
+            finished = app.finish_triage_batch([item for _, item in triage_items], conn=conn)
+            for (custom_id, _), result in zip(triage_items, finished):
+                results[custom_id] = {k: v for k, v in result.items() if k != 'index'}
+        if update_items:
+            finished, _ = app.finish_update_batch([item for _, item in update_items], conn=conn)
+            for (custom_id, _), result in zip(update_items, finished):
+                results[custom_id] = {k: v for k, v in result.items() if k != 'index'}
+        now = time.time()
+        conn.executemany("""INSERT INTO offline_batch_applied (batch_id, custom_id, result, applied_at)
+            VALUES (?, ?, ?, ?)""", [(batch_id, custom_id, json.dumps(results[custom_id]), now)
+                                     for custom_id in state['jobs']])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stub', metavar='CANNED.json', help='use StubBatchClient with canned replies')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    submit_cmd = commands.add_parser('submit', help='submit a JSONL file of jobs')
+    submit_cmd.add_argument('jobs')
+
+    poll_cmd = commands.add_parser('poll', help='check (or wait for) batch completion')
+    poll_cmd.add_argument('batch_id')
+    poll_cmd.add_argument('--wait', action='store_true')
+    poll_cmd.add_argument('--interval', type=int, default=60)
+
+    apply_cmd = commands.add_parser('apply', help='apply Airtable side effects for an ended batch')
+    apply_cmd.add_argument('batch_id')
+    apply_cmd.add_argument('--out', help='write results as JSONL here instead of stdout')
+
+    args = parser.parse_args()
+
+    if args.stub:
+        with open(args.stub, 'r') as f:
+            batch_client = StubBatchClient(json.load(f))
+    else:
+        batch_client = app.client.beta.messages.batches
+
+    if args.command == 'submit':
+        with open(args.jobs, 'r') as f:
+            jobs = [json.loads(line) for line in f if line.strip()]
+        submit(batch_client, jobs)
+    elif args.command == 'poll':
+        poll(batch_client, args.batch_id, wait=args.wait, interval=args.interval)
+    else:
+        results = apply(batch_client, args.batch_id)
+        lines = [json.dumps({'customId': custom_id, **result}) for custom_id, result in results.items()]
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            print(f"Wrote {len(lines)} results to {args.out}")
+        else:
+            print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    main()
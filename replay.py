@@ -0,0 +1,260 @@
+"""Replay recorded production traffic against the app, deterministically.
+
+Run the app with RECORDING_PATH set and every /traffic, /triage, /update
+and batch request is appended there as one redacted JSON line, along with
+the Claude replies and Airtable responses it caused (see RECORDING in
+app.py). This tool boots the app against fake Anthropic and Airtable
+servers that answer with those recorded responses, at their recorded
+latency. It then sends the recorded requests again, on their original
+schedule or faster.
+
+    python replay.py recordings.jsonl
+    python replay.py recordings.jsonl --speed 10 --diffs diffs.jsonl
+    python replay.py recordings.jsonl --speed 0 --concurrency 20 --upstream-scale 0
+
+It reports replayed against recorded latency per endpoint, plus every
+request whose output changed. Timings and other per-run fields are ignored
+in that comparison. The exit status is 1 when any output changed, so it
+can gate a change to routing or prompts.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import benchmark
+
+# Fields that legitimately differ between runs - left out of the output comparison
+VOLATILE_KEYS = {'timings', 'timingBreakdown', 'inputTrim', 'ms', 'jobRecordId', 'snapshot', 'cache'}
+
+
+# ===================
+# RECORDED UPSTREAMS
+# ===================
+
+def prompt_key(messages):
+    """Same key app.prompt_key stores for each recorded Claude call."""
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def airtable_key(method, path, params, body):
+    params = sorted((key, str(value[0] if isinstance(value, list) else value)) for key, value in (params or {}).items())
+    digest = hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest() if body else None
+    return json.dumps([method, path, params, digest])
+
+
+class RecordedResponses:
+    """Recorded upstream responses by request key, served in recorded order.
+    The last response for a key is repeated once the queue runs dry."""
+
+    def __init__(self):
+        self.responses = {}
+        self.served = 0
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, response, ms):
+        self.responses.setdefault(key, []).append((response, ms))
+
+    def take(self, key):
+        with self._lock:
+            queue = self.responses.get(key)
+            if not queue:
+                self.unmatched += 1
+                return None
+            self.served += 1
+            return queue.pop(0) if len(queue) > 1 else queue[0]
+
+
+class ReplayAnthropicHandler(benchmark.FakeAnthropicHandler):
+    """Answers with the recorded reply for the same model and prompt,
+    falling back to the benchmark's canned replies."""
+
+    def reply(self, body):
+        recorded = self.server.state['recorded'].take((body.get('model'), prompt_key(body.get('messages', []))))
+        if recorded is None:
+            return super().reply(body)
+        response, ms = recorded
+        return response['text'], response['usage'], ms / 1000 * self.server.state['scale']
+
+
+class ReplayAirtableHandler(benchmark.FakeAirtableHandler):
+    """Answers with the recorded response for the same request. Anything
+    unrecorded (e.g. writes whose due date moved on) goes to in-memory tables
+    seeded with every record the recording saw."""
+
+    def respond(self, method, table, record_id, query, body):
+        state = self.server.state
+        path = f"{table}/{record_id}" if record_id else table
+        recorded = state['recorded'].take(airtable_key(method, path, query, body))
+        if recorded is None:
+            status, payload = self.apply(method, table, record_id, query, body)
+            return self.send_json(payload, status)
+        response, ms = recorded
+        time.sleep(ms / 1000 * state['scale'])
+        self.send_json(response)
+
+
+def load_recordings(path):
+    with open(path, 'r') as f:
+        recordings = [json.loads(line) for line in f if line.strip()]
+    if not recordings:
+        sys.exit(f"No recordings in {path}")
+    return sorted(recordings, key=lambda recording: recording['t'])
+
+
+def index_upstreams(recordings):
+    """Split recorded exchanges into Claude and Airtable responses, and
+    seed tables from every record Airtable returned."""
+    claude = RecordedResponses()
+    airtable = RecordedResponses()
+    tables = {}
+    for recording in recordings:
+        for exchange in recording['exchanges']:
+            request = exchange['request']
+            if exchange['kind'] == 'claude':
+                claude.add((request['model'], request['promptKey']), exchange['response'], exchange['ms'])
+                continue
+            airtable.add(airtable_key(request['method'], request['path'], request.get('params'), request.get('json')),
+                         exchange['response'], exchange['ms'])
+            table = request['path'].split('/', 1)[0]
+            records = exchange['response'].get('records') or ([exchange['response']] if 'id' in exchange['response'] else [])
+            for record in records:
+                tables.setdefault(table, {})[record['id']] = {'id': record['id'], 'fields': dict(record.get('fields', {})),
+                                                              'modified': ''}
+    return claude, airtable, tables
+
+
+# ===================
+# REPLAY
+# ===================
+
+def normalise(value):
+    if isinstance(value, dict):
+        return {key: normalise(item) for key, item in value.items() if key not in VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [normalise(item) for item in value]
+    return value
+
+
+def replay(base_url, recordings, speed, concurrency, timeout):
+    """Send every recording, spaced by its recorded start time / speed
+    (speed 0 = back to back). Returns (samples, diffs, wall seconds)."""
+    samples = []
+    diffs = []
+    lock = threading.Lock()
+    t0 = recordings[0]['t']
+
+    with httpx.Client(base_url=base_url, timeout=timeout, limits=httpx.Limits(max_connections=concurrency)) as http:
+        def send(n):
+            recording = recordings[n]
+            headers = {'Idempotency-Key': recording['idempotencyKey']} if recording.get('idempotencyKey') else {}
+            started = time.perf_counter()
+            try:
+                response = http.request(recording['method'], recording['endpoint'], json=recording['payload'],
+                                        headers=headers)
+                status = response.status_code
+                body = response.json() if response.headers.get('content-type', '').startswith('application/json') else None
+            except httpx.HTTPError as e:
+                status, body = type(e).__name__, None
+            elapsed = time.perf_counter() - started
+
+            endpoint = recording['endpoint'].strip('/')
+            with lock:
+                samples.append({'endpoint': endpoint, 'status': status, 'seconds': elapsed,
+                                'routedBy': body.get('routedBy') if isinstance(body, dict) else None})
+                if status != recording['status'] or normalise(body) != normalise(recording['response']):
+                    diffs.append({'index': n, 'endpoint': recording['endpoint'], 'payload': recording['payload'],
+                                  'recorded': {'status': recording['status'], 'response': normalise(recording['response'])},
+                                  'replayed': {'status': status, 'response': normalise(body)}})
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = []
+            for n, recording in enumerate(recordings):
+                if speed:
+                    delay = (recording['t'] - t0) / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(pool.submit(send, n))
+            for future in futures:
+                future.result()
+        wall = time.perf_counter() - started
+    return samples, diffs, wall
+
+
+def recorded_report(recordings):
+    """The recording's own latencies, summarised like a replay for comparison."""
+    samples = [{'endpoint': recording['endpoint'].strip('/'), 'status': recording['status'],
+                'seconds': recording['ms'] / 1000, 'routedBy': None} for recording in recordings]
+    span = (recordings[-1]['t'] - recordings[0]['t']) or None
+    return benchmark.summarise(samples, span)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recordings', help='JSONL written by the app with RECORDING_PATH set')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='1 = recorded pace, 10 = ten times faster, 0 = back to back (default: 1)')
+    parser.add_argument('--concurrency', type=int, default=50, help='max requests in flight (default: 50)')
+    parser.add_argument('--upstream-scale', type=float, default=1.0,
+                        help='multiplier on recorded Claude/Airtable latency, 0 = instant (default: 1)')
+    parser.add_argument('--server', choices=['gunicorn', 'flask'],
+                        default='gunicorn' if shutil.which('gunicorn') else 'flask')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--diffs', help='write changed outputs here as JSONL')
+    args = parser.parse_args()
+
+    recordings = load_recordings(args.recordings)
+    claude, airtable, tables = index_upstreams(recordings)
+
+    anthropic = benchmark.start_server(ReplayAnthropicHandler, {
+        'recorded': claude, 'scale': args.upstream_scale, 'latency': 0.0, 'jitter': 0.0, 'canned': {},
+        'cached_systems': set(), 'lock': threading.Lock()})
+    airtable_server = benchmark.start_server(ReplayAirtableHandler, {
+        'recorded': airtable, 'scale': args.upstream_scale, 'latency': 0.0, 'jitter': 0.0, 'tables': tables,
+        'next_id': 0, 'lock': threading.Lock()})
+
+    data_dir = tempfile.mkdtemp(prefix='dot-replay-')
+    process, base_url = benchmark.start_app(args.server, {
+        'ANTHROPIC_BASE_URL': benchmark.server_url(anthropic),
+        'ANTHROPIC_API_KEY': 'replay',
+        'AIRTABLE_API_URL': f"{benchmark.server_url(airtable_server)}/v0",
+        'AIRTABLE_API_KEY': 'replay',
+        'DOT_DATA_DIR': data_dir,
+        'RECORDING_PATH': ''
+    }, benchmark.free_port())
+    print(f"Replaying {len(recordings)} requests against {base_url} ({args.server}) at speed {args.speed or 'max'}")
+
+    try:
+        samples, diffs, wall = replay(base_url, recordings, args.speed, args.concurrency, args.timeout)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"\nReplayed in {wall:.1f}s - upstream responses served {claude.served + airtable.served}, "
+          f"unmatched {claude.unmatched} Claude / {airtable.unmatched} Airtable\n")
+    benchmark.print_report(benchmark.summarise(samples, wall), recorded_report(recordings))
+
+    print(f"\n{len(diffs)} of {len(recordings)} outputs changed")
+    for diff in diffs[:10]:
+        print(f"  #{diff['index']} {diff['endpoint']}: recorded {diff['recorded']['status']}, "
+              f"replayed {diff['replayed']['status']}")
+    if args.diffs:
+        with open(args.diffs, 'w') as f:
+            f.write(''.join(json.dumps(diff) + '\n' for diff in diffs))
+        print(f"Wrote {args.diffs}")
+    sys.exit(1 if diffs else 0)
+
+
+if __name__ == '__main__':
+    main()
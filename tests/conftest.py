@@ -0,0 +1,19 @@
+"""Point the app at a throwaway data directory before it's imported.
+
+app.py reads its configuration and prompt files at import time, so the
+environment is set up here and tests run from the repository root. Nothing
+talks to real Airtable or Anthropic - tests swap in fakes.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+os.environ['DOT_DATA_DIR'] = tempfile.mkdtemp(prefix='dot-tests-')
+os.environ['ANTHROPIC_API_KEY'] = 'test'
+os.environ['AIRTABLE_RATE_LIMIT'] = '0'
+os.environ.pop('AIRTABLE_API_KEY', None)
+os.environ.pop('RECORDING_PATH', None)
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
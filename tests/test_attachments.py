@@ -0,0 +1,46 @@
+"""Base64 attachments from Power Automate: MIME line breaks anywhere are
+fine, anything else that isn't base64 is a 400 naming the attachment."""
+import base64
+import os
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('wrap', [None, 76, 4096])
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 1000, app.READ_CHUNK + 7])
+def test_spool_base64_round_trips(size, wrap):
+    raw = os.urandom(size)
+    encoded = base64.b64encode(raw).decode()
+    if wrap:
+        encoded = '\r\n'.join(encoded[i:i + wrap] for i in range(0, len(encoded), wrap))
+    with app.spool_base64(encoded) as spooled:
+        assert spooled.read() == raw
+
+
+def test_whitespace_only_after_the_first_chunk_is_skipped():
+    raw = os.urandom(app.READ_CHUNK * 2)
+    encoded = base64.b64encode(raw).decode()
+    cut = len(encoded) - 5000
+    with app.spool_base64(encoded[:cut] + '\n ' + encoded[cut:]) as spooled:
+        assert spooled.read() == raw
+
+
+@pytest.mark.parametrize('encoded', ['not*base64!', 'QUJD\nRA', 'QUJDRA==QUJD', 'QUJDé'])
+def test_spool_base64_rejects_bad_input(encoded):
+    with pytest.raises(ValueError):
+        app.spool_base64(encoded)
+
+
+def test_feedback_names_the_bad_attachment():
+    response = app.app.test_client().post('/feedback', json={
+        'jobNumber': 'SKY 042',
+        'emailContent': 'Notes attached',
+        'attachments': [
+            {'name': 'notes.txt', 'contentBytes': base64.b64encode(b'Logo bigger').decode()},
+            {'name': 'Deck v3.pdf', 'contentBytes': 'JVBERi0xLjQK%%%'}
+        ]
+    })
+    assert response.status_code == 400
+    assert 'Deck v3.pdf' in response.get_json()['message']
@@ -0,0 +1,72 @@
+"""Async job callbacks only go to configured hosts on public addresses."""
+import socket
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def dns(monkeypatch):
+    """Resolve names from a dict instead of the network."""
+    records = {}
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        address = records.get(host, host)
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        return [(family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', (address, port))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    monkeypatch.setattr(app, 'JOB_CALLBACK_HOSTS', ['flows.example.com'])
+    return records
+
+
+def test_no_callbacks_without_configured_hosts(dns, monkeypatch):
+    monkeypatch.setattr(app, 'JOB_CALLBACK_HOSTS', [])
+    dns['flows.example.com'] = '93.184.216.34'
+    assert not app.callback_allowed('https://flows.example.com/hook')
+
+
+def test_configured_public_host_is_allowed(dns):
+    dns['flows.example.com'] = '93.184.216.34'
+    dns['eu.flows.example.com'] = '93.184.216.35'
+    assert app.callback_allowed('https://flows.example.com/hook')
+    assert app.callback_allowed('https://eu.flows.example.com/hook')
+    assert not app.callback_allowed('https://flows.example.com.evil.net/hook')
+    assert not app.callback_allowed('ftp://flows.example.com/hook')
+
+
+@pytest.mark.parametrize('address', ['127.0.0.1', '10.1.2.3', '192.168.0.10', '169.254.169.254', '::1',
+                                     '::ffff:127.0.0.1', 'fd00::1'])
+def test_host_resolving_to_internal_address_is_refused(dns, address):
+    dns['flows.example.com'] = address
+    assert not app.callback_allowed('https://flows.example.com/hook')
+
+
+def test_endpoint_rejects_callback_url_when_hosts_unset(monkeypatch):
+    monkeypatch.setattr(app, 'JOB_CALLBACK_HOSTS', [])
+    response = app.app.test_client().post('/triage', json={
+        'emailContent': 'New brief', 'callbackUrl': 'http://127.0.0.1:8080/admin'
+    })
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'callback_not_allowed'
+
+
+def test_callback_is_not_sent_once_host_points_inside(dns, monkeypatch):
+    dns['flows.example.com'] = '93.184.216.34'
+    job_id = app.job_queue.enqueue('triage', '/triage', {'emailContent': 'x'}, 'https://flows.example.com/hook')
+    conn = app.open_db()
+    try:
+        app.job_queue._finish(conn, job_id, 'done', 200, {'jobNumber': 'SKY 001'})
+    finally:
+        conn.close()
+
+    posted = []
+    monkeypatch.setattr(app.job_queue.http, 'post', lambda url, **kwargs: posted.append(url))
+    # Re-pointed at the metadata service between queueing and sending
+    dns['flows.example.com'] = '169.254.169.254'
+    while app.job_queue.send_callback():
+        pass
+
+    assert posted == []
+    assert app.job_queue.get(job_id)['callback_state'] == 'failed'
@@ -0,0 +1,45 @@
+import json
+import os
+
+import pytest
+
+import app
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'routing_corpus.json')
+
+with open(CORPUS_PATH) as f:
+    CORPUS = json.load(f)
+
+
+def fast_route(email):
+    payload, _ = app.trim_payload(email, 'traffic')
+    return app.fast_route_email(payload)
+
+
+@pytest.mark.parametrize('case', CORPUS, ids=[case['name'] for case in CORPUS])
+def test_fast_path_agrees_with_label(case):
+    routing = fast_route(case['email'])
+    if routing is None:
+        return
+    assert routing['route'] == case['route']
+    for field in ('jobNumber', 'clientCode'):
+        if field in case:
+            assert routing[field] == case[field]
+
+
+def test_fast_path_precision():
+    claimed = [(case, fast_route(case['email'])) for case in CORPUS]
+    claimed = [(case, routing) for case, routing in claimed if routing]
+    wrong = [case['name'] for case, routing in claimed if routing['route'] != case['route']]
+    assert not wrong
+    # Still worth having: the mechanical cases stay off Claude
+    assert len(claimed) >= len(CORPUS) // 2
+
+
+@pytest.mark.parametrize('subject,content', [
+    ('RE: Which job is this?', 'Let me check\n\nOn Mon, 3 Mar 2025 at 10:02, Dot <dot@hunch.co.nz> wrote:\n> just reply "Triage"'),
+    ('banner', 'Add the banner to the WIP list'),
+    ('WIP list', 'The Sky banner is missing from it'),
+])
+def test_keywords_outside_command_position_go_to_claude(subject, content):
+    assert fast_route({'subjectLine': subject, 'emailContent': content, 'senderEmail': 'amy@hunch.co.nz'}) is None
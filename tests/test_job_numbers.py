@@ -0,0 +1,139 @@
+"""Concurrent job number allocation: distinct, gap-free numbers per client,
+and no client (or unrelated dot.db user) waiting on another's Airtable call.
+An Airtable outage is a 503, never a TBC job number."""
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+AIRTABLE_LATENCY = 0.5
+
+
+class FakeAirtable:
+    """Clients table whose reads take `latency` seconds. Next # never moves -
+    the write-back goes through the journal, which isn't flushed here."""
+
+    def __init__(self, next_numbers, latency):
+        self.next_numbers = next_numbers
+        self.latency = latency
+        self.down = False
+
+    def get_record(self, table, record_id):
+        time.sleep(self.latency)
+        if self.down:
+            raise app.UpstreamUnavailable('airtable', 'circuit open', retry_after=30)
+        return {'id': record_id, 'fields': {'Next #': self.next_numbers[record_id[3:]]}}
+
+
+class FakeDirectory:
+    def __init__(self, codes):
+        self.codes = codes
+
+    def knows(self, code):
+        return code in self.codes
+
+    def get(self, code):
+        return {'recordId': f"rec{code}", 'teamId': None, 'sharepointUrl': None}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    codes = ['ONE', 'SKY', 'TOW', 'FIS']
+    monkeypatch.setattr(app, 'airtable', FakeAirtable({code: 85 for code in codes}, AIRTABLE_LATENCY))
+    monkeypatch.setattr(app, 'client_directory', FakeDirectory(codes))
+    conn = app.open_db()
+    try:
+        conn.execute('DELETE FROM job_number_blocks')
+        conn.execute('DELETE FROM write_journal')
+    finally:
+        conn.close()
+    return codes
+
+
+def allocate_many(block_size, code, count):
+    allocator = app.JobNumberAllocator(block_size)
+    return [allocator.allocate(code)[0] for _ in range(count)]
+
+
+def queued_next_numbers():
+    conn = app.open_db()
+    try:
+        rows = conn.execute("SELECT record_id, fields FROM write_journal WHERE table_name = ?",
+                            (app.AIRTABLE_CLIENTS_TABLE,)).fetchall()
+    finally:
+        conn.close()
+    return {row['record_id']: json.loads(row['fields'])['Next #'] for row in rows}
+
+
+@pytest.mark.parametrize('block_size', [1, 5])
+def test_threads_get_distinct_gap_free_numbers(clients, block_size):
+    app.airtable.latency = 0.02
+    allocator = app.JobNumberAllocator(block_size)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        numbers = list(pool.map(lambda _: allocator.allocate('ONE')[0], range(40)))
+
+    assert sorted(numbers) == list(range(85, 125))
+    # Airtable is told where the local counter got to
+    assert queued_next_numbers()['recONE'] >= 125
+
+
+@pytest.mark.parametrize('block_size', [1, 5])
+def test_processes_get_distinct_gap_free_numbers(clients, block_size):
+    app.airtable.latency = 0.02
+    # Each process has its own allocator and locks, like gunicorn workers -
+    # only dot.db keeps them apart
+    context = multiprocessing.get_context('fork')
+    with context.Pool(4) as pool:
+        results = pool.starmap(allocate_many, [(block_size, 'SKY', 10)] * 4)
+
+    numbers = [number for result in results for number in result]
+    assert sorted(numbers) == list(range(85, 125))
+
+
+def test_clients_do_not_wait_on_each_other(clients):
+    allocator = app.JobNumberAllocator(1)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        numbers = list(pool.map(lambda code: allocator.allocate(code)[0], clients))
+    elapsed = time.perf_counter() - started
+
+    assert numbers == [85] * len(clients)
+    # One Airtable read each, side by side - serialised would be 4 x latency
+    assert elapsed < 2 * AIRTABLE_LATENCY
+
+
+def test_airtable_read_does_not_hold_the_database(clients):
+    allocator = app.JobNumberAllocator(1)
+    refill = threading.Thread(target=allocator.allocate, args=('TOW',))
+    refill.start()
+    time.sleep(AIRTABLE_LATENCY / 5)
+
+    # The refill is mid-Airtable-call; other dot.db writers carry on
+    started = time.perf_counter()
+    app.write_journal.enqueue(app.AIRTABLE_UPDATES_TABLE, 'create', [{'Update': 'x'}])
+    elapsed = time.perf_counter() - started
+    refill.join()
+
+    assert elapsed < AIRTABLE_LATENCY / 2
+
+
+def test_airtable_outage_is_not_a_tbc_job_number(clients, monkeypatch):
+    app.airtable.down = True
+    app.airtable.latency = 0
+    monkeypatch.setattr(app, 'AIRTABLE_API_KEY', 'test')
+    monkeypatch.setattr(app, 'triage_analysis', lambda *_: ({'clientCode': 'SKY', 'jobName': 'Promo'}, None))
+
+    with pytest.raises(app.UpstreamUnavailable):
+        app.get_job_info_from_airtable('SKY')
+
+    response = app.app.test_client().post('/triage', json={'emailContent': 'New brief for the summer promo'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '31'
+
+    response = app.app.test_client().post('/triage/batch', json={'emails': [{'emailContent': 'New brief'}]})
+    assert response.get_json()['results'][0]['status'] == 503
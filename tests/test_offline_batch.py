@@ -0,0 +1,97 @@
+"""Offline batch apply: a crash at any point, then a rerun, writes each
+job's Airtable records exactly once."""
+import pytest
+
+import app
+import offline_batch
+
+TRIAGE_REPLY = {'clientCode': 'SKY', 'clientName': 'Sky', 'projectOwner': 'Amy',
+                'jobName': 'Summer promo', 'jobSummary': 'Social and OOH for the summer promo'}
+
+
+class FakeAirtable:
+    def __init__(self):
+        self.created = []
+
+    def get_record(self, table, record_id):
+        return {'id': record_id, 'fields': {'Next #': 85}}
+
+    def create_records(self, table, fields_list):
+        self.created.extend(fields_list)
+        return [{'id': f"rec{len(self.created) - len(fields_list) + n}"} for n in range(len(fields_list))]
+
+    def update_records(self, table, updates):
+        pass
+
+
+class FakeDirectory:
+    def knows(self, code):
+        return True
+
+    def get(self, code):
+        return {'recordId': f"rec{code}", 'teamId': None, 'sharepointUrl': None}
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    fake = FakeAirtable()
+    monkeypatch.setattr(app, 'airtable', fake)
+    monkeypatch.setattr(app, 'client_directory', FakeDirectory())
+    monkeypatch.setattr(app, 'AIRTABLE_API_KEY', 'test')
+    conn = offline_batch.open_applied_db()
+    try:
+        for table in ('job_number_blocks', 'write_journal', 'offline_batch_applied'):
+            conn.execute(f"DELETE FROM {table}")
+    finally:
+        conn.close()
+    client = offline_batch.StubBatchClient({'triage': TRIAGE_REPLY})
+    jobs = [{'kind': 'triage', 'emailContent': f"New brief number {n} for the summer promo"} for n in range(3)]
+    batch_id = offline_batch.submit(client, jobs)
+    return client, batch_id, fake
+
+
+def project_creates(fake):
+    return sorted(fields['Job Number'] for fields in fake.created if 'Job Number' in fields)
+
+
+def test_crash_after_commit_is_not_applied_twice(batch, monkeypatch):
+    client, batch_id, fake = batch
+    save_state = offline_batch.save_state
+
+    def crash(state):
+        raise RuntimeError('killed')
+    monkeypatch.setattr(offline_batch, 'save_state', crash)
+    with pytest.raises(RuntimeError):
+        offline_batch.apply(client, batch_id)
+    first = project_creates(fake)
+
+    monkeypatch.setattr(offline_batch, 'save_state', save_state)
+    results = offline_batch.apply(client, batch_id)
+
+    assert project_creates(fake) == first == ['SKY 085', 'SKY 086', 'SKY 087']
+    assert sorted(result['jobNumber'] for result in results.values()) == first
+
+
+def test_crash_before_commit_queues_nothing(batch, monkeypatch):
+    client, batch_id, fake = batch
+    finish_triage_batch = app.finish_triage_batch
+
+    def crash(analysed, conn=None):
+        finish_triage_batch(analysed, conn=conn)
+        raise RuntimeError('killed')
+    monkeypatch.setattr(app, 'finish_triage_batch', crash)
+    with pytest.raises(RuntimeError):
+        offline_batch.apply(client, batch_id)
+    conn = app.open_db()
+    try:
+        queued = conn.execute("SELECT COUNT(*) FROM write_journal WHERE table_name = ?",
+                              (app.AIRTABLE_JOBS_TABLE,)).fetchone()[0]
+    finally:
+        conn.close()
+    assert queued == 0
+
+    monkeypatch.setattr(app, 'finish_triage_batch', finish_triage_batch)
+    offline_batch.apply(client, batch_id)
+
+    # The first run's numbers went unused - gaps, never duplicates
+    assert project_creates(fake) == ['SKY 088', 'SKY 089', 'SKY 090']
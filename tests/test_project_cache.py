@@ -0,0 +1,114 @@
+"""The project cache never serves a record written since it was fetched -
+whichever process made the write - and a burst of lookups for an uncached
+job makes one Airtable read."""
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+
+class FakeAirtable:
+    """One Projects record; PATCHes land in it, reads are counted."""
+
+    def __init__(self):
+        self.fields = {'Job Number': 'ONE 125', 'Project Name': 'Brand refresh', 'Stage': 'Briefing'}
+        self.reads = 0
+        self.latency = 0
+        self.error = None
+
+    def list_records(self, table, formula=None, **kwargs):
+        self.reads += 1
+        time.sleep(self.latency)
+        if self.error:
+            raise self.error
+        return [{'id': 'recONE125', 'fields': dict(self.fields)}]
+
+    def update_records(self, table, updates):
+        for _, fields in updates:
+            self.fields.update(fields)
+
+
+@pytest.fixture
+def airtable(monkeypatch):
+    fake = FakeAirtable()
+    monkeypatch.setattr(app, 'airtable', fake)
+    monkeypatch.setattr(app, 'AIRTABLE_API_KEY', 'test')
+    monkeypatch.setattr(app, 'AIRTABLE_WRITE_BEHIND', True)
+    monkeypatch.setattr(app, 'project_cache', app.ProjectCache(16, 300))
+    conn = app.open_db()
+    try:
+        conn.execute('DELETE FROM write_journal')
+        conn.execute('DELETE FROM project_writes')
+    finally:
+        conn.close()
+    return fake
+
+
+def write_stage(stage):
+    app.update_project_fields_in_airtable('ONE 125', {'Stage': stage}, record_id='recONE125')
+
+
+def in_other_process(fn, *args):
+    process = multiprocessing.get_context('fork').Process(target=fn, args=args)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_hits_are_served_until_a_write(airtable):
+    app.get_project_from_airtable('ONE 125')
+    app.get_project_from_airtable('ONE 125')
+    assert airtable.reads == 1
+
+
+def test_write_in_another_process_invalidates(airtable):
+    assert app.get_project_from_airtable('ONE 125')['stage'] == 'Briefing'
+
+    # Another worker queues a PATCH and its flusher sends it
+    in_other_process(write_stage, 'Craft')
+    assert app.get_project_from_airtable('ONE 125') is not None
+    assert airtable.reads == 2
+    app.write_journal.flush_once()
+
+    # A read from before the send is dropped once Airtable has the change
+    assert app.get_project_from_airtable('ONE 125')['stage'] == 'Craft'
+    assert airtable.reads == 3
+
+
+def test_writer_sees_its_own_change_before_the_send(airtable):
+    app.get_project_from_airtable('ONE 125')
+    write_stage('Craft')
+    assert app.get_project_from_airtable('ONE 125')['stage'] == 'Craft'
+    assert airtable.reads == 1
+
+
+def burst(count):
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        futures = [pool.submit(app.get_project_from_airtable, 'ONE 125') for _ in range(count)]
+    return futures
+
+
+def test_concurrent_misses_share_one_read(airtable):
+    airtable.latency = 0.2
+    projects = [future.result() for future in burst(10)]
+    assert airtable.reads == 1
+    assert all(project['stage'] == 'Briefing' for project in projects)
+    # Callers get their own copies
+    projects[0]['stage'] = 'Mutated'
+    assert app.get_project_from_airtable('ONE 125')['stage'] == 'Briefing'
+
+
+def test_concurrent_misses_share_one_failure(airtable):
+    airtable.latency = 0.2
+    airtable.error = app.UpstreamUnavailable('airtable', 'circuit open', retry_after=30)
+    futures = burst(5)
+    assert airtable.reads == 1
+    assert all(isinstance(future.exception(), app.UpstreamUnavailable) for future in futures)
+
+    # The failure isn't cached - the next lookup tries again
+    airtable.error = None
+    assert app.get_project_from_airtable('ONE 125')['stage'] == 'Briefing'
+    assert airtable.reads == 2
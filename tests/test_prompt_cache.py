@@ -0,0 +1,17 @@
+"""System prompts are only marked cacheable when a model can actually cache them."""
+import app
+
+
+def test_short_prompt_is_not_marked():
+    assert 'cache_control' not in app.TRIAGE_SYSTEM[0]
+
+
+def test_long_prompt_is_marked():
+    assert app.UPDATE_SYSTEM[0]['cache_control'] == {'type': 'ephemeral'}
+
+
+def test_any_model_in_the_policy_can_cache(monkeypatch):
+    prompt = 'x' * 4 * 1500
+    assert 'cache_control' in app.cacheable_system(prompt, 'traffic')[0]
+    monkeypatch.setitem(app.MODEL_POLICY, 'traffic', [app.HAIKU_MODEL])
+    assert 'cache_control' not in app.cacheable_system(prompt, 'traffic')[0]
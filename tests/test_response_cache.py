@@ -0,0 +1,50 @@
+"""Response cache: a near-duplicate email only reuses Claude's answer when
+nothing that decides the client differs."""
+import pytest
+
+import app
+
+BRIEF = ("Hi team, we're after a refresh of the {client} summer campaign across social, digital display "
+         "and out of home. The hero message stays the same as last year but the offer changes to a "
+         "bonus month free for new customers who sign up before the end of February. We need concepts "
+         "in two weeks, then production to go live on the first of March. Budget is similar to last "
+         "year's campaign. Can you send through a rough timeline and a cost estimate by Friday please? "
+         "Thanks, the marketing team")
+
+
+@pytest.fixture
+def claude(monkeypatch):
+    monkeypatch.setattr(app, 'response_cache', app.ResponseCache(100, {'triage': 600, 'traffic': 600}, 0.85, 20))
+    calls = []
+
+    def ask_claude_triage(email_content):
+        client_code = 'FIS' if 'Fisher Funds' in email_content else 'ONE'
+        calls.append(client_code)
+        return {'clientCode': client_code, 'jobName': 'Summer campaign'}, 'claude-test'
+    monkeypatch.setattr(app, 'ask_claude_triage', ask_claude_triage)
+    return calls
+
+
+def test_triage_near_duplicate_is_reused(claude):
+    first, _ = app.triage_analysis(BRIEF.format(client='One NZ'))
+    second, hit = app.triage_analysis(BRIEF.format(client='One NZ') + ' Cheers')
+    assert hit and second == first
+    assert claude == ['ONE']
+
+
+def test_triage_is_not_reused_across_clients(claude):
+    app.triage_analysis(BRIEF.format(client='One NZ'))
+    analysis, hit = app.triage_analysis(BRIEF.format(client='Fisher Funds'))
+    assert hit is None
+    assert analysis['clientCode'] == 'FIS'
+
+
+def test_triage_is_not_reused_across_forwarding_domains(claude):
+    app.triage_analysis(BRIEF.format(client='new') + '\nFrom: Kate <kate@tower.co.nz>')
+    _, hit = app.triage_analysis(BRIEF.format(client='new') + '\nFrom: Jo <jo@fisherfunds.co.nz>')
+    assert hit is None
+
+
+def test_client_signals():
+    assert app.client_signals('WIP for Sky and One NZ, cc ben@hunch.co.nz') == ['ONE', 'SKY']
+    assert app.client_signals('From: a@newclient.co.nz') == ['newclient.co.nz']
@@ -0,0 +1,31 @@
+import json
+import os
+
+import pytest
+
+import app
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'trim_corpus.json')
+
+with open(CORPUS_PATH) as f:
+    CORPUS = json.load(f)
+
+
+@pytest.mark.parametrize('case', CORPUS, ids=[case['name'] for case in CORPUS])
+@pytest.mark.parametrize('endpoint', ['triage', 'update'])
+def test_actionable_lines_survive_trimming(case, endpoint):
+    trimmed, _ = app.trim_email(case['message'], endpoint)
+    for line in case['keep']:
+        assert line in trimmed
+    for line in case.get('drop', []):
+        assert line not in trimmed
+
+
+def test_quoted_sign_off_only_cuts_the_signature():
+    message = ("Sounds good, see below.\n\n"
+               "On Mon, 3 Mar 2025 at 10:02, Kate <kate@tower.co.nz> wrote:\n"
+               "> Thanks for the concepts.\n> Changes:\n> 1. Warmer palette\n> 2. Live date 9 June\n"
+               "> Thanks,\n> Kate\n> Tower Insurance\n> 09 555 0199\n> tower.co.nz")
+    trimmed, _ = app.trim_email(message, 'triage')
+    assert '2. Live date 9 June' in trimmed
+    assert 'tower.co.nz' not in trimmed.splitlines()
@@ -0,0 +1,45 @@
+"""Circuit breaker bookkeeping around the shared rate limiter."""
+import httpx
+import pytest
+
+import app
+
+
+def fail(breaker, exc):
+    with pytest.raises(type(exc)):
+        with breaker.guard(app.airtable_failure):
+            raise exc
+
+
+def server_error():
+    request = httpx.Request('GET', 'https://api.airtable.com/v0/base/Projects')
+    return httpx.HTTPStatusError('Server error', request=request, response=httpx.Response(502, request=request))
+
+
+def rate_limited():
+    return app.UpstreamUnavailable('airtable', 'rate limit wait exceeded', retry_after=2)
+
+
+def test_rate_limit_wait_does_not_reset_failures():
+    breaker = app.CircuitBreaker('airtable', 3, 30)
+    fail(breaker, server_error())
+    fail(breaker, server_error())
+    fail(breaker, rate_limited())
+    assert breaker.failures == 2
+    fail(breaker, server_error())
+    assert breaker.state == 'open'
+
+
+def test_rate_limit_wait_does_not_close_half_open_breaker():
+    breaker = app.CircuitBreaker('airtable', 1, 0.01)
+    fail(breaker, server_error())
+    assert breaker.state == 'open'
+    breaker.opened_at -= 1
+
+    # The trial call never reached Airtable - still half-open, and the next
+    # call gets to be the trial
+    fail(breaker, rate_limited())
+    assert breaker.state == 'half_open'
+    with breaker.guard(app.airtable_failure):
+        pass
+    assert breaker.state == 'closed'
@@ -0,0 +1,105 @@
+"""Write journal: what callers are told about writes that were sent versus
+only queued for the flusher, and that a slow send is never sent twice."""
+import threading
+import time
+
+import httpx
+import pytest
+
+import app
+
+
+class FakeAirtable:
+    """Records creates and PATCHes; fails every send while `down`."""
+
+    def __init__(self):
+        self.down = False
+        self.latency = 0
+        self.created = []
+        self.updated = []
+
+    def fail(self, status=502):
+        request = httpx.Request('POST', 'https://api.airtable.com/v0/base/table')
+        raise httpx.HTTPStatusError('Request failed', request=request, response=httpx.Response(status, request=request))
+
+    def create_records(self, table, fields_list):
+        time.sleep(self.latency)
+        if self.down:
+            self.fail()
+        # Airtable rejects the whole request if any record has a bad select option
+        if any(fields.get('Stage') == 'Bogus' for fields in fields_list):
+            self.fail(422)
+        self.created.extend(fields_list)
+        return [{'id': f"rec{len(self.created) - len(fields_list) + n}"} for n in range(len(fields_list))]
+
+    def update_records(self, table, updates):
+        if self.down:
+            self.fail()
+        self.updated.extend(updates)
+
+
+@pytest.fixture
+def airtable(monkeypatch):
+    fake = FakeAirtable()
+    monkeypatch.setattr(app, 'airtable', fake)
+    monkeypatch.setattr(app, 'AIRTABLE_API_KEY', 'test')
+    monkeypatch.setattr(app, 'AIRTABLE_WRITE_BEHIND', False)
+    conn = app.open_db()
+    try:
+        conn.execute('DELETE FROM write_journal')
+    finally:
+        conn.close()
+    return fake
+
+
+def test_synchronous_create_reports_written(airtable):
+    assert app.create_update_in_airtable('recPROJ', 'Copy approved') == 'written'
+    assert len(airtable.created) == 1
+
+
+def test_synchronous_create_reports_queued_when_send_fails(airtable):
+    airtable.down = True
+    assert app.create_update_in_airtable('recPROJ', 'Copy approved') == 'queued'
+    assert app.write_journal.stats()['pending'] == 1
+
+
+def test_project_patch_reports_queued_when_send_fails(airtable):
+    airtable.down = True
+    assert app.update_project_fields_in_airtable('ONE 125', {'Stage': 'Craft'}, record_id='recPROJ') == 'queued'
+
+
+def test_batch_updates_report_written_or_queued(airtable):
+    assert app.update_records_in_batches(app.AIRTABLE_JOBS_TABLE, [('recA', {'Stage': 'Craft'})]) == ['written']
+    airtable.down = True
+    assert app.update_records_in_batches(app.AIRTABLE_JOBS_TABLE, [('recB', {'Stage': 'Craft'})]) == ['queued']
+
+
+def test_slow_send_is_not_reclaimed(airtable, monkeypatch):
+    # A send held up by the rate limiter for longer than the claim timeout
+    # keeps its claim - the flusher must not take it for a dead worker's
+    monkeypatch.setattr(app, 'JOURNAL_CLAIM_TIMEOUT', 0.4)
+    airtable.latency = 1.5
+    entry_ids = app.write_journal.enqueue(app.AIRTABLE_UPDATES_TABLE, 'create', [{'Update': 'Copy approved'}])
+    sender = threading.Thread(target=app.write_journal.flush_entries, args=(entry_ids,))
+    sender.start()
+    while not app.write_journal.stats()['sending']:
+        time.sleep(0.01)
+    while sender.is_alive():
+        app.write_journal.flush_once()
+        time.sleep(0.05)
+    assert len(airtable.created) == 1
+
+
+def test_rejected_record_does_not_fail_its_batch(airtable):
+    fields_list = [{'Update': 'First'}, {'Update': 'Bad', 'Stage': 'Bogus'}, {'Update': 'Third'}]
+    entry_ids = app.write_journal.enqueue(app.AIRTABLE_UPDATES_TABLE, 'create', fields_list)
+    assert app.write_journal.flush_once() == 3
+
+    conn = app.open_db()
+    try:
+        states = [conn.execute("SELECT state FROM write_journal WHERE id = ?", (entry_id,)).fetchone()[0]
+                  for entry_id in entry_ids]
+    finally:
+        conn.close()
+    assert states == ['done', 'failed', 'done']
+    assert [fields['Update'] for fields in airtable.created] == ['First', 'Third']
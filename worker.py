@@ -0,0 +1,44 @@
+"""Background worker for async /triage, /update and batch jobs.
+
+Requests sent with `Prefer: respond-async`, `?async=1` or a callbackUrl are
+queued in SQLite under DOT_DATA_DIR (see JOB QUEUE in app.py). This process
+claims them and runs each through the same view the web process would
+have, on its own pool of threads, so job throughput scales separately from
+the web workers. Run as many as needed - they share the queue.
+
+    python worker.py
+    python worker.py --concurrency 10
+
+It must see the same DOT_DATA_DIR as the web process. SIGTERM lets running
+jobs finish before exiting.
+"""
+import argparse
+import signal
+import threading
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=app.JOB_WORKER_CONCURRENCY,
+                        help=f"jobs run at once (default: JOB_WORKER_CONCURRENCY, {app.JOB_WORKER_CONCURRENCY})")
+    parser.add_argument('--grace', type=float, default=120.0,
+                        help='seconds to wait for running jobs on shutdown (default: 120)')
+    args = parser.parse_args()
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    app.job_queue.start(args.concurrency)
+    print(f"Job worker {app.job_queue.worker_id} running {args.concurrency} threads on {app.DOT_DB_PATH}")
+    while not stopping.wait(1.0):
+        pass
+
+    print('Stopping - waiting for running jobs')
+    app.job_queue.stop(args.grace)
+
+
+if __name__ == '__main__':
+    main()